@@ -2,6 +2,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 import pandas as pd
+from .prediction_store import *
 from .custom_losses import *
 from .metrics import *
 from keras.models import load_model
@@ -11,7 +12,7 @@ from abstention.calibration import PlattScaling, IsotonicRegression
 import argparse
 def parse_args():
     parser=argparse.ArgumentParser(description="calibration of model preacts/logits")
-    parser.add_argument("--preacts",help="preact/logit hdf5 file generated by kerasAC_predict")
+    parser.add_argument("--preacts",help="preact/logit hdf5 file generated by kerasAC_predict, table or columnar format")
     parser.add_argument("--labels",help="hdf5 file generated by kerasAC_predict")
     parser.add_argument("--model",help="hdf5 file generated by kerasAC_train")
     parser.add_argument("--outf",help="name of output hdf5 file")
@@ -51,10 +52,10 @@ def calibrate(preacts,labels,model,outf,calibrate_regression=False,calibrate_cla
     assert not ((calibrate_classification==True) and (calibrate_regression==True))
     if(type(preacts)!=type(pd.DataFrame)):
         #load the preacts
-        preacts=pd.read_hdf(preacts)
+        preacts=read_prediction_table(preacts)
         print("loaded preacts from hdf5")
     if(type(labels)!=type(pd.DataFrame)):
-        labels=pd.read_hdf(labels)
+        labels=read_prediction_table(labels)
         print("loaded labels from hdf5") 
     #make sure they are in the same order
     labels=labels.loc[preacts.index]
@@ -40,6 +40,8 @@ def args_object_from_args_dict(args_dict):
     vars(args_object)['valid_upsample']=None
     vars(args_object)['threads']=1
     vars(args_object)['max_queue_size']=100
+    vars(args_object)['prefetch_depth']=0
+    vars(args_object)['prefetch_workers']=None
     vars(args_object)['save_weights']=None
     vars(args_object)['w1']=None
     vars(args_object)['w0']=None
@@ -50,10 +52,24 @@ def args_object_from_args_dict(args_dict):
     vars(args_object)['shuffle_epoch_start']=True
     vars(args_object)['shuffle_epoch_end']=True
     vars(args_object)['revcomp']=False
+    vars(args_object)['upsample_cache_dir']=None
+    vars(args_object)['onehot_dtype']='float32'
+    vars(args_object)['vals_dtype']='float32'
+    vars(args_object)['reject_ambig_nonupsampled']=False
     
     #prediction
     vars(args_object)['predict_chroms']=None
     vars(args_object)['prediction_pickle']=None
+    vars(args_object)['output_format']='table'
+    vars(args_object)['writer_queue_size']=16
+    vars(args_object)['output_tracks_prefix']=None
+    vars(args_object)['track_format']='bigwig'
+    vars(args_object)['tile_length']=None
+    vars(args_object)['tile_overlap']=0
+    vars(args_object)['bed_regions']=None
+    vars(args_object)['skip_ambig']=False
+    vars(args_object)['num_shards']=1
+    vars(args_object)['shard_index']=0
     vars(args_object)['performance_metrics_classification_file']=None
     vars(args_object)['performance_metrics_regression_file']=None
     vars(args_object)['predictions_pickle_to_load']=None
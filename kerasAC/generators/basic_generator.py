@@ -5,6 +5,8 @@ import random
 import math
 import pysam
 from ..util import *
+from ..ref_cache import *
+from ..label_store import *
 import threading
 import pickle
 import pdb
@@ -14,23 +16,82 @@ def get_weights(data):
     w0=[float(data.shape[0])/sum(data.iloc[:,i]==0) for i in range(data.shape[1])]
     return w1,w0
 
-def open_data_file(data_path=None,tasks=None,chroms_to_use=None):
-    print("running open_data_file with tasks:"+str(tasks))
+def get_chunk_chroms(chunk):
+    #chromosome of each row of a label chunk, from the CHR index level or the first column 
+    if 'CHR' in chunk.index.names:
+        return chunk.index.get_level_values('CHR')
+    return chunk.iloc[:,0]
+
+def get_threshold_rows(vals,upsample_thresh_list):
+    '''
+    row ids of the upsampling groups of DataGenerator.get_upsampled_indices: group i holds the rows with any value >= upsample_thresh_list[i] 
+    and all values < upsample_thresh_list[i+1]; the last group has no upper bound 
+    '''
+    rows=[]
+    for ind in range(len(upsample_thresh_list)):
+        mask=(vals>=upsample_thresh_list[ind]).any(axis=1)
+        if ind<len(upsample_thresh_list)-1:
+            mask&=(vals<upsample_thresh_list[ind+1]).all(axis=1)
+        rows.append(np.flatnonzero(mask))
+    return rows
+
+def read_data_file_chunks(data_path,tasks=None,chunksize=1000000):
+    '''
+    yield DataFrame chunks of an hdf5 or tab-separated BED label file, reading only the coordinate and task columns 
+    '''
     if data_path.endswith('.hdf5'):
-        if tasks==None:
-            data=pd.read_hdf(data_path)
+        columns=None if tasks is None else ['CHR','START','END']+tasks
+        #chunked reads need the hdf5 file to be in table format; the format is checked up front, so a failed chunk is never re-read 
+        with pd.HDFStore(data_path,'r') as store:
+            keys=store.keys()
+            is_table=(len(keys)==1) and store.get_storer(keys[0]).is_table
+        if is_table:
+            for chunk in pd.read_hdf(data_path,columns=columns,chunksize=chunksize):
+                yield chunk
         else:
-            data=pd.read_hdf(data_path,columns=['CHR','START','END']+tasks)
+            print("warning! "+data_path+" is not in hdf5 table format, reading it in one piece")
+            yield pd.read_hdf(data_path,columns=columns)
     else:
-        #treat as bed file
-        if tasks==None:
-            data=pd.read_csv(data_path,header=0,sep='\t')
-        else:
-            data=pd.read_csv(data_path,header=0,sep='\t',nrows=1)
-            chrom_col=data.columns[0]
-            start_col=data.columns[1]
-            end_col=data.columns[2]
-            data=pd.read_csv(data_path,header=0,sep='\t',usecols=[chrom_col,start_col,end_col]+tasks)
+        #treat as bed file; the header gives the coordinate column names. chromosome names are read as strings so they agree
+        #across chunks; the task column dtypes are inferred as in a single read 
+        header=pd.read_csv(data_path,header=0,sep='\t',nrows=0).columns
+        usecols=None if tasks is None else list(header[0:3])+tasks
+        for chunk in pd.read_csv(data_path,header=0,sep='\t',usecols=usecols,chunksize=chunksize,dtype={header[0]:str}):
+            yield chunk
+
+def open_data_file(data_path=None,tasks=None,chroms_to_use=None,upsample_thresh_list=None,chunksize=1000000):
+    '''
+    the file is streamed in chunks of chunksize rows; rows of other chromosomes are dropped as each chunk is read, so peak memory 
+    follows the retained rows rather than the size of the file 
+    upsample_thresh_list -- if given, the upsampling groups (see get_threshold_rows) are built chunk by chunk, and (data, group row ids) is returned 
+    '''
+    print("running open_data_file with tasks:"+str(tasks))
+    if is_label_store(data_path):
+        #memory-mapped columnar labels (see kerasAC_label_store); chromosome filtering selects row ranges 
+        data=LabelStore(data_path,tasks=tasks,chroms_to_use=chroms_to_use)
+        print("opened label store, data.shape:"+str(data.shape))
+        if upsample_thresh_list is not None:
+            return data,None
+        return data
+    chunks=[]
+    threshold_rows=[[] for i in upsample_thresh_list] if upsample_thresh_list is not None else None
+    num_rows=0
+    for chunk in read_data_file_chunks(data_path,tasks=tasks,chunksize=chunksize):
+        if chroms_to_use!=None:
+            chunk=chunk[np.in1d(np.asarray(get_chunk_chroms(chunk)).astype(str),chroms_to_use)]
+        if (chunk.shape[0]==0) and (len(chunks)>0):
+            continue
+        if threshold_rows is not None:
+            if 'CHR' in chunk.index.names:
+                vals=chunk.values
+            else:
+                vals=chunk.iloc[:,3:].values
+            for ind,rows in enumerate(get_threshold_rows(vals,upsample_thresh_list)):
+                threshold_rows[ind].append(num_rows+rows)
+        num_rows+=chunk.shape[0]
+        chunks.append(chunk)
+    data=pd.concat(chunks) if len(chunks)>1 else chunks[0]
+    del chunks
     print("loaded labels")
     print(data.head())
     try:
@@ -38,10 +99,10 @@ def open_data_file(data_path=None,tasks=None,chroms_to_use=None):
         print('set index to CHR, START, END')
     except:
         pass
-    if chroms_to_use!=None:
-        data=data[np.in1d(data.index.get_level_values(0), chroms_to_use)]
     print("filtered on chroms_to_use")
     print("data.shape:"+str(data.shape), data.columns)
+    if threshold_rows is not None:
+        return data,[np.concatenate(i) for i in threshold_rows]
     return data
 
 
@@ -65,7 +126,17 @@ class DataGenerator(Sequence):
                  upsample_thresh_list=None,
                  upsample_ratio_list=None,
                  shuffle=True,
-                 return_coords=False):
+                 return_coords=False,
+                 ref_cache_dir=None,
+                 onehot_dtype='float32',
+                 vals_dtype='float32',
+                 positional_gathers=False):
+        '''
+        positional_gathers -- align all input/output tables to the rows of the index file once at startup and keep them as contiguous arrays,
+        so batches are integer gathers of index row ids rather than pandas MultiIndex .loc lookups. 
+        startup then fails on duplicate coordinates or index rows missing from a table, rather than the batches that hit them. 
+        always on for label stores, which are only read positionally 
+        '''
         self.lock = threading.Lock()
         self.return_coords=return_coords
         self.expand_dims=expand_dims
@@ -73,6 +144,8 @@ class DataGenerator(Sequence):
         self.batch_size=batch_size
         self.ref_fasta=ref_fasta
         self.chroms_to_use=chroms_to_use
+        self.onehot_dtype=np.dtype(onehot_dtype)
+        self.vals_dtype=np.dtype(vals_dtype)
         
         #decide if reverse complement should be used
         self.add_revcomp=add_revcomp
@@ -99,9 +172,22 @@ class DataGenerator(Sequence):
         self.output_path=output_path
         self.num_inputs=num_inputs
         self.num_outputs=num_outputs
+        #the upsampling groups of the index file are built while it is read 
+        self.upsample_thresh_list=upsample_thresh_list
         self.file_to_pd=self.get_file_to_pd()        
+        #read the reference once into a shared memory-mapped cache rather than opening the fasta for every batch
+        if ("seq" in list(self.input_path)+list(self.output_path)) and (self.ref_fasta is not None):
+            self.ref=ReferenceCache(self.ref_fasta,chroms=self.chroms_to_use,cache_dir=ref_cache_dir)
+        else:
+            self.ref=None
         self.indices=self.file_to_pd[self.index_path]
         self.num_indices=self.indices.shape[0]
+        self.positional_gathers=positional_gathers
+        if any([isinstance(i,LabelStore) for i in self.file_to_pd.values()]) and (self.positional_gathers==False):
+            print("label stores are only read with positional_gathers=True, enabling it")
+            self.positional_gathers=True
+        if self.positional_gathers==True:
+            self.align_files_to_index()
         print("indices:"+str(self.indices.head()))
         print("num_indices:"+str(self.num_indices))
         #handle task-specific weights -- this is a bit outdated and may be removed in the future. 
@@ -112,7 +198,6 @@ class DataGenerator(Sequence):
             self.w0=w0
             
         #set variables needed for upsampling the positives
-        self.upsample_thresh_list=upsample_thresh_list
         self.upsample_ratio_list=upsample_ratio_list
         #generate the upsampled threshold index subgroups
         print("creating upsampling logic for generator")
@@ -120,7 +205,10 @@ class DataGenerator(Sequence):
         if self.upsample_thresh_list is not None:
             self.get_upsampled_indices()
         else:
-            self.indices=self.indices.index.tolist() 
+            if self.positional_gathers==True:
+                self.indices=np.arange(self.num_indices)
+            else:
+                self.indices=self.indices.index.tolist() 
             if self.shuffle == True:
                 np.random.shuffle(self.indices)
         print("generator initialized")
@@ -134,9 +222,14 @@ class DataGenerator(Sequence):
         print(self.index_path)
         print(self.tasks)
         if self.tasks[0] is not None:
-            file_to_df[self.index_path]=open_data_file(data_path=self.index_path,tasks=[ti[0] for ti in self.tasks if ti is not None],chroms_to_use=self.chroms_to_use)
+            index_tasks=[ti[0] for ti in self.tasks if ti is not None]
+        else:
+            index_tasks=self.index_tasks
+        if self.upsample_thresh_list is not None:
+            file_to_df[self.index_path],self.index_threshold_rows=open_data_file(data_path=self.index_path,tasks=index_tasks,chroms_to_use=self.chroms_to_use,upsample_thresh_list=self.upsample_thresh_list)
         else:
-            file_to_df[self.index_path]=open_data_file(data_path=self.index_path,tasks=self.index_tasks,chroms_to_use=self.chroms_to_use)
+            file_to_df[self.index_path]=open_data_file(data_path=self.index_path,tasks=index_tasks,chroms_to_use=self.chroms_to_use)
+            self.index_threshold_rows=None
         print("got index_path df") 
         for i in range(self.num_inputs):
             cur_input=self.input_path[i]
@@ -155,6 +248,56 @@ class DataGenerator(Sequence):
                 continue
             file_to_df[cur_output]=open_data_file(data_path=cur_output,tasks=self.tasks[i],chroms_to_use=self.chroms_to_use)
         return file_to_df
+
+    def align_files_to_index(self):
+        '''
+        store each input/output table as a contiguous vals_dtype array whose rows line up with the rows of the index file,
+        along with the CHR/START/END arrays of the index used to decode row ids to coordinates;
+        label stores stay memory-mapped; they are only re-indexed when their rows differ from those of the index file 
+        '''
+        if isinstance(self.indices,LabelStore):
+            self.index_chroms,self.index_starts,self.index_ends=self.indices.get_coords()
+            index=None
+        else:
+            index=self.indices.index
+            self.index_chroms=np.asarray(index.get_level_values(0)).astype(str)
+            self.index_starts=np.asarray(index.get_level_values(1),dtype=np.int64)
+            self.index_ends=np.asarray(index.get_level_values(2),dtype=np.int64)
+        self.file_to_array={}
+        for path,data in self.file_to_pd.items():
+            if isinstance(data,LabelStore):
+                if (path==self.index_path) or self.has_index_rows(data):
+                    data=data.select(None)
+                else:
+                    data=data.select(self.get_index_rows(data.get_index(),path))
+                data.dtype=self.vals_dtype
+                self.file_to_array[path]=data
+                continue
+            if (index is not None) and data.index.equals(index):
+                self.file_to_array[path]=np.ascontiguousarray(data.values,dtype=self.vals_dtype)
+                continue
+            rows=self.get_index_rows(data.index,path)
+            self.file_to_array[path]=np.ascontiguousarray(data.values[rows],dtype=self.vals_dtype)
+        #only the index table is needed from here on, for the upsampling thresholds 
+        self.file_to_pd={self.index_path:self.indices}
+        print("aligned "+str(len(self.file_to_array))+" tables to the index rows")
+
+    def has_index_rows(self,data):
+        #label stores of the same chromosomes hold the rows in the same order as the index 
+        if data.shape[0]!=self.num_indices:
+            return False
+        chroms,starts,ends=data.get_coords()
+        return np.array_equal(starts,self.index_starts) and np.array_equal(ends,self.index_ends) and np.array_equal(chroms,self.index_chroms)
+
+    def get_index_rows(self,table_index,path):
+        #row of table_index matching each row of the index file 
+        if not table_index.is_unique:
+            raise Exception("duplicate CHR/START/END entries in "+str(path)+", use positional_gathers=False")
+        index=pd.MultiIndex.from_arrays([self.index_chroms,self.index_starts,self.index_ends])
+        rows=table_index.get_indexer(index)
+        if (rows<0).any():
+            raise KeyError(str(int((rows<0).sum()))+" coordinates of the index file are missing from "+str(path))
+        return rows
             
     def get_upsampled_indices(self):
         '''
@@ -185,7 +328,7 @@ class DataGenerator(Sequence):
             self.batch_sizes.append(sub_batch_size)
 
             #get the coordinates where all values fall in the range [lower_thresh_bound, upper_thresh_bound)
-            sub_batch_coords=self.indices.loc[(self.indices>=lower_thresh_bound).any(axis=1) & (self.indices < upper_thresh_bound).all(axis=1)].index
+            sub_batch_coords=self.get_threshold_subset(ind,lower_thresh_bound,upper_thresh_bound)
             len_sub_batch_coords=len(sub_batch_coords)
             self.upsampled_coord_indices[ind]=sub_batch_coords
             self.upsampled_numerical_indices[ind] = np.arange(len_sub_batch_coords)
@@ -202,7 +345,7 @@ class DataGenerator(Sequence):
         lower_thresh_bound=self.upsample_thresh_list[ind]
         sub_batch_size=int(self.batch_size-sum(self.batch_sizes))
         self.batch_sizes.append(sub_batch_size)
-        sub_batch_coords=self.indices.loc[(self.indices>=lower_thresh_bound).any(axis=1)].index
+        sub_batch_coords=self.get_threshold_subset(ind,lower_thresh_bound)
         len_sub_batch_coords=len(sub_batch_coords)
         self.upsampled_coord_indices[ind]=sub_batch_coords
         self.upsampled_numerical_indices[ind] = np.arange(len_sub_batch_coords)        
@@ -216,51 +359,83 @@ class DataGenerator(Sequence):
         return
             
         
+    def get_threshold_mask(self,lower_thresh_bound,upper_thresh_bound=None):
+        #boolean mask of the index rows with any value >= lower_thresh_bound and, if given, all values < upper_thresh_bound 
+        if isinstance(self.indices,LabelStore):
+            return self.indices.threshold_mask(lower_thresh_bound,upper_thresh_bound)
+        mask=(self.indices>=lower_thresh_bound).any(axis=1)
+        if upper_thresh_bound is not None:
+            mask&=(self.indices < upper_thresh_bound).all(axis=1)
+        return mask.values
+
+    def get_threshold_subset(self,ind,lower_thresh_bound,upper_thresh_bound=None):
+        #index rows of upsampling group ind, reusing the groups built while the index file was read if available 
+        if self.index_threshold_rows is not None:
+            rows=self.index_threshold_rows[ind]
+            if self.positional_gathers==True:
+                return rows
+            return self.indices.index[rows]
+        return self.get_index_subset(self.get_threshold_mask(lower_thresh_bound,upper_thresh_bound))
+
+    def get_index_subset(self,mask):
+        #index row ids (positional_gathers) or CHR/START/END MultiIndex of the index rows selected by a boolean mask 
+        if self.positional_gathers==True:
+            return np.flatnonzero(mask)
+        return self.indices.loc[mask].index
+        
     def __len__(self):
         return math.ceil(self.num_indices/self.batch_size)
 
     def get_coords(self,idx):
+        '''
+        returns an array of index row ids if positional_gathers is set, otherwise a list of (CHR, START, END) tuples 
+        '''
         if self.upsample_thresh_list is not None:
             all_bed_entries=[]
             for ind,val in enumerate(self.batch_sizes):
                 batch_indices = self.upsampled_numerical_indices[ind][idx*val:(idx+1)*val]
-                bed_entries = self.upsampled_coord_indices[ind][batch_indices].tolist()
-                all_bed_entries+=bed_entries
+                bed_entries = self.upsampled_coord_indices[ind][batch_indices]
+                all_bed_entries.append(bed_entries)
+            if self.positional_gathers==True:
+                return np.concatenate(all_bed_entries)
+            return sum([i.tolist() for i in all_bed_entries],[])
         else:
             all_bed_entries=self.indices[idx*self.batch_size:(idx+1)*self.batch_size]
         return all_bed_entries
+
+    def decode_coords(self,coords):
+        #list of (CHR, START, END) tuples for the index row ids of a batch 
+        if self.positional_gathers==False:
+            return coords
+        return list(zip(self.index_chroms[coords].tolist(),self.index_starts[coords].tolist(),self.index_ends[coords].tolist()))
     
     def get_seq(self,coords):
-        seqs=[self.ref.fetch(i[0],i[1],i[2]) for i in coords]
-        return seqs
+        if self.positional_gathers==True:
+            return self.ref.fetch_regions(self.index_chroms[coords],self.index_starts[coords],self.index_ends[coords])
+        return self.ref.fetch_regions([i[0] for i in coords],[i[1] for i in coords],[i[2] for i in coords])
         
     def get_pd_vals(self,coords,io_index):
-        return self.file_to_pd[io_index].loc[coords].values
+        if self.positional_gathers==True:
+            return self.file_to_array[io_index][coords]
+        return self.file_to_pd[io_index].loc[coords].values.astype(self.vals_dtype,copy=False)
     
     def transform_seq(self,seqs):
-        if self.add_revcomp==True:
-            #add in the reverse-complemented sequences for training.
-            seqs_rc=[revcomp(s) for s in seqs]
-            seqs=seqs+seqs_rc
+        #one-hot encode, adding in the reverse-complemented sequences for training in the same pass if specified
+        onehot=one_hot_encode(seqs,dtype=self.onehot_dtype,add_revcomp=self.add_revcomp)
         if self.shuffled_ref_negatives is True:
-            #generate the corresponding negative set by dinucleotide-shuffling the sequences
-            seqs_shuffled=[dinuc_shuffle(s) for s in seqs]
-            seqs=seqs+seqs_shuffled
-        return seqs
+            #generate the corresponding negative set by dinucleotide-shuffling the (forward and reverse complemented) sequences
+            onehot=np.concatenate((onehot,dinuc_shuffle(onehot)[:,0]),axis=0)
+        return onehot
     
     
     def transform_vals(self,vals):
         if self.add_revcomp==True:
-            vals=np.concatenate((vals,vals),axis=0)
+            vals=add_revcomp_vals(vals,flip_axes=(1,) if vals.ndim==3 else ())
         if self.shuffled_ref_negatives is True: 
-            val_shape=vals.shape
-            vals=np.concatenate((vals,np.zeros(vals_shape)))
+            vals=np.concatenate((vals,np.zeros(vals.shape,dtype=vals.dtype)))
         return vals
         
     def __getitem__(self,idx):
-        with self.lock:
-            ref=pysam.FastaFile(self.ref_fasta)
-            self.ref=ref
         #get the coordinates for the current batch
         coords=self.get_coords(idx)
         #get the inputs
@@ -268,7 +443,7 @@ class DataGenerator(Sequence):
         for cur_input_index in range(self.num_inputs):
             cur_input=self.input_path[cur_input_index]
             if cur_input=="seq":
-                cur_x=one_hot_encode(self.transform_seq(self.get_seq(coords)))
+                cur_x=self.transform_seq(self.get_seq(coords))
                 if self.expand_dims==True:
                     cur_x=np.expand_dims(cur_x,axis=1)
             else:
@@ -280,7 +455,7 @@ class DataGenerator(Sequence):
         for cur_output_index in range(self.num_outputs):
             cur_output=self.output_path[cur_output_index] 
             if cur_output=="seq":
-                cur_y=one_hot_encode(self.transform_seq(self.get_seq(coords)))
+                cur_y=self.transform_seq(self.get_seq(coords))
                 if self.expand_dims==True:
                     cur_y=np.expand_dims(cur_y,axis=1)
             else:
@@ -290,7 +465,7 @@ class DataGenerator(Sequence):
         if self.return_coords is False: 
             return (X,y)
         else:
-            return (X,y,coords)
+            return (X,y,self.decode_coords(coords))
         
 
 
@@ -0,0 +1,241 @@
+#shared-memory batch prefetching for the training generators.
+#persistent worker processes (forked, so the generator, its open arrays and reference memory-maps are inherited rather than pickled)
+#build batches and write them straight into a ring of preallocated shared-memory slots;
+#the training loop receives zero-copy numpy views of the slots, so batch arrays are never pickled through a queue.
+from keras.utils import Sequence
+import multiprocessing as mp
+import pickle
+import queue
+import random
+import signal
+import traceback
+import numpy as np
+
+class ArrayLeaf(object):
+    #placeholder for the i'th numpy array of a flattened batch
+    def __init__(self,index):
+        self.index=index
+
+def contains_array(obj):
+    if isinstance(obj,np.ndarray):
+        return obj.ndim>0
+    if isinstance(obj,(list,tuple)):
+        return any([contains_array(i) for i in obj])
+    return False
+
+def flatten_batch(batch):
+    '''
+    split a batch (nested lists/tuples, i.e. (X,y) or (X,y,coords)) into its numpy arrays and a picklable template of the structure.
+    anything that isn't an array, or a list/tuple containing arrays, is kept in the template as-is
+    '''
+    arrays=[]
+    def get_template(obj):
+        if isinstance(obj,np.ndarray) and obj.ndim>0:
+            arrays.append(obj)
+            return ArrayLeaf(len(arrays)-1)
+        if isinstance(obj,(list,tuple)) and contains_array(obj):
+            return type(obj)([get_template(i) for i in obj])
+        return obj
+    return get_template(batch),arrays
+
+def unflatten_batch(template,arrays):
+    if isinstance(template,ArrayLeaf):
+        return arrays[template.index]
+    if isinstance(template,(list,tuple)):
+        return type(template)([unflatten_batch(i,arrays) for i in template])
+    return template
+
+def seed_random_state(*keys):
+    #seed numpy and python random number generators from a tuple of keys, i.e. (seed, epoch, batch index)
+    cur_seed=int(np.random.SeedSequence([int(i) for i in keys]).generate_state(1)[0])
+    np.random.seed(cur_seed)
+    random.seed(cur_seed)
+
+def get_slot_views(slot_buffers,array_specs,max_rows):
+    #numpy views of the raw shared-memory buffers of one slot
+    return [np.frombuffer(slot_buffers[i],dtype=array_specs[i][0],count=max_rows*int(np.prod(array_specs[i][1]))).reshape((max_rows,)+array_specs[i][1]) for i in range(len(array_specs))]
+
+def prefetch_worker(generator,shared_buffers,array_specs,max_rows,task_queue,result_queue,seed):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(generator,'reopen_tdb_arrays'):
+        generator.reopen_tdb_arrays()
+    slot_views=[get_slot_views(slot_buffers,array_specs,max_rows) for slot_buffers in shared_buffers]
+    cur_epoch=0
+    while True:
+        task=task_queue.get()
+        if task is None:
+            break
+        slot,idx,epoch=task
+        try:
+            #all workers see the same epoch-end shuffles, as each one re-seeds before calling on_epoch_end
+            while cur_epoch<epoch:
+                cur_epoch+=1
+                seed_random_state(seed,cur_epoch)
+                generator.on_epoch_end()
+            seed_random_state(seed,epoch,idx)
+            template,arrays=flatten_batch(generator[idx])
+            fits=(len(arrays)==len(array_specs))
+            if fits:
+                for i in range(len(arrays)):
+                    if (arrays[i].dtype!=array_specs[i][0]) or (arrays[i].shape[1:]!=array_specs[i][1]) or (arrays[i].shape[0]>max_rows):
+                        fits=False
+                        break
+            if fits:
+                for i in range(len(arrays)):
+                    slot_views[slot][i][0:arrays[i].shape[0]]=arrays[i]
+                result=(slot,idx,epoch,template,[i.shape[0] for i in arrays],None,None)
+            else:
+                #batch doesn't match the slot layout, send it through the queue instead
+                result=(slot,idx,epoch,template,None,arrays,None)
+            #pickle here rather than in the queue's feeder thread, so an unpicklable batch is reported instead of silently dropped
+            result=pickle.dumps(result,protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            result=pickle.dumps((slot,idx,epoch,None,None,None,traceback.format_exc()),protocol=pickle.HIGHEST_PROTOCOL)
+        result_queue.put(result)
+
+
+class SharedMemoryPrefetcher(Sequence):
+    def __init__(self,generator,prefetch_depth,num_workers=1,seed=1234,max_rows=None,timeout=10):
+        '''
+        generator -- TiledbGenerator/DataGenerator (or any keras Sequence) to prefetch batches from
+        prefetch_depth -- how many batches are built ahead of the training loop; prefetch_depth+1 shared-memory slots are allocated,
+        as the batch last returned by __getitem__ holds its slot until the next call
+        num_workers -- number of worker processes; at most prefetch_depth of them can be busy, so it is capped at prefetch_depth
+        max_rows -- row capacity of each slot; defaults to the number of rows in the first batch.
+        Batches that don't fit the slot layout are sent through the result queue instead.
+
+        The arrays returned by __getitem__ are views into a slot, and are only valid until the next call to __getitem__.
+        Use with fit_generator(...,workers=0), and call close() when done.
+        '''
+        if prefetch_depth<1:
+            raise Exception("prefetch_depth must be >= 1; you provided:"+str(prefetch_depth))
+        self.generator=generator
+        self.prefetch_depth=prefetch_depth
+        self.num_workers=max(1,num_workers)
+        if self.num_workers>prefetch_depth:
+            print("WARNING: only "+str(prefetch_depth)+" batches are prefetched at a time, using "+str(prefetch_depth)+" of the "+str(self.num_workers)+" requested prefetch workers")
+            self.num_workers=prefetch_depth
+        self.seed=seed
+        self.timeout=timeout
+        self.num_batches=len(generator)
+        self.epoch=0
+
+        #probe the first batch for the shapes and dtypes of the slot arrays
+        probe_template,probe_arrays=flatten_batch(generator[0])
+        self.array_specs=[(i.dtype,i.shape[1:]) for i in probe_arrays]
+        if max_rows is None:
+            max_rows=max([i.shape[0] for i in probe_arrays])
+        self.max_rows=max_rows
+        #one slot per prefetched batch, plus the slot held by the batch last returned to the caller
+        num_slots=prefetch_depth+1
+        self.shared_buffers=[[mp.RawArray('b',max(1,max_rows*int(np.prod(shape))*dtype.itemsize)) for dtype,shape in self.array_specs] for slot in range(num_slots)]
+        self.slot_views=[get_slot_views(slot_buffers,self.array_specs,max_rows) for slot_buffers in self.shared_buffers]
+        print("allocated "+str(num_slots)+" shared-memory batch slots of "+str(sum([i.nbytes for i in self.slot_views[0]])/2**20)+" MB each")
+
+        ctx=mp.get_context('fork')
+        self.task_queue=ctx.Queue()
+        self.result_queue=ctx.Queue()
+        self.workers=[]
+        for worker_index in range(self.num_workers):
+            worker=ctx.Process(target=prefetch_worker,args=(generator,self.shared_buffers,self.array_specs,max_rows,self.task_queue,self.result_queue,seed))
+            worker.daemon=True
+            worker.start()
+            self.workers.append(worker)
+        self.free_slots=list(range(num_slots))
+        self.submitted={}
+        self.ready={}
+        self.held_slot=None
+
+    def __len__(self):
+        return self.num_batches
+
+    def submit(self,idx):
+        slot=self.free_slots.pop()
+        self.submitted[(self.epoch,idx)]=slot
+        self.task_queue.put((slot,idx,self.epoch))
+
+    def schedule(self,idx):
+        #keep the next prefetch_depth batches of the current epoch in flight; the next epoch's batches are only
+        #submitted after on_epoch_end, so they are built from the reshuffled state
+        for offset in range(self.prefetch_depth):
+            cur_idx=idx+offset
+            if (len(self.free_slots)==0) or (cur_idx>=self.num_batches):
+                break
+            key=(self.epoch,cur_idx)
+            if (key not in self.submitted) and (key not in self.ready):
+                self.submit(cur_idx)
+
+    def receive(self):
+        while True:
+            try:
+                result=self.result_queue.get(timeout=self.timeout)
+                break
+            except queue.Empty:
+                if not all([i.is_alive() for i in self.workers]):
+                    raise Exception("a prefetch worker process exited unexpectedly")
+        slot,idx,epoch,template,rows,arrays,error=pickle.loads(result)
+        del self.submitted[(epoch,idx)]
+        if error is not None:
+            self.free_slots.append(slot)
+            raise Exception("prefetch worker failed on batch "+str(idx)+":\n"+error)
+        if epoch!=self.epoch:
+            #built before the last on_epoch_end, drop it
+            self.free_slots.append(slot)
+            return
+        self.ready[(epoch,idx)]=(slot,template,rows,arrays)
+
+    def drain(self):
+        #wait out any in-flight batches and drop prefetched batches, i.e. when batches are requested out of order
+        while len(self.submitted)>0:
+            self.receive()
+        for key in self.ready:
+            self.free_slots.append(self.ready[key][0])
+        self.ready={}
+
+    def __getitem__(self,idx):
+        #the previously returned batch is no longer in use
+        if self.held_slot is not None:
+            self.free_slots.append(self.held_slot)
+            self.held_slot=None
+        key=(self.epoch,idx)
+        if (key not in self.submitted) and (key not in self.ready):
+            self.drain()
+        self.schedule(idx)
+        while key not in self.ready:
+            self.receive()
+        slot,template,rows,arrays=self.ready.pop(key)
+        if arrays is None:
+            arrays=[self.slot_views[slot][i][0:rows[i]] for i in range(len(rows))]
+            self.held_slot=slot
+        else:
+            self.free_slots.append(slot)
+        #top up the ring now that this batch's slot is accounted for
+        self.schedule(idx+1)
+        return unflatten_batch(template,arrays)
+
+    def on_epoch_end(self):
+        #batches submitted from here on are built after the workers' own on_epoch_end call;
+        #prefetched batches of the old epoch are discarded, and in-flight ones are dropped as they arrive
+        self.epoch+=1
+        for key in self.ready:
+            self.free_slots.append(self.ready[key][0])
+        self.ready={}
+
+    def close(self):
+        for worker in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=self.timeout)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers=[]
+
+    def cancel(self):
+        #stop the workers immediately, dropping any in-flight batches, i.e. on ctrl-c or when the consumer fails
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in self.workers:
+            worker.join(timeout=self.timeout)
+        self.task_queue.cancel_join_thread()
+        self.workers=[]
@@ -5,6 +5,7 @@ import random
 import math
 import pysam
 from ..util import *
+from ..ref_cache import *
 import threading
 import pickle
 import pdb
@@ -21,76 +22,84 @@ class SNPGenerator(Sequence):
                  rsid_col=None,
                  compute_gc=False,
                  batch_size=1000,
-                 expand_dims=True):
+                 expand_dims=True,
+                 ref_cache_dir=None,
+                 onehot_dtype='float32',
+                 alt_allele_col=None,
+                 bed=None,
+                 ref=None):
+        '''
+        each variant is centered in the window [pos-flank_size, pos+flank_size), with its allele written at offset flank_size; 
+        window positions past the chromosome ends are N 
+        alt_allele_col -- if given, each batch holds the windows with the allele_col and the alt_allele_col alleles, encoded from a single reference fetch:
+        [rsids, ref_X, alt_X] rather than [rsids, X], where X is seqs, or [seqs, gc] with compute_gc 
+        bed -- DataFrame of variants (i.e. one chunk of bed_path) used instead of reading all of bed_path 
+        ref -- ReferenceCache to share between generators, i.e. those of the chunks of one file 
+        '''
         self.bed_path=bed_path
-        self.bed=pd.read_csv(self.bed_path,header=0,sep='\t')
+        if bed is None:
+            bed=pd.read_csv(self.bed_path,header=0,sep='\t')
+        self.bed=bed
         self.num_snps=self.bed.shape[0]
         self.chrom_col=chrom_col
         self.pos_col=pos_col
         self.allele_col=allele_col
+        self.alt_allele_col=alt_allele_col
         self.flank_size=flank_size
         self.rsid_col=rsid_col
         self.compute_gc=compute_gc
         self.batch_size=batch_size
         self.ref_fasta=ref_fasta
-        self.batch_size=batch_size
-        self.ref_fasta=ref_fasta
-        self.batch_size=batch_size
         self.lock=threading.Lock()
         self.expand_dims=expand_dims
+        self.onehot_dtype=np.dtype(onehot_dtype)
+        #columnar variant table: chromosome names, positions, allele base codes and ids 
+        self.chroms=self.bed[self.chrom_col].astype(str).values
+        self.positions=self.bed[self.pos_col].values.astype(np.int64)
+        self.allele_codes=self.get_allele_codes(self.allele_col)
+        if self.alt_allele_col is not None:
+            self.alt_allele_codes=self.get_allele_codes(self.alt_allele_col)
+        if self.rsid_col is not None:
+            self.rsids=self.bed[self.rsid_col].values
+        else:
+            self.rsids=self.bed.index.values
+        #read the chromosomes harboring variants once into a shared memory-mapped cache
+        if ref is None:
+            ref=ReferenceCache(self.ref_fasta,chroms=[str(i) for i in self.bed[self.chrom_col].unique()],cache_dir=ref_cache_dir)
+        self.ref=ref
 
+    def get_allele_codes(self,allele_col):
+        #base code of the first base of each allele 
+        alleles=self.bed[allele_col].astype(str).str[0].values
+        return base_code_lookup[seqs_to_bytes(list(alleles))[:,0]]
 
-    def __getitem__(self,idx):
-        with self.lock:
-            self.ref=pysam.FastaFile(self.ref_fasta)
-        cur_entries=self.bed.iloc[idx*self.batch_size:min([self.num_snps,(idx+1)*self.batch_size])]
-        seqs=[]
-        gc=[]
-        rsids=[]
-        for index,entry in cur_entries.iterrows():
-            cur_chrom=entry[self.chrom_col]
-            cur_pos=entry[self.pos_col]
-            left_flank_start=max([0,cur_pos-self.flank_size])
-            left_flank_end=cur_pos
-            snp_allele=entry[self.allele_col]
-            try:
-                if len(snp_allele)>1:
-                    snp_allele=snp_allele[0]
-            except:
-                print(entry)
-                raise Exception() 
-            right_flank_start=cur_pos+1
-            right_flank_end=cur_pos+self.flank_size
-            left_flank=self.ref.fetch(cur_chrom,left_flank_start,left_flank_end)
-            right_flank=self.ref.fetch(cur_chrom,right_flank_start,right_flank_end)
-            cur_seq=left_flank+snp_allele+right_flank
-            
-            assert(len(cur_seq)==2*self.flank_size)
-            seqs.append(cur_seq)
-            if self.compute_gc==True:
-                cur_gc=self.compute_gc_func(cur_seq)
-                gc.append(cur_gc)
-            if self.rsid_col is not None:
-                rsids.append(entry[self.rsid_col])
-            else:
-                rsids.append(index)
-            index+=1 
-        seqs=np.array([[ltrdict.get(x,[0,0,0,0]) for x in seq] for seq in seqs])
+    def write_allele(self,onehot,allele_codes):
+        #overwrite the center position of the one-hot windows with the alleles 
+        onehot[:,self.flank_size,:]=np.eye(AMBIG_CODE+1,NUM_BASES,dtype=onehot.dtype)[allele_codes]
+        return onehot
+
+    def get_batch_inputs(self,onehot):
+        gc=None
+        if self.compute_gc==True:
+            #fraction of C and G bases in each window 
+            gc=np.expand_dims(onehot[:,:,1:3].sum(axis=(1,2),dtype=np.float64)/onehot.shape[1],axis=1)
         if self.expand_dims==True:
-            seqs=np.expand_dims(seqs,axis=1) 
-        if self.compute_gc==False:
-            return [rsid,seqs]
-        else:
-            gc=np.expand_dims(np.asarray(gc),axis=1)
-            return [rsids,[seqs,gc]]
+            onehot=np.expand_dims(onehot,axis=1)
+        if gc is None:
+            return onehot
+        return [onehot,gc]
 
-    def compute_gc_func(self,seq):
-        seq=seq.lower()
-        g_count=seq.count('g')
-        c_count=seq.count('c')
-        seq_len=len(seq)
-        return (g_count+c_count)/seq_len 
+    def __getitem__(self,idx):
+        batch=slice(idx*self.batch_size,min([self.num_snps,(idx+1)*self.batch_size]))
+        rsids=self.rsids[batch].tolist()
+        #one gather for all windows of the batch 
+        windows=self.ref.fetch_windows(self.chroms[batch],self.positions[batch]-self.flank_size,2*self.flank_size)
+        onehot=one_hot_encode(windows,dtype=self.onehot_dtype)
+        if self.alt_allele_col is None:
+            return [rsids,self.get_batch_inputs(self.write_allele(onehot,self.allele_codes[batch]))]
+        alt_onehot=self.write_allele(onehot.copy(),self.alt_allele_codes[batch])
+        ref_onehot=self.write_allele(onehot,self.allele_codes[batch])
+        return [rsids,self.get_batch_inputs(ref_onehot),self.get_batch_inputs(alt_onehot)]
 
     def __len__(self):
         return math.ceil(self.num_snps/self.batch_size)
-
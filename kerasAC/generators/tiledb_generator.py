@@ -16,8 +16,11 @@ from ..tiledb_config import *
 import tiledb
 import pdb
 from ..s3_sync import * 
+from ..ref_cache import *
 from collections import OrderedDict
 import gc
+import json
+import hashlib
 import pdb             
 
 
@@ -28,7 +31,7 @@ def get_upsampled_indices_chrom(inputs):
     tdb_ambig_attribute=inputs[3]
     tdb_partition_attribute_for_upsample=inputs[4]
     task_indices=inputs[5]
-    tdb_partition_thresh_for_upsample=inputs[6]
+    upsample_thresh_list=inputs[6]
     print("starting getting indices to upsample in range:"+str(region_start)+"-"+str(region_end))
     with tiledb.open(tdb_array_name,'r',ctx=tiledb.Ctx(get_default_config())) as tdb_array:
         if tdb_ambig_attribute is not None:
@@ -37,13 +40,62 @@ def get_upsampled_indices_chrom(inputs):
         else:
             attr_vals=tdb_array.query(attrs=[tdb_partition_attribute_for_upsample]).multi_index[region_start:region_end-1,task_indices]        
         upsample_vals=np.sum(attr_vals[tdb_partition_attribute_for_upsample],axis=1)
+    #tier i holds the positions with values in [upsample_thresh_list[i], upsample_thresh_list[i+1]); the last tier is unbounded, -1 is below every threshold 
+    tiers=np.searchsorted(upsample_thresh_list,upsample_vals,side='right')-1
+    #searchsorted places nan past every threshold, so non-finite values are excluded explicitly
+    tiers[~np.isfinite(upsample_vals)]=-1
     if tdb_ambig_attribute is not None:
-        cur_upsampled_indices=region_start+np.argwhere((upsample_vals>=tdb_partition_thresh_for_upsample) & ( ambig_attr_vals==0))
-    else: 
-        cur_upsampled_indices=region_start+np.argwhere(upsample_vals>=tdb_partition_thresh_for_upsample)
+        tiers[ambig_attr_vals!=0]=-1
+    cur_upsampled_indices=[region_start+np.flatnonzero(tiers==tier) for tier in range(len(upsample_thresh_list))]
     print("finished indices to upsample in range:"+str(region_start)+"-"+str(region_end))
     return cur_upsampled_indices
 
+def read_tdb_windows(tdb_array,attribute,window_starts,window_len,column_indices=None):
+    '''
+    read the windows [start, start+window_len) for all entries of a batch with a single multi-range query;
+    overlapping windows are coalesced so each base is read once. 
+    column_indices -- tdb task indices to read; if None, the full second dimension of the array is read 
+    returns an array of shape (num_windows, window_len, num_columns) 
+    '''
+    range_starts,range_ends,window_offsets=coalesce_windows(window_starts,window_len)
+    #multi_index ranges are inclusive of the end coordinate 
+    ranges=[slice(int(range_start),int(range_end)-1) for range_start,range_end in zip(range_starts,range_ends)]
+    if column_indices is None:
+        column_start,column_end=tdb_array.schema.domain.dim(1).domain
+        column_ranges=slice(int(column_start),int(column_end))
+    else:
+        column_ranges=list(column_indices)
+    flat_vals=tdb_array.query(attrs=[attribute]).multi_index[ranges,column_ranges][attribute]
+    flat_vals=flat_vals.reshape((int(np.sum(range_ends-range_starts)),-1))
+    #scatter the concatenated ranges back to one row per window 
+    return flat_vals[window_offsets[:,None]+np.arange(window_len)]
+
+def get_out_of_range_rows(vals,min_val=None,max_val=None):
+    '''
+    boolean mask of the rows (first axis) of vals with any entry below min_val or above max_val 
+    '''
+    flat_vals=vals.reshape((vals.shape[0],-1))
+    out_of_range=np.zeros(vals.shape[0],dtype=bool)
+    if min_val is not None:
+        out_of_range|=(flat_vals<min_val).any(axis=1)
+    if max_val is not None:
+        out_of_range|=(flat_vals>max_val).any(axis=1)
+    return out_of_range
+
+def get_tdb_fragment_timestamps(tdb_array_name,ctx=None):
+    '''
+    sorted list of the [start,end] write timestamps of the array's fragments, used to invalidate caches derived from the array contents.
+    returns None if the installed tiledb-py can't list fragments 
+    '''
+    try:
+        fragments=tiledb.FragmentInfoList(tdb_array_name,ctx=ctx)
+    except AttributeError:
+        return None
+    return sorted([[int(i) for i in fragment.timestamp_range] for fragment in fragments])
+
+def get_default_upsample_cache_dir():
+    return os.path.join(os.path.expanduser('~'),'.cache','kerasAC','upsampled_indices')
+
 def init_worker():
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
@@ -99,13 +151,45 @@ class TiledbGenerator(Sequence):
                  return_coords=False,
                  tdb_config=None,
                  tdb_ctx=None,
+                 tdb_batched_reads=True,
+                 ref_cache_dir=None,
+                 upsample_cache_dir=None,
+                 onehot_dtype='float32',
+                 vals_dtype='float32',
+                 sample_seed=None,
+                 reject_ambig_nonupsampled=False,
+                 upsample_thresh_list=None,
+                 upsample_ratio_list=None,
+                 revcomp_strand_pairs=None,
                  num_threads=1):
         '''
         tdb_partition_attribute_for_upsample -- attribute in tiledb array used for determining which bases to upsample (usu. 'idr_peak') 
         tdb_partition_thresh_for_upsample -- threshold for determinining samples to upsample (generally 1) 
         tdb_input_aggregation/ tdb_output_aggregation -- one of 'average','max','binary_max','sum',None
+        tdb_batched_reads -- read all windows in a batch with one multi-range tiledb query rather than one query per example 
+        ref_cache_dir -- directory for the memory-mapped reference sequence cache, defaults to <ref_fasta>.kerasAC_cache
+        upsample_cache_dir -- directory for the cached upsampled index arrays, defaults to ~/.cache/kerasAC/upsampled_indices; False disables the cache
+        onehot_dtype -- dtype of one-hot encoded sequence batches, i.e. 'uint8','float16','float32'
+        vals_dtype -- dtype of tiledb value batches, i.e. 'float16','float32'; aggregation and transformation are computed in at least float32 
+        sample_seed -- seed for the non-upsampled positions; each batch draws from a generator seeded by (sample_seed, epoch, batch index). 
+        If None, the batch seed is drawn from numpy's global state, which the prefetch workers seed per batch 
+        reject_ambig_nonupsampled -- redraw non-upsampled positions whose input/output windows contain an N in the reference 
+        upsample_thresh_list/upsample_ratio_list -- stratified upsampling; tier i holds the positions with partition attribute values in 
+        [upsample_thresh_list[i], upsample_thresh_list[i+1]), the last tier is unbounded, and upsample_ratio_list[i] is the fraction of each batch drawn from tier i. 
+        i.e. upsample_thresh_list=[0.5,1], upsample_ratio_list=[0.2,0.3] gives 20% of each batch in [0.5,1), 30% >= 1, and 50% random genome positions. 
+        upsample_ratio_list may also follow the DataGenerator convention of len(upsample_thresh_list)-1 ratios, in which case the last tier takes the 
+        rest of the batch and no random positions are drawn, i.e. upsample_thresh_list=[0,1], upsample_ratio_list=[0.7] gives 70% in [0,1) and 30% >= 1. 
+        defaults to the single tier [tdb_partition_thresh_for_upsample] with upsample_ratio 
+        add_revcomp -- append the reverse complement of each entry; per-position input/output/bias tracks are reversed along the position axis 
+        revcomp_strand_pairs -- (plus, minus) pairs of strand-specific tasks, as positions in the selected tasks, whose input/output values are 
+        swapped on the reverse complement strand 
         '''
         self.num_threads=num_threads
+        self.sample_seed=sample_seed
+        #the upsampled index order of each epoch is derived from this seed, so every worker's copy of the generator agrees on it 
+        self.shuffle_seed=sample_seed if sample_seed is not None else int(np.random.randint(2**31))
+        self.reject_ambig_nonupsampled=reject_ambig_nonupsampled
+        self.epoch=0
         self.shuffle_epoch_start=shuffle_epoch_start
         self.shuffle_epoch_end=shuffle_epoch_end
 
@@ -123,6 +207,9 @@ class TiledbGenerator(Sequence):
             self.batch_size=int(math.floor(self.batch_size/2))
             
         self.expand_dims=expand_dims
+        self.onehot_dtype=np.dtype(onehot_dtype)
+        self.vals_dtype=np.dtype(vals_dtype)
+        self.vals_compute_dtype=np.promote_types(self.vals_dtype,np.float32)
 
         #create tiledb configuration parameters (these have been found optimal for most use cases, but should set in a separate config file in the future)
         if tdb_config is not None:
@@ -134,8 +221,10 @@ class TiledbGenerator(Sequence):
         else:
             self.ctx=tiledb.Ctx(self.config)
             
+        self.tdb_batched_reads=tdb_batched_reads
         print("opening:"+tdb_array+" for reading...")
         self.tdb_array_name=tdb_array
+        self.tdb_bias_array_names=tdb_bias_arrays
         self.tdb_array=tiledb.open(tdb_array,mode='r',ctx=self.ctx)
         if tdb_bias_arrays is not None:
             self.bias_arrays=[tiledb.open(tdb_bias_arrays[i],mode='r',ctx=self.ctx) for i in range(len(tdb_bias_arrays))]
@@ -157,7 +246,6 @@ class TiledbGenerator(Sequence):
                 self.chroms_to_use=[i.split()[0] for i in open(chrom_sizes,'r').read().strip().split('\n')]
         #find the tdb indices that correspond to the chroms to be used 
         self.get_chrom_index_ranges(self.chroms_to_use)
-        print("self.weighted_chrom_indices"+str(self.weighted_chrom_indices))
         print("got indices for used chroms")
 
         #get indices of tasks to be used in training
@@ -169,6 +257,15 @@ class TiledbGenerator(Sequence):
             #already got task indices when calling get_chrom_index_ranges function above
             pass 
         print("identified task indices:"+str(self.task_indices))
+        #order of the task columns on the reverse complement strand, with strand-specific task pairs swapped 
+        self.revcomp_task_order=None
+        if revcomp_strand_pairs is not None:
+            self.revcomp_task_order=list(range(len(self.task_indices)))
+            for plus_task,minus_task in revcomp_strand_pairs:
+                if max(plus_task,minus_task)>=len(self.task_indices):
+                    raise Exception("revcomp_strand_pairs must index into the "+str(len(self.task_indices))+" selected tasks; you provided:"+str(revcomp_strand_pairs))
+                self.revcomp_task_order[plus_task]=minus_task
+                self.revcomp_task_order[minus_task]=plus_task
         self.tdb_ambig_attribute=tdb_ambig_attribute
 
         #store input params
@@ -185,22 +282,61 @@ class TiledbGenerator(Sequence):
         self.tdb_output_aggregation=[str(i) for i in tdb_output_aggregation]
         self.tdb_output_transformation=[str(i) for i in tdb_output_transformation]
 
+        #read the used chromosomes of the reference once; batches slice the shared memory-mapped arrays
+        if ("seq" in list(self.tdb_input_source_attribute)+list(self.tdb_output_source_attribute)) or (self.reject_ambig_nonupsampled==True):
+            self.ref=ReferenceCache(self.ref_fasta,chroms=self.chroms_to_use,cache_dir=ref_cache_dir)
+        else:
+            self.ref=None
 
         #identify min/max values
         self.tdb_input_min=transform_data_type(tdb_input_min,self.num_inputs)
         self.tdb_input_max=transform_data_type(tdb_input_max,self.num_inputs)
         self.tdb_output_min=transform_data_type(tdb_output_min,self.num_outputs)
         self.tdb_output_max=transform_data_type(tdb_output_max,self.num_outputs)
+        #non-upsampled positions are rejected if any input/output window around them is ambiguous 
+        self.ambig_flank=max([int(i) for i in list(self.tdb_input_flank)+list(self.tdb_output_flank) if i is not None])
+        self.has_range_bounds=any([i is not None for i in self.tdb_input_min+self.tdb_input_max+self.tdb_output_min+self.tdb_output_max])
                 
         #identify upsampled genome indices for model training
         self.tdb_partition_attribute_for_upsample=tdb_partition_attribute_for_upsample
         self.tdb_partition_thresh_for_upsample=tdb_partition_thresh_for_upsample
+        if upsample_cache_dir is None:
+            upsample_cache_dir=get_default_upsample_cache_dir()
+        self.upsample_cache_dir=upsample_cache_dir
         if upsample_ratio is not None:
             assert type(upsample_ratio)==float
-        self.upsample_ratio=upsample_ratio
+        if upsample_thresh_list is None:
+            upsample_thresh_list=[tdb_partition_thresh_for_upsample]
+        if (upsample_ratio_list is None) and (upsample_ratio is not None):
+            upsample_ratio_list=[upsample_ratio]
+        self.upsample_thresh_list=[float(i) for i in upsample_thresh_list]
+        if self.upsample_thresh_list!=sorted(self.upsample_thresh_list):
+            raise Exception("upsample_thresh_list must be sorted in increasing order; you provided:"+str(self.upsample_thresh_list))
+        if upsample_ratio_list is not None:
+            upsample_ratio_list=[float(i) for i in upsample_ratio_list]
+            if len(upsample_ratio_list)==len(self.upsample_thresh_list)-1:
+                #DataGenerator convention: the last (unbounded) tier takes the rest of the batch
+                upsample_ratio_list=upsample_ratio_list+[1-sum(upsample_ratio_list)]
+            elif len(upsample_ratio_list)!=len(self.upsample_thresh_list):
+                raise Exception("upsample_ratio_list must have one ratio per threshold in upsample_thresh_list ("+str(len(self.upsample_thresh_list))+
+                                ", the rest of the batch is random positions) or one fewer ("+str(len(self.upsample_thresh_list)-1)+
+                                ", the last tier takes the rest of the batch); you provided thresholds:"+str(self.upsample_thresh_list)+" and ratios:"+str(upsample_ratio_list))
+            self.upsample_ratio_list=upsample_ratio_list
+            self.upsample_ratio=sum(self.upsample_ratio_list)
+            if (self.upsample_ratio>1+1e-9) or (min(self.upsample_ratio_list)<0):
+                raise Exception("upsample ratios must be >= 0 and sum to at most 1; you provided:"+str(upsample_ratio_list))
+        else:
+            self.upsample_ratio_list=None
+            self.upsample_ratio=None
         if self.upsample_ratio is not None:
             self.get_upsampled_indices()
-            self.upsampled_batch_size=math.ceil(self.upsample_ratio*self.batch_size)
+            #sizes of the tier sub-batches; rounding up the cumulative ratios keeps the single tier case at ceil(upsample_ratio*batch_size) 
+            cumulative_sizes=np.minimum(np.ceil(np.cumsum(self.upsample_ratio_list)*self.batch_size-1e-9),self.batch_size).astype(np.int64)
+            self.upsampled_tier_batch_sizes=np.diff(cumulative_sizes,prepend=0)
+            self.upsampled_batch_size=int(cumulative_sizes[-1])
+            empty_tiers=[self.upsample_thresh_list[i] for i in range(len(self.upsample_thresh_list)) if (self.upsampled_tier_batch_sizes[i]>0) and (self.upsampled_tier_lens[i]==0)]
+            if len(empty_tiers)>0:
+                raise Exception("no positions to upsample in the tiers starting at thresholds:"+str(empty_tiers))
         else:
             self.upsampled_batch_size=0
             self.upsampled_indices_len=0
@@ -214,35 +350,34 @@ class TiledbGenerator(Sequence):
         self.return_coords=return_coords
         print('created generator')
         
+    def reopen_tdb_arrays(self):
+        '''
+        re-open the tiledb arrays with a fresh context; called in forked worker processes, which can't share the parent's open arrays 
+        '''
+        self.ctx=tiledb.Ctx(self.config)
+        self.tdb_array=tiledb.open(self.tdb_array_name,mode='r',ctx=self.ctx)
+        if self.bias_arrays is not None:
+            self.bias_arrays=[tiledb.open(i,mode='r',ctx=self.ctx) for i in self.tdb_bias_array_names]
+            
     def get_chrom_index_ranges(self,chroms_to_use):
         '''
-        find tdb indices corresponding to the used chromosomes 
+        find tdb indices corresponding to the used chromosomes, ordered by their offset in the array 
         '''
-        num_chroms=self.tdb_array.meta['num_chroms']
         self.task_indices=[i for i in range(self.tdb_array.meta['num_tasks'])]
-        chrom_indices=[]
-        chrom_sizes=[]
-        chroms=[]
-        num_indices=0
-        for i in range(num_chroms):
-            chrom_name=self.tdb_array.meta['chrom_'+str(i)]
-            if chrom_name in chroms_to_use:
-                chroms.append(chrom_name)
-                start_index=self.tdb_array.meta['offset_'+str(i)]
-                end_index=start_index+self.tdb_array.meta['size_'+str(i)]
-                num_indices+=(end_index-start_index)
-                chrom_indices.append((start_index,end_index))
-                chrom_sizes.append(self.tdb_array.meta['size_'+str(i)])
-        min_chrom_size=min(chrom_sizes)
-        scaled_chrom_sizes=[round(i/min_chrom_size) for i in chrom_sizes]
-        weighted_chrom_sizes=[]
-        for i in range(len(chrom_sizes)):
-            cur_weight=scaled_chrom_sizes[i]
-            cur_range=[chrom_indices[i]]
-            weighted_chrom_sizes=weighted_chrom_sizes+cur_weight*cur_range
+        chrom_names,chrom_offsets,chrom_sizes=get_tdb_chrom_offsets(self.tdb_array)
+        used=np.isin(chrom_names,chroms_to_use)
+        chroms=chrom_names[used].tolist()
+        chrom_starts=chrom_offsets[used]
+        chrom_sizes=chrom_sizes[used]
+        chrom_indices=[(int(start_index),int(start_index+size)) for start_index,size in zip(chrom_starts,chrom_sizes)]
         self.chrom_indices=chrom_indices
-        self.weighted_chrom_indices=weighted_chrom_sizes
-        self.num_indices=num_indices
+        #sorted start/end (exclusive) tdb indices of the used chromosomes, for vectorized index --> coordinate lookups 
+        self.chrom_starts=chrom_starts
+        self.chrom_ends=chrom_starts+chrom_sizes
+        self.chrom_names=chrom_names[used]
+        #cumulative chromosome lengths; a uniform draw over [0, num_indices) picks a chromosome in proportion to its length 
+        self.chrom_cum_ends=np.cumsum(chrom_sizes)
+        self.num_indices=int(np.sum(chrom_sizes))
         self.chroms_to_use=chroms
         return
     
@@ -259,19 +394,112 @@ class TiledbGenerator(Sequence):
         assert(len(task_indices)>0)
         return task_indices
     
-    def get_nonupsample_batch_indices(self):
+    def get_sample_rng(self,idx):
         '''
-        randomly select n positions from the genome 
+        np.random.Generator for the non-upsampled positions of batch idx 
         '''
-        #get current chromosome
-        cur_interval=random.sample(self.weighted_chrom_indices,1)[0]
-        #sample random indices from the current chromosome 
-        cur_batch=random.sample(range(cur_interval[0],cur_interval[1]),self.non_upsampled_batch_size)
-        return cur_batch
-                                                                                                    
+        if self.sample_seed is None:
+            return np.random.default_rng(np.random.randint(2**32,dtype=np.uint64))
+        return np.random.default_rng([int(self.sample_seed),int(self.epoch),int(idx)])
+
+    def sample_positions(self,num_positions,rng):
+        '''
+        draw positions uniformly over all used chromosomes, returns (chrom_codes, tdb_indices) arrays 
+        '''
+        offsets=rng.integers(0,self.num_indices,size=num_positions,dtype=np.int64)
+        chrom_codes=np.searchsorted(self.chrom_cum_ends,offsets,side='right')
+        positions=offsets-(self.chrom_cum_ends[chrom_codes]-(self.chrom_ends[chrom_codes]-self.chrom_starts[chrom_codes]))
+        return chrom_codes,self.chrom_starts[chrom_codes]+positions
+
+    def get_nonupsample_batch_indices(self,idx=0,max_draws=100):
+        '''
+        randomly select n positions from the genome, each chromosome weighted by its length 
+        if reject_ambig_nonupsampled is set, positions with an N within ambig_flank are redrawn, up to max_draws times 
+        '''
+        rng=self.get_sample_rng(idx)
+        chrom_codes,tdb_indices=self.sample_positions(self.non_upsampled_batch_size,rng)
+        if self.reject_ambig_nonupsampled==False:
+            return tdb_indices
+        to_draw=np.arange(tdb_indices.shape[0])
+        for draw in range(max_draws):
+            positions=tdb_indices[to_draw]-self.chrom_starts[chrom_codes[to_draw]]
+            ambig=self.ref.is_ambig(self.chrom_names[chrom_codes[to_draw]],positions,self.ambig_flank)
+            to_draw=to_draw[ambig]
+            if to_draw.shape[0]==0:
+                break
+            chrom_codes[to_draw],tdb_indices[to_draw]=self.sample_positions(to_draw.shape[0],rng)
+        return tdb_indices
     
 
+    def get_upsample_cache_paths(self):
+        '''
+        the cache is keyed on everything that determines the upsampled indices: array, attributes, threshold, tasks and chromosome ranges
+        '''
+        cache_key={'tdb_array':os.path.abspath(self.tdb_array_name) if not self.tdb_array_name.startswith('s3://') else self.tdb_array_name,
+                   'tdb_partition_attribute_for_upsample':self.tdb_partition_attribute_for_upsample,
+                   'upsample_thresh_list':self.upsample_thresh_list,
+                   'tdb_ambig_attribute':self.tdb_ambig_attribute,
+                   'task_indices':[int(i) for i in self.task_indices],
+                   'chrom_indices':[[int(i) for i in region] for region in self.chrom_indices]}
+        cache_hash=hashlib.sha1(json.dumps(cache_key,sort_keys=True).encode('utf-8')).hexdigest()
+        cache_prefix=os.path.join(self.upsample_cache_dir,cache_hash)
+        return cache_key,cache_prefix+'.npy',cache_prefix+'.json'
+
+    def load_cached_upsampled_indices(self,fragment_timestamps):
+        cache_key,cache_npy,cache_json=self.get_upsample_cache_paths()
+        if not (os.path.exists(cache_npy) and os.path.exists(cache_json)):
+            return None
+        with open(cache_json,'r') as f:
+            cache_meta=json.load(f)
+        if cache_meta['fragment_timestamps']!=fragment_timestamps:
+            print("tdb array has been modified since the upsampled indices were cached, recomputing")
+            return None
+        print("loading cached upsampled indices from:"+cache_npy)
+        return np.load(cache_npy,mmap_mode='r'),np.asarray(cache_meta['tier_offsets'],dtype=np.int64)
+
+    def save_cached_upsampled_indices(self,upsampled_indices,tier_offsets,fragment_timestamps):
+        cache_key,cache_npy,cache_json=self.get_upsample_cache_paths()
+        try:
+            os.makedirs(self.upsample_cache_dir,exist_ok=True)
+            #write to temporary files first so concurrent runs never see a partial cache 
+            tmp_suffix='.tmp.'+str(os.getpid())
+            np.save(cache_npy+tmp_suffix+'.npy',upsampled_indices)
+            with open(cache_json+tmp_suffix,'w') as f:
+                json.dump({'key':cache_key,'fragment_timestamps':fragment_timestamps,'tier_offsets':[int(i) for i in tier_offsets]},f)
+            os.replace(cache_npy+tmp_suffix+'.npy',cache_npy)
+            os.replace(cache_json+tmp_suffix,cache_json)
+            print("cached upsampled indices to:"+cache_npy)
+        except OSError as e:
+            print("warning! could not cache upsampled indices:"+str(e))
+
     def get_upsampled_indices(self):
+        '''
+        the indices of all tiers are stored in one array, tier after tier; tier i is upsampled_indices[upsampled_tier_offsets[i]:upsampled_tier_offsets[i+1]] 
+        '''
+        cached=None
+        fragment_timestamps=None
+        if self.upsample_cache_dir is not False:
+            fragment_timestamps=get_tdb_fragment_timestamps(self.tdb_array_name,ctx=self.ctx)
+            if fragment_timestamps is None:
+                print("warning! installed tiledb-py can't list array fragments, upsampled index cache disabled")
+            else:
+                cached=self.load_cached_upsampled_indices(fragment_timestamps)
+        if cached is None:
+            upsampled_indices,tier_offsets=self.compute_upsampled_indices()
+            if fragment_timestamps is not None:
+                self.save_cached_upsampled_indices(upsampled_indices,tier_offsets,fragment_timestamps)
+        else:
+            upsampled_indices,tier_offsets=cached
+        #the indices are kept in their original (possibly memory-mapped) order; shuffling is a lazy permutation applied per batch, see get_upsampled_order_seed 
+        self.upsampled_indices=upsampled_indices
+        self.upsampled_tier_offsets=tier_offsets
+        self.upsampled_tier_lens=np.diff(tier_offsets)
+        self.upsampled_indices_len=len(self.upsampled_indices)
+        print("upsampled tier sizes:"+str(self.upsampled_tier_lens))
+        print("finished upsampling")
+        return
+
+    def compute_upsampled_indices(self):
         from multiprocessing import Pool
         print("num_threads:"+str(self.num_threads))
         pool=Pool(processes=self.num_threads,initializer=init_worker)
@@ -279,14 +507,13 @@ class TiledbGenerator(Sequence):
         for region in self.chrom_indices:
             region_start=region[0]
             region_end=region[1]
-            pool_inputs.append((region_start,region_end,self.tdb_array_name,self.tdb_ambig_attribute,self.tdb_partition_attribute_for_upsample,self.task_indices,self.tdb_partition_thresh_for_upsample))
-        upsampled_indices=None
+            pool_inputs.append((region_start,region_end,self.tdb_array_name,self.tdb_ambig_attribute,self.tdb_partition_attribute_for_upsample,self.task_indices,self.upsample_thresh_list))
+        #one scan of the partition attribute fills every tier 
+        tier_indices=[[] for tier in self.upsample_thresh_list]
         try:
             for region_upsampled_indices in pool.map(get_upsampled_indices_chrom,pool_inputs):
-                if upsampled_indices is None:
-                    upsampled_indices=np.squeeze(region_upsampled_indices)
-                else:
-                    upsampled_indices=np.concatenate((upsampled_indices,np.squeeze(region_upsampled_indices)))
+                for tier in range(len(tier_indices)):
+                    tier_indices[tier].append(np.asarray(region_upsampled_indices[tier],dtype=np.int64))
         except KeyboardInterrupt:
             kill_child_processes(os.getpid())
             pool.terminate()
@@ -298,21 +525,15 @@ class TiledbGenerator(Sequence):
         pool.close()
         pool.join()
         print('closed upsampling pool') 
-        print("made upsampled index data frame")
-        self.upsampled_indices=upsampled_indices
-        if self.shuffle_epoch_start==True:
-            #shuffle rows & reset index
-            print("shuffling upsampled dataframes prior to start of training")
-            np.random.shuffle(self.upsampled_indices)
-        self.upsampled_indices_len=len(self.upsampled_indices)
-        print("finished upsampling")
-        return
+        tier_indices=[np.concatenate(i) for i in tier_indices]
+        tier_offsets=np.cumsum([0]+[i.shape[0] for i in tier_indices])
+        return np.concatenate(tier_indices),tier_offsets
 
     
         
     def __len__(self):
         #we are only training on peak regions
-        if (self.upsample_ratio is not None) and (self.upsample_ratio==1):
+        if (self.upsample_ratio is not None) and (self.non_upsampled_batch_size==0):
             return int(floor(self.upsampled_indices_len/self.upsampled_batch_size))
         else:
         #training on peak and non-peak regions 
@@ -321,7 +542,6 @@ class TiledbGenerator(Sequence):
 
     def __getitem__(self,idx):
         gc.unfreeze()
-        self.ref=pysam.FastaFile(self.ref_fasta)
         
         #get the coordinates for the current batch
         tdb_batch_indices=self.get_tdb_indices_for_batch(idx) #coords is a df with 'chrom' and 'pos' columns.
@@ -338,13 +558,12 @@ class TiledbGenerator(Sequence):
                 if coords is None:
                     coords=self.get_coords(tdb_batch_indices)
                 cur_seq=self.get_seq(coords,self.tdb_input_flank[cur_input_index])
-                transformed_seq=self.transform_seq(cur_seq,self.tdb_input_transformation[cur_input_index])
-                cur_x=one_hot_encode(transformed_seq)
+                cur_x=self.transform_seq(cur_seq,self.tdb_input_transformation[cur_input_index])
             else:
                 #extract values from tdb
                 cur_vals=self.get_tdb_vals(tdb_batch_indices,cur_input_index,self.tdb_input_flank[cur_input_index],is_input=True)
-                aggregate_vals=self.aggregate_vals(cur_vals,self.input_aggregation[cur_input_index])
-                transformed_vals=self.transform_vals(aggregate_vals,self.tdb_input_transformation[cur_input_index])
+                aggregate_vals=self.aggregate_vals(cur_vals,self.tdb_input_aggregation[cur_input_index])
+                transformed_vals=self.transform_vals(aggregate_vals,self.tdb_input_transformation[cur_input_index],task_order=self.revcomp_task_order)
                 cur_x=transformed_vals
             if self.expand_dims==True:
                 cur_x=np.expand_dims(cur_x,axis=1)
@@ -368,20 +587,19 @@ class TiledbGenerator(Sequence):
             if cur_output=="seq":
                 #get the one-hot encoded sequence
                 if coords is None:
-                    coords=get_coords(tdb_batch_indices)
+                    coords=self.get_coords(tdb_batch_indices)
                 cur_seq=self.get_seq(coords,self.tdb_output_flank[cur_output_index])
-                transformed_seq=self.transform_seq(cur_seq,self.tdb_output_transformation[cur_output_index])
-                cur_y=one_hot_encode(transformed_seq)
+                cur_y=self.transform_seq(cur_seq,self.tdb_output_transformation[cur_output_index])
             else:
                 #extract values from tdb
                 cur_vals=self.get_tdb_vals(tdb_batch_indices,cur_output_index,self.tdb_output_flank[cur_output_index],is_output=True)
                 aggregate_vals=self.aggregate_vals(cur_vals,self.tdb_output_aggregation[cur_output_index])
-                transformed_vals=self.transform_vals(aggregate_vals,self.tdb_output_transformation[cur_output_index])
+                transformed_vals=self.transform_vals(aggregate_vals,self.tdb_output_transformation[cur_output_index],task_order=self.revcomp_task_order)
                 cur_y=transformed_vals
             y.append(cur_y)
         if self.return_coords is True:
             if self.add_revcomp==True:
-                coords=coords+coords #concatenate coord list 
+                coords=(np.concatenate((coords[0],coords[0])),np.concatenate((coords[1],coords[1])))
         
         filtered_X,filtered_y,filtered_coords=self.remove_data_out_of_range(X,y,coords)
         
@@ -391,64 +609,49 @@ class TiledbGenerator(Sequence):
             return (filtered_X,filtered_y)
         
     def remove_data_out_of_range(self,X,y,coords=None):
-        bad_indices=[]
+        #fast path: no min/max bounds configured, so there is nothing to filter 
+        if self.has_range_bounds==False:
+            return X,y,coords
+        out_of_range=np.zeros(X[0].shape[0],dtype=bool)
         for i in range(self.num_inputs):
-            if self.tdb_input_min[i] is not None:
-                out_of_range=[j[0] for j in np.argwhere(X[i]<self.tdb_input_min[i]).tolist() if len(j)>0 ]
-                bad_indices+=out_of_range
-            if self.tdb_input_max[i] is not None:
-                out_of_range=[j[0] for j in np.argwhere(X[i]>self.tdb_input_max[i]).tolist() if len(j)>0 ]
-                bad_indices+=out_of_range
+            out_of_range|=get_out_of_range_rows(X[i],self.tdb_input_min[i],self.tdb_input_max[i])
         for i in range(self.num_outputs):
-            if self.tdb_output_min[i] is not None:
-                out_of_range=[j[0] for j in np.argwhere(y[i]<self.tdb_output_min[i]).tolist() if len(j)>0]
-                bad_indices+=out_of_range
-            if self.tdb_output_max[i] is not None:
-                out_of_range=[j[0] for j in np.argwhere(y[i]>self.tdb_output_max[i]).tolist() if len(j)>0]
-                bad_indices+=out_of_range
-        bad_indices=list(set(bad_indices))
-        X=[np.delete(i,bad_indices,0) for i in X]
-        y=[np.delete(i,bad_indices,0) for i in y]
+            out_of_range|=get_out_of_range_rows(y[i],self.tdb_output_min[i],self.tdb_output_max[i])
+        if not out_of_range.any():
+            #all rows are in range, skip the copy 
+            return X,y,coords
+        in_range=~out_of_range
+        X=[i[in_range] for i in X]
+        y=[i[in_range] for i in y]
         if coords is not None:
-            coords=np.delete(coords,bad_indices,0)
-            coords=[tuple(coord) for coord in coords]
-            coords=[(i[0],int(i[1])) for i in coords]
+            coords=tuple(i[in_range] for i in coords)
         return X,y,coords
         
     def get_coords(self,tdb_batch_indices):
-        #return list of (chrom,pos) for each index in batch
-        coords=[]
-        for cur_batch_index in tdb_batch_indices:
-            for chrom_index in range(len(self.chrom_indices)):
-                cur_chrom_start_index=self.chrom_indices[chrom_index][0]
-                cur_chrom_end_index=self.chrom_indices[chrom_index][1]
-                if (cur_batch_index >=cur_chrom_start_index) and (cur_batch_index<cur_chrom_end_index):
-                    coords.append([self.chroms_to_use[chrom_index],cur_batch_index-cur_chrom_start_index])
-                    break
-        return coords
+        #return (chrom_codes, positions) arrays for the indices in the batch; chrom_codes index into self.chrom_names
+        return tdb_indices_to_coords(tdb_batch_indices,chrom_starts=self.chrom_starts,chrom_ends=self.chrom_ends)
     
     def get_tdb_indices_for_batch(self,idx):
         upsampled_batch_indices=None
         non_upsampled_batch_indices=None
         if self.upsampled_batch_size > 0:
-            #might need to wrap to get the upsampled index length
-            upsampled_batch_start=int(idx*self.upsampled_batch_size % self.upsampled_indices_len)
-            upsampled_batch_end=upsampled_batch_start+self.upsampled_batch_size
-            while upsampled_batch_end > self.upsampled_indices_len:
-                if upsampled_batch_indices is None:
-                    upsampled_batch_indices=self.upsampled_indices[upsampled_batch_start:self.upsampled_indices_len]
-                else:
-                    upsampled_batch_indices=np.concatenate((upsampled_batch_indices,self.upsampled_indices[upsampled_batch_start:self.upsampled_indices_len]))
-                upsampled_batch_start=0
-                upsampled_batch_end=upsampled_batch_end-self.upsampled_indices_len
-            if upsampled_batch_indices is None:
-                upsampled_batch_indices=self.upsampled_indices[upsampled_batch_start:upsampled_batch_end]
-            else: 
-                upsampled_batch_indices=np.concatenate((upsampled_batch_indices,self.upsampled_indices[upsampled_batch_start:upsampled_batch_end]))
+            upsampled_positions=[]
+            order_seed=self.get_upsampled_order_seed()
+            for tier in range(len(self.upsampled_tier_batch_sizes)):
+                tier_batch_size=int(self.upsampled_tier_batch_sizes[tier])
+                if tier_batch_size==0:
+                    continue
+                tier_len=int(self.upsampled_tier_lens[tier])
+                #positions of the sub-batch in this epoch's order of the tier, wrapping around the end of the tier 
+                order_positions=(int(idx)*tier_batch_size+np.arange(tier_batch_size,dtype=np.int64))%tier_len
+                if order_seed is not None:
+                    order_positions=lazy_permutation(order_positions,tier_len,order_seed+(tier,))
+                upsampled_positions.append(self.upsampled_tier_offsets[tier]+order_positions)
+            upsampled_batch_indices=np.asarray(self.upsampled_indices[np.concatenate(upsampled_positions)])
             
         if self.non_upsampled_batch_size > 0:
             #select random indices from genome
-            non_upsampled_batch_indices=self.get_nonupsample_batch_indices()
+            non_upsampled_batch_indices=self.get_nonupsample_batch_indices(idx)
         if (upsampled_batch_indices is not None) and (non_upsampled_batch_indices is not None):
             tdb_batch_indices=np.concatenate((upsampled_batch_indices,non_upsampled_batch_indices))
         elif upsampled_batch_indices is not None:
@@ -461,33 +664,24 @@ class TiledbGenerator(Sequence):
     
      
     def get_seq(self,coords,flank):
-        seqs=[]
-        for coord in coords:
-            chrom=coord[0]
-            start_pos=coord[1]-flank
-            end_pos=coord[1]+flank 
-            try:
-                seq=self.ref.fetch(chrom,start_pos,end_pos)
-                if len(seq)<2*flank:
-                    delta=2*flank-len(seq)
-                    seq=seq+"N"*delta
-            except:
-                seq="N"*2*flank
-            seqs.append(seq) 
-        return seqs
+        #windows past the chromosome ends are padded with N
+        chrom_codes,centers=coords
+        return self.ref.fetch_windows(self.chrom_names[chrom_codes],centers-flank,2*flank)
 
     def transform_seq(self,seqs,transformation):
-        if self.add_revcomp is True:
-            seqs_rc=[revcomp(s) for s in seqs]
-            seqs=seqs+seqs_rc
-        return seqs
+        #one-hot encode, appending the reverse complemented sequences in the same pass if specified
+        return one_hot_encode(seqs,dtype=self.onehot_dtype,add_revcomp=self.add_revcomp)
 
     def get_bias_vals(self,tdb_batch_indices,cur_bias_index,flank):
         num_entries=len(tdb_batch_indices)
-        vals=np.full((num_entries,2*flank,1),np.nan)
         cur_array=self.bias_arrays[cur_bias_index]
+        attribute=self.bias_source_attribute[cur_bias_index]
+        if self.tdb_batched_reads==True:
+            window_starts=np.asarray(tdb_batch_indices,dtype=np.int64)-flank
+            return read_tdb_windows(cur_array,attribute,window_starts,2*flank).astype(self.vals_compute_dtype,copy=False)
+        vals=np.full((num_entries,2*flank,1),np.nan,dtype=self.vals_compute_dtype)
         for val_index in range(num_entries):
-            vals[val_index,:,:]=cur_array.query(attrs=[self.bias_source_attribute[cur_bias_index]])[tdb_batch_indices[val_index]-flank:tdb_batch_indices[val_index]+flank,:][self.bias_source_attribute[cur_bias_index]]
+            vals[val_index,:,:]=cur_array.query(attrs=[attribute])[tdb_batch_indices[val_index]-flank:tdb_batch_indices[val_index]+flank,:][attribute]
         return vals 
     
     def get_tdb_vals(self,tdb_batch_indices,input_output_index,flank,is_input=False,is_output=False):
@@ -503,33 +697,44 @@ class TiledbGenerator(Sequence):
             input_or_output="outputs"
             attribute=self.tdb_output_source_attribute[input_output_index] 
             
+        if self.tdb_batched_reads==True:
+            #one multi-range query for the whole batch 
+            window_starts=np.asarray(tdb_batch_indices,dtype=np.int64)-flank
+            return read_tdb_windows(self.tdb_array,attribute,window_starts,2*flank,self.task_indices).astype(self.vals_compute_dtype,copy=False)
         num_tasks=len(self.task_indices)
         num_entries=len(tdb_batch_indices)
         #prepopulate the values array with nans
-        vals=np.full((num_entries,2*flank,num_tasks),np.nan)
+        vals=np.full((num_entries,2*flank,num_tasks),np.nan,dtype=self.vals_compute_dtype)
         #iterate through entries
         for val_index in range(num_entries):
             vals[val_index,:,:]=self.tdb_array.query(attrs=[attribute]).multi_index[tdb_batch_indices[val_index]-flank:tdb_batch_indices[val_index]+flank-1,self.task_indices][attribute]
         return vals
     
-    def transform_vals(self,vals,transformer):
-        if self.add_revcomp==True:
-            vals=np.concatenate((vals,vals),axis=0)
+    def transform_vals(self,vals,transformer,task_order=None):
         if transformer == 'None':
-            return vals
+            pass
         elif transformer == 'asinh':
-            return np.arcsinh(vals)
+            vals=np.arcsinh(vals)
         elif transformer == 'log10':
-            return np.log10(vals+self.pseudocount)
+            vals=np.log10(vals+self.pseudocount)
         elif transformer == 'log':
-            return np.log(vals+self.pseudocount)
+            vals=np.log(vals+self.pseudocount)
         elif transformer == 'counts_to_logit':
             vals=vals/np.expand_dims(vals.sum(axis=1),axis=1) #transform to probability space, axis 0 = batch, axis 1 = genome pos, axis 2 = task 
             vals+=self.bias_pseudocount
             vals=logit(vals)
-            return vals 
         else:
-            raise Exception("transform_vals argument must be one of None, asinh, log10, log; you provided:"+transformer) 
+            raise Exception("transform_vals argument must be one of None, asinh, log10, log; you provided:"+transformer)
+        if self.add_revcomp==True:
+            #the transformations act per entry, so they are applied before adding the reverse complement strand, which reverses per-position tracks 
+            #and swaps strand-specific tasks (task_order) 
+            if vals.ndim==3:
+                return add_revcomp_vals(vals,flip_axes=(1,),dtype=self.vals_dtype,task_order=task_order)
+            if vals.ndim==1:
+                task_order=None
+            return add_revcomp_vals(vals,flip_axes=(),dtype=self.vals_dtype,task_order=task_order)
+        #cast to the batch dtype once the arithmetic is done 
+        return vals.astype(self.vals_dtype,copy=False)
     
     def aggregate_vals(self,vals,aggregator):
         if aggregator == 'None':
@@ -550,8 +755,17 @@ class TiledbGenerator(Sequence):
             raise Exception("aggregate_vals argument must be one of None, average, max, sum; you provided:"+aggregator)
 
     
+    def get_upsampled_order_seed(self):
+        '''
+        seed of the lazy permutation giving the current epoch's order of the upsampled indices, or None to keep their original order 
+        '''
+        if self.shuffle_epoch_end==True and self.epoch>0:
+            return (self.shuffle_seed,self.epoch)
+        if self.shuffle_epoch_start==True:
+            return (self.shuffle_seed,0)
+        return None
+
     def on_epoch_end(self):
-        if self.shuffle_epoch_end==True:
-            print("WARNING: SHUFFLING ON EPOCH END MAYBE SLOW:"+str(self.upsampled_indices.shape))
-            self.upsampled_indices=self.upsampled_indices.sample(frac=1)
+        #advancing the epoch reshuffles the upsampled indices (if shuffle_epoch_end) and reseeds the non-upsampled positions; nothing is copied 
+        self.epoch+=1
 
@@ -52,8 +52,24 @@ class TiledbPredictGenerator(TiledbGenerator):
                  bed_regions=None,
                  tdb_config=None,
                  tdb_ctx=None,
+                 ref_cache_dir=None,
+                 upsample_cache_dir=None,
+                 onehot_dtype='float32',
+                 vals_dtype='float32',
+                 tile_length=None,
+                 tile_overlap=0,
+                 skip_ambig=False,
+                 num_shards=1,
+                 shard_index=0,
                  num_threads=1):
-        
+        '''
+        tiledb_stride -- distance between consecutive prediction centers within each chromosome or bed region 
+        bed_regions -- BED file path, or list of (chrom, start, end), to predict on instead of the whole of the used chromosomes; overlapping regions are merged 
+        tile_length -- if set, tile each chromosome with windows of this length (i.e. the model's output length) overlapping by tile_overlap bases,
+        in place of the tiledb_stride walk; the last window of each chromosome is shifted to end at the chromosome end, and chromosomes shorter than a window are skipped
+        skip_ambig -- skip the stretches where the input/output window around the center contains an N (or runs off the chromosome), using the reference cache's ambiguity masks; applies to the tiledb_stride walk, not to tiles 
+        num_shards/shard_index -- predict on the shard_index'th of num_shards contiguous ranges of batches, i.e. to split whole-genome prediction across processes 
+        '''
         TiledbGenerator.__init__(self,          
                                  ref_fasta=ref_fasta,
                                  batch_size=batch_size,
@@ -92,16 +108,154 @@ class TiledbPredictGenerator(TiledbGenerator):
                                  return_coords=True,
                                  tdb_config=tdb_config,
                                  tdb_ctx=tdb_ctx,
+                                 ref_cache_dir=ref_cache_dir,
+                                 upsample_cache_dir=upsample_cache_dir,
+                                 onehot_dtype=onehot_dtype,
+                                 vals_dtype=vals_dtype,
                                  tasks=tasks,
                                  task_indices=task_indices,
                                  num_threads=num_threads)
         self.tiledb_stride=tiledb_stride
         self.bed_regions=bed_regions
+        self.tile_length=tile_length
+        self.tile_overlap=tile_overlap
+        self.skip_ambig=skip_ambig
+        if (self.skip_ambig==True) and (self.ref is None):
+            self.ref=ReferenceCache(self.ref_fasta,chroms=self.chroms_to_use,cache_dir=ref_cache_dir)
+        if self.tile_length is not None:
+            self.init_tiles()
+            num_planned_batches=int(ceil(self.num_tiles/self.batch_size))
+        elif len(self.upsampled_indices)==0:
+            self.plan_batches()
+            num_planned_batches=self.num_planned_batches
+        else:
+            num_planned_batches=None
+        #contiguous range of batches handled by this shard
+        if num_planned_batches is not None:
+            self.first_batch=(num_planned_batches*shard_index)//num_shards
+            self.last_batch=(num_planned_batches*(shard_index+1))//num_shards
+        else:
+            assert num_shards==1, "sharding is not supported with upsampling"
         print("created predict generator")
         
 
 
+    def init_tiles(self):
+        '''
+        count the tiles of each chromosome; tile centers are computed per batch from these counts, so nothing genome-sized is stored
+        '''
+        self.tile_step=self.tile_length-self.tile_overlap
+        if self.tile_step<1:
+            raise Exception("tile_overlap must be smaller than tile_length; you provided:"+str(self.tile_overlap)+","+str(self.tile_length))
+        chrom_sizes=self.chrom_ends-self.chrom_starts
+        self.tile_counts=np.where(chrom_sizes>=self.tile_length,(np.maximum(chrom_sizes-self.tile_length,0)+self.tile_step-1)//self.tile_step+1,0)
+        self.tile_cum_counts=np.cumsum(self.tile_counts)
+        self.num_tiles=int(self.tile_cum_counts[-1]) if self.tile_counts.shape[0]>0 else 0
+        print("tiling "+str(self.chrom_names.shape[0])+" chromosomes with "+str(self.num_tiles)+" windows of "+str(self.tile_length)+" bp, step "+str(self.tile_step))
+
+    def get_tile_indices_for_batch(self,idx):
+        '''
+        tdb indices of the tile centers in batch idx, in order of chromosome and position
+        '''
+        ordinals=np.arange(idx*self.batch_size,min((idx+1)*self.batch_size,self.num_tiles),dtype=np.int64)
+        chrom_codes=np.searchsorted(self.tile_cum_counts,ordinals,side='right')
+        tile_ordinals=ordinals-(self.tile_cum_counts[chrom_codes]-self.tile_counts[chrom_codes])
+        chrom_sizes=self.chrom_ends[chrom_codes]-self.chrom_starts[chrom_codes]
+        tile_starts=np.minimum(tile_ordinals*self.tile_step,chrom_sizes-self.tile_length)
+        return self.chrom_starts[chrom_codes]+tile_starts+self.tile_length//2
+
+    def get_regions(self):
+        '''
+        (chrom_code, start, end) regions to predict on, in chromosome coordinates and in the order of the used chromosomes 
+        '''
+        chrom_sizes=self.chrom_ends-self.chrom_starts
+        if self.bed_regions is None:
+            return [(chrom_code,0,int(chrom_sizes[chrom_code])) for chrom_code in range(self.chrom_names.shape[0])]
+        if isinstance(self.bed_regions,str):
+            bed=pd.read_csv(self.bed_regions,header=None,sep='\t',usecols=[0,1,2],comment='#')
+            bed_regions=zip(bed[0].astype(str),bed[1],bed[2])
+        else:
+            bed_regions=self.bed_regions
+        chrom_codes=dict([(str(chrom),chrom_code) for chrom_code,chrom in enumerate(self.chrom_names)])
+        regions=sorted([(chrom_codes[str(chrom)],max(0,int(start)),min(int(end),int(chrom_sizes[chrom_codes[str(chrom)]]))) for chrom,start,end in bed_regions if str(chrom) in chrom_codes])
+        #merge overlapping regions, so no position is predicted twice 
+        merged=[]
+        for chrom_code,start,end in regions:
+            if start>=end:
+                continue
+            if (len(merged)>0) and (merged[-1][0]==chrom_code) and (start<=merged[-1][2]):
+                merged[-1]=(chrom_code,merged[-1][1],max(merged[-1][2],end))
+            else:
+                merged.append((chrom_code,start,end))
+        return merged
+
+    def get_nonambig_runs(self,chrom,start,end,chunk_size=2**24):
+        '''
+        (run_start, run_end) stretches of [start, end) whose windows contain no N, read from the bit-packed ambiguity mask one chunk at a time 
+        '''
+        packed_mask=self.ref.get_ambig_mask(chrom,self.ambig_flank)
+        if packed_mask is None:
+            #chromosome missing from the fasta 
+            return []
+        runs=[]
+        for chunk_start in range(start,end,chunk_size):
+            chunk_end=min(chunk_start+chunk_size,end)
+            bits=np.unpackbits(packed_mask[chunk_start>>3:(chunk_end+7)>>3])[(chunk_start&7):(chunk_start&7)+(chunk_end-chunk_start)]
+            clear=np.concatenate(([False],bits==0,[False]))
+            edges=np.flatnonzero(clear[1:]!=clear[:-1])
+            for run_start,run_end in zip(chunk_start+edges[0::2],chunk_start+edges[1::2]):
+                if (len(runs)>0) and (runs[-1][1]==run_start):
+                    #continues the last run of the previous chunk
+                    runs[-1]=(runs[-1][0],int(run_end))
+                else:
+                    runs.append((int(run_start),int(run_end)))
+        return runs
+
+    def plan_batches(self):
+        '''
+        lay out the prediction centers as segments of evenly strided positions: a segment starts at tdb index segment_starts[i] and has segment_counts[i] centers, 
+        tiledb_stride apart; batch_segments[b] is the segment holding the first center of batch b. Nothing per-position is stored. 
+        '''
+        stride=self.tiledb_stride
+        segment_starts=[]
+        segment_counts=[]
+        for chrom_code,start,end in self.get_regions():
+            if self.skip_ambig==True:
+                runs=self.get_nonambig_runs(str(self.chrom_names[chrom_code]),start,end)
+            else:
+                runs=[(start,end)]
+            for run_start,run_end in runs:
+                #keep the centers on the region's stride grid 
+                first=start+((run_start-start+stride-1)//stride)*stride
+                if first>=run_end:
+                    continue
+                segment_starts.append(int(self.chrom_starts[chrom_code])+first)
+                segment_counts.append((run_end-1-first)//stride+1)
+        self.segment_starts=np.array(segment_starts,dtype=np.int64)
+        self.segment_counts=np.array(segment_counts,dtype=np.int64)
+        self.segment_cum_counts=np.cumsum(self.segment_counts)
+        self.num_planned_positions=int(self.segment_cum_counts[-1]) if self.segment_counts.shape[0]>0 else 0
+        self.num_planned_batches=int(ceil(self.num_planned_positions/self.batch_size))
+        self.batch_segments=np.searchsorted(self.segment_cum_counts,np.arange(self.num_planned_batches,dtype=np.int64)*self.batch_size,side='right')
+        print("planned "+str(self.num_planned_positions)+" positions in "+str(self.segment_counts.shape[0])+" segments, "+str(self.num_planned_batches)+" batches")
+
+    def get_planned_indices_for_batch(self,idx):
+        '''
+        tdb indices of the centers in batch idx of the plan
+        '''
+        ordinals=np.arange(idx*self.batch_size,min((idx+1)*self.batch_size,self.num_planned_positions),dtype=np.int64)
+        first_segment=self.batch_segments[idx]
+        segments=first_segment+np.searchsorted(self.segment_cum_counts[first_segment:],ordinals,side='right')
+        offsets=ordinals-(self.segment_cum_counts[segments]-self.segment_counts[segments])
+        return self.segment_starts[segments]+offsets*self.tiledb_stride
+
+    def get_chrom_sizes(self):
+        #(chrom, size) of the used chromosomes, in the order batches walk through them
+        return [(str(chrom),int(end-start)) for chrom,start,end in zip(self.chrom_names,self.chrom_starts,self.chrom_ends)]
+
     def get_tdb_indices_for_batch(self,idx):
+        if self.tile_length is not None:
+            return self.get_tile_indices_for_batch(self.first_batch+idx)
         if len(self.upsampled_indices)>0:
             #use the upsampled indices 
             upsampled_batch_start=idx*self.upsampled_batch_size
@@ -109,16 +263,14 @@ class TiledbPredictGenerator(TiledbGenerator):
             upsampled_batch_indices=self.upsampled_indices[upsampled_batch_start:upsampled_batch_end]
             return upsampled_batch_indices
         else:
-            #not upsampling, going through the test chromosomes with specified stride value 
-            startpos=idx*self.batch_size*self.tiledb_stride
-            batch_indices=[i for i in range(startpos,startpos+self.batch_size*self.tiledb_stride,self.tiledb_stride)]
-            return batch_indices
+            #not upsampling, going through the planned positions of the test chromosomes/regions with specified stride value 
+            return self.get_planned_indices_for_batch(self.first_batch+idx)
     
     def __len__(self):
-        if len(self.upsampled_indices) is 0: 
-            return int(ceil(self.length/(self.batch_size*self.tiledb_stride)))
+        if (self.tile_length is not None) or (len(self.upsampled_indices)==0):
+            return self.last_batch-self.first_batch
         else:
-            return int(ceil(self.upsampled_indices.shape[0] /self.batch_size))
+            return int(ceil(self.upsampled_indices.shape[0]/self.upsampled_batch_size))
 
     def on_epoch_end(self):
         pass
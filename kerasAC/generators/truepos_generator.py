@@ -4,7 +4,8 @@ import numpy as np
 import random
 import math
 import pysam
-from .util import *
+from ..util import *
+from ..ref_cache import *
 import threading
 import pickle
 import pdb
@@ -61,7 +62,7 @@ def open_data_file(data_path=None,tasks=None,chroms_to_use=None):
     return data
 
 class TruePosGenerator(Sequence):
-    def __init__(self,data_pickle,ref_fasta,batch_size=128,precision_thresh=0.9,expand_dims=True):
+    def __init__(self,data_pickle,ref_fasta,batch_size=128,precision_thresh=0.9,expand_dims=True,ref_cache_dir=None):
         f=open(data_pickle,'rb')
         data=pickle.load(f)
         self.predictions=data[0]
@@ -75,6 +76,7 @@ class TruePosGenerator(Sequence):
         self.indices=np.arange(self.data.shape[0])
         self.add_revcomp=False
         self.ref_fasta=ref_fasta
+        self.ref=ReferenceCache(self.ref_fasta,chroms=[str(i) for i in self.data.index.get_level_values(0).unique()],cache_dir=ref_cache_dir)
         self.lock=threading.Lock()
         self.batch_size=batch_size
         self.expand_dims=expand_dims
@@ -85,17 +87,16 @@ class TruePosGenerator(Sequence):
 
     def __getitem__(self,idx):
         with self.lock:
-            self.ref=pysam.FastaFile(self.ref_fasta)
             return self.get_basic_batch(idx)
 
     def get_basic_batch(self,idx):
         #get seq positions
         inds=self.indices[idx*self.batch_size:(idx+1)*self.batch_size]
         bed_entries=self.data.index[inds]
-        #get sequences
-        seqs=[self.ref.fetch(i[0],i[1],i[2]) for i in bed_entries]
+        #get sequences as slices of the reference cache
+        seqs=self.ref.fetch_regions(bed_entries.get_level_values(0),bed_entries.get_level_values(1),bed_entries.get_level_values(2))
         #one-hot-encode the fasta sequences
-        seqs=np.array([[ltrdict.get(x,[0,0,0,0]) for x in seq] for seq in seqs])
+        seqs=one_hot_encode(seqs)
         x_batch=seqs
         if (self.expand_dims==True):
             x_batch=np.expand_dims(x_batch,1)
@@ -257,7 +258,7 @@ class DataGenerator(Sequence):
         pass
     
     def one_hot_encode(self,seq):
-        pass
+        return one_hot_encode(seq)
     
     def transform_vals(self,vals):
         pass
@@ -284,7 +285,7 @@ class DataGenerator(Sequence):
             for cur_output_index in range(self.num_outputs):
                 cur_output=self.output_path[cur_output_index] 
                 if cur_ouput=="seq":
-                    y.append(self.one_hot_encode(self.transform_seq(self.get_seq(coords)))
+                    y.append(self.one_hot_encode(self.transform_seq(self.get_seq(coords))))
                 else:
                     y.append(self.tranform_vals(self.get_pd_vals(coords)))                    
             #return the batch as an X,y tuple 
@@ -313,13 +314,12 @@ class DataGenerator(Sequence):
             seqs=seqs+seqs_rc
             bed_entries=bed_entries+bed_entries
             
+        #one-hot-encode the fasta sequences
+        seqs=one_hot_encode(seqs)
+
         #generate the corresponding negative set by dinucleotide-shuffling the sequences
-        seqs_shuffled=[dinuc_shuffle(s) for s in seqs]
-        seqs=seqs+seqs_shuffled
+        seqs=np.concatenate((seqs,dinuc_shuffle(seqs)[:,0]),axis=0)
         bed_entries=bed_entries+bed_entries
-        
-        #one-hot-encode the fasta sequences
-        seqs=np.array([[ltrdict.get(x,[0,0,0,0]) for x in seq] for seq in seqs])
         x_batch=seqs
         if (self.expand_dims==True):
             x_batch=np.expand_dims(x_batch,1)
@@ -366,13 +366,10 @@ class DataGenerator(Sequence):
             bed_entries=[(i[0],i[1],i[2]) for i in pos_bed_entries]+[(i[0],i[1],i[2]) for i in neg_bed_entries]
             
         if self.add_revcomp==True:
-            #add in the reverse-complemented sequences for training.
-            seqs_rc=[revcomp(s) for s in seqs]
-            seqs=seqs+seqs_rc
             bed_entries+=bed_entries
 
-        #one-hot-encode the fasta sequences
-        seqs=np.array([[ltrdict.get(x,[0,0,0,0]) for x in seq] for seq in seqs])
+        #one-hot-encode the fasta sequences, adding in the reverse-complemented sequences for training
+        seqs=one_hot_encode(seqs,add_revcomp=self.add_revcomp)
         x_batch=seqs
 
         if (self.expand_dims==True):
@@ -401,13 +398,10 @@ class DataGenerator(Sequence):
         #get sequences
         seqs=[self.ref.fetch(i[0],i[1],i[2]) for i in bed_entries]
         if self.add_revcomp==True:
-            #add in the reverse-complemented sequences for training.
-            seqs_rc=[revcomp(s) for s in seqs]
-            seqs=seqs+seqs_rc
             bed_entries+=bed_entries
             
-        #one-hot-encode the fasta sequences
-        seqs=np.array([[ltrdict.get(x,[0,0,0,0]) for x in seq] for seq in seqs])
+        #one-hot-encode the fasta sequences, adding in the reverse-complemented sequences for training
+        seqs=one_hot_encode(seqs,add_revcomp=self.add_revcomp)
         x_batch=seqs
         if(self.expand_dims==True):
             x_batch=np.expand_dims(x_batch,1)
@@ -498,7 +492,7 @@ class SNPGenerator(DataGenerator):
             seq=seq[0:self.flank_size]+allele+seq[self.flank_size+len(allele)::]
             seqs.append(seq)
         #one-hot-encode the fasta sequences
-        seqs=np.array([[ltrdict.get(x,[0,0,0,0]) for x in seq] for seq in seqs])
+        seqs=one_hot_encode(seqs)
         x_batch=seqs
         if (self.expand_dims==True):
             x_batch=np.expand_dims(x_batch,1)
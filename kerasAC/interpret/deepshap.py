@@ -1,4 +1,4 @@
-from deeplift.dinuc_shuffle import dinuc_shuffle
+from ..util import dinuc_shuffle
 import shap
 import tensorflow as tf
 import numpy as np
@@ -11,11 +11,10 @@ def deepshap_wrapper(inputs):
 
 def create_background(inputs, bg_size=10, seed=1234):
     input_seq=inputs[0]
-    input_seq_bg = [np.empty((bg_size,) + input_seq.shape),np.asarray(bg_size*[inputs[1]])]
     rng = np.random.RandomState(seed)
-    for i in range(bg_size):
-        input_seq_shuf = dinuc_shuffle(np.squeeze(input_seq), rng=rng)
-        input_seq_bg[0][i] = np.expand_dims(input_seq_shuf,axis=0)
+    #all bg_size shuffles in one batched call
+    input_seq_shuf = dinuc_shuffle(np.squeeze(input_seq), num_shufs=bg_size, rng=rng)
+    input_seq_bg = [input_seq_shuf.reshape((bg_size,) + input_seq.shape).astype(float),np.asarray(bg_size*[inputs[1]])]
     return input_seq_bg
 
 
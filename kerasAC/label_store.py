@@ -0,0 +1,197 @@
+#columnar label store for the hdf5/BED training path.
+#labels are stored as one contiguous .npy file per task column (uint8 for byte-sized integer labels, float32 otherwise), next to the
+#START/END coordinate columns; rows are grouped by chromosome, with the row range of each chromosome in meta.json.
+#the columns are memory-mapped, so all worker processes share the same pages, and selecting chromosomes is a slice of the rows.
+import os
+import json
+import argparse
+import shutil
+import numpy as np
+import pandas as pd
+
+LABEL_STORE_META='meta.json'
+
+def is_label_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path,LABEL_STORE_META))
+
+def get_column_dtype(values):
+    #uint8 for integer-valued labels in [0,255], i.e. binary peak labels; float32 otherwise
+    finite=np.isfinite(values)
+    if finite.all() and (values.min(initial=0)>=0) and (values.max(initial=0)<=255) and (np.mod(values,1)==0).all():
+        return np.uint8
+    return np.float32
+
+def read_label_table(data_path,tasks=None):
+    '''
+    read a seqdataloader hdf5 or tab-separated BED label file as a DataFrame with CHR/START/END as its first three columns
+    '''
+    if data_path.endswith('.hdf5'):
+        data=pd.read_hdf(data_path)
+        if list(data.index.names)==['CHR','START','END']:
+            data=data.reset_index()
+    else:
+        data=pd.read_csv(data_path,header=0,sep='\t')
+    if tasks is not None:
+        data=data[list(data.columns[0:3])+list(tasks)]
+    return data
+
+def convert_to_label_store(data_path,store_path,tasks=None):
+    '''
+    convert a seqdataloader hdf5 or BED label file to a label store directory at store_path
+    '''
+    data=read_label_table(data_path,tasks=tasks)
+    coord_cols=data.columns[0:3]
+    task_names=[str(i) for i in data.columns[3:]]
+    #group rows by chromosome, keeping the file order of the chromosomes and of the rows within each chromosome
+    chrom_codes,chrom_names=pd.factorize(data[coord_cols[0]].astype(str))
+    order=np.argsort(chrom_codes,kind='stable')
+    chrom_offsets=np.cumsum([0]+np.bincount(chrom_codes,minlength=len(chrom_names)).tolist())
+    tmp_path=store_path.rstrip('/')+'.tmp.'+str(os.getpid())
+    os.makedirs(tmp_path,exist_ok=True)
+    np.save(os.path.join(tmp_path,'start.npy'),data[coord_cols[1]].values[order].astype(np.int64))
+    np.save(os.path.join(tmp_path,'end.npy'),data[coord_cols[2]].values[order].astype(np.int64))
+    column_dtypes=[]
+    for task_index,task in enumerate(data.columns[3:]):
+        values=data[task].values[order].astype(np.float64)
+        column_dtype=get_column_dtype(values)
+        np.save(os.path.join(tmp_path,'task_'+str(task_index)+'.npy'),values.astype(column_dtype))
+        column_dtypes.append(np.dtype(column_dtype).name)
+    meta={'source':os.path.abspath(data_path),
+          'num_rows':int(data.shape[0]),
+          'tasks':task_names,
+          'dtypes':column_dtypes,
+          'chroms':[str(i) for i in chrom_names],
+          'chrom_offsets':[int(i) for i in chrom_offsets]}
+    with open(os.path.join(tmp_path,LABEL_STORE_META),'w') as f:
+        json.dump(meta,f)
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.replace(tmp_path,store_path)
+    print("wrote label store with "+str(meta['num_rows'])+" rows and "+str(len(task_names))+" tasks to "+store_path)
+    return store_path
+
+class LabelStore(object):
+    def __init__(self,store_path,tasks=None,chroms_to_use=None,dtype='float32'):
+        '''
+        store_path -- directory written by convert_to_label_store
+        tasks -- task columns to read, by name; defaults to all tasks
+        chroms_to_use -- chromosomes to keep; rows of the other chromosomes are skipped
+        dtype -- dtype of the value arrays returned by __getitem__
+        '''
+        self.store_path=store_path
+        with open(os.path.join(store_path,LABEL_STORE_META),'r') as f:
+            self.meta=json.load(f)
+        if tasks is None:
+            tasks=self.meta['tasks']
+        self.tasks=list(tasks)
+        self.task_columns=[self.meta['tasks'].index(task) for task in self.tasks]
+        self.dtype=np.dtype(dtype)
+        #row ranges of the used chromosomes
+        chrom_ranges=[]
+        for chrom_index,chrom in enumerate(self.meta['chroms']):
+            if (chroms_to_use is None) or (chrom in chroms_to_use):
+                chrom_ranges.append((chrom_index,self.meta['chrom_offsets'][chrom_index],self.meta['chrom_offsets'][chrom_index+1]))
+        self.chrom_ranges=chrom_ranges
+        if sum([end-start for chrom_index,start,end in chrom_ranges])==self.meta['num_rows']:
+            self.rows=None
+        else:
+            self.rows=np.concatenate([np.arange(start,end,dtype=np.int64) for chrom_index,start,end in chrom_ranges]+[np.zeros(0,dtype=np.int64)])
+        self.columns=None
+        self.open_columns()
+
+    def __getstate__(self):
+        #memory-maps are re-opened after unpickling in a worker process
+        state=self.__dict__.copy()
+        state['columns']=None
+        state['starts']=None
+        state['ends']=None
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.open_columns()
+
+    def open_columns(self):
+        self.starts=np.load(os.path.join(self.store_path,'start.npy'),mmap_mode='r')
+        self.ends=np.load(os.path.join(self.store_path,'end.npy'),mmap_mode='r')
+        self.columns=[np.load(os.path.join(self.store_path,'task_'+str(i)+'.npy'),mmap_mode='r') for i in self.task_columns]
+
+    @property
+    def shape(self):
+        num_rows=self.meta['num_rows'] if self.rows is None else self.rows.shape[0]
+        return (num_rows,len(self.tasks))
+
+    def select(self,rows):
+        '''
+        returns a view of the store holding the given rows (positions within the current rows, None for all), i.e. to align it to an index file
+        '''
+        selected=LabelStore.__new__(LabelStore)
+        selected.__dict__.update(self.__dict__)
+        if rows is not None:
+            rows=np.asarray(rows,dtype=np.int64)
+            selected.rows=rows if self.rows is None else self.rows[rows]
+        selected.chrom_ranges=None
+        return selected
+
+    def get_coords(self):
+        '''
+        (chroms, starts, ends) arrays of the current rows
+        '''
+        chrom_names=np.array(self.meta['chroms'])
+        chrom_offsets=np.asarray(self.meta['chrom_offsets'],dtype=np.int64)
+        if self.rows is None:
+            chrom_codes=np.repeat(np.arange(chrom_names.shape[0]),np.diff(chrom_offsets))
+            return chrom_names[chrom_codes],np.asarray(self.starts),np.asarray(self.ends)
+        chrom_codes=np.searchsorted(chrom_offsets,self.rows,side='right')-1
+        return chrom_names[chrom_codes],self.starts[self.rows],self.ends[self.rows]
+
+    def get_index(self):
+        chroms,starts,ends=self.get_coords()
+        return pd.MultiIndex.from_arrays([chroms,starts,ends],names=['CHR','START','END'])
+
+    def get_column(self,task_index):
+        column=self.columns[task_index]
+        if self.rows is None:
+            return column
+        return column[self.rows]
+
+    def __getitem__(self,rows):
+        '''
+        gather the values of the given rows as a (num_rows, num_tasks) array
+        '''
+        if self.rows is not None:
+            rows=self.rows[rows]
+        vals=np.empty((len(rows),len(self.columns)),dtype=self.dtype)
+        for task_index,column in enumerate(self.columns):
+            vals[:,task_index]=column[rows]
+        return vals
+
+    def threshold_mask(self,lower_thresh_bound,upper_thresh_bound=None):
+        '''
+        boolean mask of the rows with any task value >= lower_thresh_bound and, if given, all task values < upper_thresh_bound; computed one column at a time
+        '''
+        any_above=np.zeros(self.shape[0],dtype=bool)
+        all_below=np.ones(self.shape[0],dtype=bool)
+        for task_index in range(len(self.columns)):
+            column=self.get_column(task_index)
+            any_above|=(column>=lower_thresh_bound)
+            if upper_thresh_bound is not None:
+                all_below&=(column<upper_thresh_bound)
+        return any_above&all_below
+
+    def head(self,n=5):
+        return pd.DataFrame(self[np.arange(min(n,self.shape[0]))],index=self.select(np.arange(min(n,self.shape[0]))).get_index(),columns=self.tasks)
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="convert a seqdataloader hdf5 or BED label file to a memory-mapped columnar label store")
+    parser.add_argument("--data_path",help="hdf5 or tab-separated BED file with CHR, START, END columns followed by one column per task")
+    parser.add_argument("--store_path",help="output directory of the label store")
+    parser.add_argument("--tasks",nargs="*",default=None,help="task columns to convert, defaults to all")
+    return parser.parse_args()
+
+def main():
+    args=parse_args()
+    convert_to_label_store(args.data_path,args.store_path,tasks=args.tasks)
+
+if __name__=="__main__":
+    main()
@@ -2,6 +2,7 @@ import pandas as pd
 import numpy as np 
 import argparse
 import pyBigWig 
+from ..prediction_store import *
 #from .utils import *
 from scipy.stats import spearmanr, pearsonr
 from scipy import nanmean, nanstd
@@ -141,8 +142,8 @@ def get_performance_metrics_profile_wrapper(args):
     for loss_index in range(len(args.losses)):
         cur_loss=args.losses[loss_index]
         cur_loss_suffix=args.loss_suffixes[loss_index]
-        cur_pred=pd.read_hdf(args.predictions+"."+cur_loss_suffix,header=None,sep='\t')
-        cur_labels=pd.read_hdf(args.labels+"."+cur_loss_suffix,header=None,sp='\t')
+        cur_pred=read_prediction_table(args.predictions+"."+cur_loss_suffix)
+        cur_labels=read_prediction_table(args.labels+"."+cur_loss_suffix)
         if args.pseudoreps is not None:
             pseudoreps=[pyBigWig.open(rep) for rep in args.pseudoreps]
         else:
@@ -4,6 +4,7 @@ from __future__ import print_function
 import argparse
 import warnings
 import pandas as pd
+from ..prediction_store import *
 from .classification_performance_metrics import *
 from .regression_performance_metrics import *
 from .profile_performance_metrics import *
@@ -53,8 +54,8 @@ def metrics_from_pickle(cur_pickle,tasks,args):
         return metrics_function(model_predictions,labels)
 
 def metrics_from_hdf(cur_labels, cur_predictions, tasks,args):
-    cur_labels=pd.read_hdf(cur_labels)[tasks]
-    cur_predictions=pd.read_hdf(cur_predictions)[tasks]
+    cur_labels=read_prediction_table(cur_labels,columns=tasks)
+    cur_predictions=read_prediction_table(cur_predictions,columns=tasks)
     #make sure they are ordered
     cur_labels=cur_labels.loc[cur_predictions.index]
     metrics_function=get_metrics_function(args)
@@ -6,6 +6,7 @@ import pysam
 import argparse
 import pyBigWig
 import matplotlib.pyplot as plt
+from .util import one_hot_encode
 
 def parse_args():
     parser=argparse.ArgumentParser(description="generate plot of sequence importance scores")
@@ -23,10 +24,8 @@ def parse_args():
 def one_hot_encode_sequence(chrom,start,end,ref):    
     num_generated=0
     ref=pysam.FastaFile(ref)
-    ltrdict = {'a':[1,0,0,0],'c':[0,1,0,0],'g':[0,0,1,0],'t':[0,0,0,1], 'n':[0,0,0,0],'A':[1,0,0,0],'C':[0,1,0,0],'G':[0,0,1,0],'T':[0,0,0,1],'N':[0,0,0,0]}
     seq=ref.fetch(chrom,start,end)
-    seq=np.array([ltrdict.get(x,[0,0,0,0]) for x in seq])
-    return seq
+    return one_hot_encode(seq)[0]
 
 def plot_seq_importance(scores, data, ylim=None, figsize=(25, 3),outf=None,tick_interval=5):
     seq_len = data.shape[0]
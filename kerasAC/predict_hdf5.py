@@ -23,8 +23,11 @@ from kerasAC.activations import softMaxAxis1
 from .calibrate import * 
 from .generators.basic_generator import *
 from .generators.tiledb_predict_generator import *
+from .generators.prefetch import *
 from .tiledb_config import *
 from .s3_sync import *
+from .prediction_store import *
+from .prediction_writer import *
 from .splits import *
 from .get_model import *
 from .custom_losses import * 
@@ -66,6 +69,7 @@ def parse_args():
     
     output_params=parser.add_argument_group("output_params")
     output_params.add_argument('--predictions_and_labels_hdf5',help='name of hdf5 to save predictions',default=None)
+    output_params.add_argument('--output_format',choices=['table','columnar'],default='table',help="table: pandas table-format hdf5 appended per batch; columnar: chunked, compressed h5py datasets of values and coordinates, faster to write for wide (i.e. profile) outputs")
     calibration_params=parser.add_argument_group("calibration_params")
     calibration_params.add_argument("--calibrate_classification",action="store_true",default=False)
     calibration_params.add_argument("--calibrate_regression",action="store_true",default=False)        
@@ -89,8 +93,10 @@ def parse_args():
     model_params.add_argument("--num_gpus",type=int,default=1)
     
     parallelization_params=parser.add_argument_group("parallelization")
-    parallelization_params.add_argument("--threads",type=int,default=1)
-    parallelization_params.add_argument("--max_queue_size",type=int,default=100)
+    parallelization_params.add_argument("--threads",type=int,default=1,help="number of persistent worker processes building batches")
+    parallelization_params.add_argument("--max_queue_size",type=int,default=100,help="upper bound on the number of batches built ahead of the model")
+    parallelization_params.add_argument("--prefetch_depth",type=int,default=0,help="number of batches the workers build ahead of the model, in shared-memory slots; 0 uses min(max_queue_size, 2*threads). at most prefetch_depth workers are used")
+    parallelization_params.add_argument("--writer_queue_size",type=int,default=16,help="number of batches that can wait for each output writer before inference blocks")
 
     snp_params=parser.add_argument_group("snp_params")
     snp_params.add_argument('--background_freqs',default=None)
@@ -100,6 +106,7 @@ def parse_args():
     snp_params.add_argument('--alt_col',type=int,default=None)
 
     parser.add_argument('--batch_size',type=int,help='batch size to use to make model predictions',default=50)
+    parser.add_argument('--positional_gathers',action='store_true',help='align all tables to the index rows at startup and gather batches by row id; fails at startup on duplicate or missing coordinates. always on for label stores')
     return parser.parse_args()
 
 def get_out_predictions_prefix(args):
@@ -134,18 +141,25 @@ def get_out_labels_prefix(args):
         out_labels_prefix=args.predictions_and_labels_hdf5+".labels" 
     return out_labels_prefix
 
-def write_predictions(args):
+def write_predictions(args,pred_queue):
     '''
-    separate predictions file for each output/task combination 
+    separate predictions file for each output/task combination; run in a WriterProcess, returns the writer-side metrics
     '''
     try:
         out_predictions_prefix=get_out_predictions_prefix(args)
         first=True
+        #columnar writers, by output file
+        writers={}
+        num_batches=0
+        write_seconds=0
         while True:
-            pred_df=pred_queue.get()
-            if type(pred_df) == str: 
-                if pred_df=="FINISHED":
-                    return
+            #raw per-output arrays and the CoordBlock of the batch
+            pred_block=pred_queue.get()
+            if type(pred_block) == str: 
+                if pred_block=="FINISHED":
+                    for writer in writers.values():
+                        writer.close()
+                    return {'batches_written':num_batches,'write_seconds':write_seconds}
             if first is True:
                 mode='w'
                 first=False
@@ -153,11 +167,21 @@ def write_predictions(args):
             else:
                 mode='a'
                 append=True
-            for cur_output_index in range(len(pred_df)):
-                #get cur_pred_df for current output
-                cur_pred_df=pred_df[cur_output_index]
+            coord_block,pred_arrays=pred_block
+            start=time.time()
+            for cur_output_index in range(len(pred_arrays)):
+                #get cur_preds for current output
+                cur_preds=pred_arrays[cur_output_index]
                 cur_out_f='.'.join([out_predictions_prefix,str(cur_output_index)])
-                cur_pred_df.to_hdf(cur_out_f,key="data",mode=mode,append=append,format="table",min_itemsize={'CHR':30})
+                if args.output_format=='columnar':
+                    if cur_out_f not in writers:
+                        writers[cur_out_f]=ColumnarPredictionWriter(cur_out_f)
+                    writers[cur_out_f].append_block(cur_preds,coord_block)
+                else:
+                    #the index is built once per batch, in the writer process
+                    coord_block.to_dataframe(cur_preds).to_hdf(cur_out_f,key="data",mode=mode,append=append,format="table",min_itemsize={'CHR':30})
+            num_batches+=1
+            write_seconds+=time.time()-start
                 
     except KeyboardInterrupt:
         #shutdown the pool
@@ -171,18 +195,25 @@ def write_predictions(args):
         kill_child_processes(os.getpid())
         raise e
 
-def write_labels(args):
+def write_labels(args,label_queue):
     '''
-    separate label file for each output/task combination
+    separate label file for each output/task combination; run in a WriterProcess, returns the writer-side metrics
     '''
     out_labels_prefix=get_out_labels_prefix(args)
     try:
         first=True
+        #columnar writers, by output file
+        writers={}
+        num_batches=0
+        write_seconds=0
         while True:
-            label_df=label_queue.get()
-            if type(label_df)==str:
-                if label_df=="FINISHED":
-                    return
+            #raw per-output arrays and the CoordBlock of the batch
+            label_block=label_queue.get()
+            if type(label_block)==str:
+                if label_block=="FINISHED":
+                    for writer in writers.values():
+                        writer.close()
+                    return {'batches_written':num_batches,'write_seconds':write_seconds}
             if first is True:
                 mode='w'
                 first=False
@@ -190,10 +221,20 @@ def write_labels(args):
             else:
                 mode='a'
                 append=True
-            for cur_output_index in range(len(label_df)):
-                cur_label_df=label_df[cur_output_index]
+            coord_block,label_arrays=label_block
+            start=time.time()
+            for cur_output_index in range(len(label_arrays)):
+                cur_labels=label_arrays[cur_output_index]
                 cur_out_f='.'.join([out_labels_prefix,str(cur_output_index)])
-                cur_label_df.to_hdf(cur_out_f,key="data",mode=mode,append=append,format="table",min_itemsize={'CHR':30})
+                if args.output_format=='columnar':
+                    if cur_out_f not in writers:
+                        writers[cur_out_f]=ColumnarPredictionWriter(cur_out_f)
+                    writers[cur_out_f].append_block(cur_labels,coord_block)
+                else:
+                    #the index is built once per batch, in the writer process
+                    coord_block.to_dataframe(cur_labels).to_hdf(cur_out_f,key="data",mode=mode,append=append,format="table",min_itemsize={'CHR':30})
+            num_batches+=1
+            write_seconds+=time.time()-start
                 
     except KeyboardInterrupt:
         #shutdown the pool
@@ -213,7 +254,7 @@ def init_worker():
 
 def kill_child_processes(parent_pid, sig=signal.SIGTERM):
     try:
-        parent = mp.Process(parent_pid)
+        parent = psutil.Process(parent_pid)
     except psutil.NoSuchProcess:
         return
     children = parent.children(recursive=True)
@@ -222,21 +263,28 @@ def kill_child_processes(parent_pid, sig=signal.SIGTERM):
         
 
 
-def get_batch_wrapper(idx):
-    X,y,coords=test_generator[idx]
+def get_batch_wrapper(idx,batch_source=None):
+    '''
+    batch_source -- SharedMemoryPrefetcher to take the batch from; defaults to building it with test_generator
+    '''
+    if batch_source is None:
+        X,y,coords=test_generator[idx]
+    else:
+        X,y,coords=batch_source[idx]
     if type(y) is not list:
         y=[y]
     try:
         y=[i.squeeze(axis=-1) for i in y]
     except:
         pass
+    if batch_source is not None:
+        #prefetched arrays are views of a shared-memory slot that is reused by later batches; the labels outlive it in the writer queue
+        y=[np.array(i) for i in y]
     if type(X) is not list:
         X=[X]
     
-    #represent coords w/ string, MultiIndex not supported in table append mode
-    #set the column names for the MultiIndex
-    coords=pd.MultiIndex.from_tuples(coords,names=['CHR','START','END'])
-    y=[pd.DataFrame(i,index=coords) for i in y]
+    #(chrom,start,end) tuples are passed on as a CoordBlock of chromosome codes and int64 starts/ends
+    coords=coord_block_from_tuples(coords,index_names=['CHR','START','END'])
     return [X,y,coords,idx]
 
 
@@ -256,6 +304,7 @@ def get_hdf5_predict_generator(args):
                                  expand_dims=args.expand_dims,
                                  tasks=args.tasks,
                                  shuffle=False,
+                                 positional_gathers=args.positional_gathers,
                                  return_coords=True)
     return test_generator
 def get_variant_predict_generator(args):
@@ -286,53 +335,45 @@ def get_generator(args):
     else:
         return get_hdf5_predict_generator(args)
 
-def predict_on_batch_wrapper(args,model,test_generator):
+def get_batch_source(args,test_generator):
+    '''
+    persistent worker processes (args.threads) build batches continuously into a bounded ring of shared-memory slots while the model runs;
+    batches are handed back in index order, so predictions and labels are written in the order of the index
+    '''
+    prefetch_depth=args.prefetch_depth
+    if (prefetch_depth is None) or (prefetch_depth<1):
+        prefetch_depth=min(args.max_queue_size,2*args.threads)
+    #short generators cap the depth, and with it the number of workers that can be busy
+    prefetch_depth=max(1,min(prefetch_depth,len(test_generator)))
+    batch_source=SharedMemoryPrefetcher(test_generator,prefetch_depth,args.threads)
+    print("prefetching "+str(prefetch_depth)+" batches with "+str(batch_source.num_workers)+" worker processes")
+    return batch_source
+
+def predict_on_batch_wrapper(args,model,test_generator,batch_source):
     num_batches=len(test_generator)
-    processed=0
     try:
-        with mp.Pool(processes=args.threads,initializer=init_worker) as pool: 
-            while (processed < num_batches):
-                idset=range(processed,min([num_batches,processed+args.max_queue_size]))
-                for result in pool.imap_unordered(get_batch_wrapper,idset):
-                    X=result[0]
-                    y=result[1]
-                    coords=result[2]
-                    idx=result[3]
-                    processed+=1
-                    if processed%10==0:
-                        print(str(processed)+"/"+str(num_batches))
-                    #get the model predictions            
-                    preds=model.predict_on_batch(X)
-                    if type(preds) is not list:
-                        preds=[preds]
-                    try:
-                        preds=[i.squeeze(axis=-1) for i in preds]
-                    except:
-                        pass 
-                    preds_dfs=[pd.DataFrame(cur_pred,index=coords) for cur_pred in preds]
-                    label_queue.put(y)
-                    pred_queue.put(preds_dfs)
-                    
-    except KeyboardInterrupt:
-        #shutdown the pool
-        pool.terminate()
-        pool.join() 
-        # Kill remaining child processes
-        kill_child_processes(os.getpid())
-        raise 
-    except Exception as e:
+        for idx in range(num_batches):
+            X,y,coords,idx=get_batch_wrapper(idx,batch_source=batch_source)
+            if idx%10==0:
+                print(str(idx)+"/"+str(num_batches))
+            #get the model predictions            
+            preds=model.predict_on_batch(X)
+            if type(preds) is not list:
+                preds=[preds]
+            try:
+                preds=[i.squeeze(axis=-1) for i in preds]
+            except:
+                pass 
+            #raw arrays and compact coordinates go to the writers; no DataFrames are built in the inference loop
+            label_writer.put((coords,y))
+            pred_writer.put((coords,preds))
+    except BaseException as e:
         print(e)
-        #shutdown the pool
-        pool.terminate()
-        pool.join()
-        # Kill remaining child processes
-        kill_child_processes(os.getpid())
-        raise e
-    print("finished with tiledb predictions!")
-    label_queue.put("FINISHED")
-    label_queue.close() 
-    pred_queue.put("FINISHED")
-    pred_queue.close() 
+        #stop the batch workers without waiting on in-flight batches
+        batch_source.cancel()
+        raise
+    batch_source.close()
+    print("finished with hdf5 predictions!")
     return
 
 
@@ -349,20 +390,18 @@ def get_layer_outputs(functor,X):
 def predict(args):
     if type(args)==type({}):
         args=args_object_from_args_dict(args) 
-    global pred_queue
-    global label_queue
+    global pred_writer
+    global label_writer
     
-    pred_queue=mp.Queue()
-    label_queue=mp.Queue()
-    
-    label_writer=mp.Process(target=write_predictions,args=([args]))
-    pred_writer=mp.Process(target=write_labels,args=([args]))
-    label_writer.start()
-    pred_writer.start() 
+    #bounded writer queues: inference blocks when writes fall behind, instead of buffering batches without limit
+    pred_writer=WriterProcess(write_predictions,args,"predictions",max_queue_size=args.writer_queue_size)
+    label_writer=WriterProcess(write_labels,args,"labels",max_queue_size=args.writer_queue_size)
 
 
     #get the generator
     test_generator=get_generator(args) 
+    #start the batch workers before the model is loaded, so they are forked without tensorflow state
+    batch_source=get_batch_source(args,test_generator)
     
     #get the model
     #if calibration is to be done, get the preactivation model 
@@ -379,26 +418,19 @@ def predict(args):
                         outputs=model.layers[-1].output)
             
     #call the predict_on_batch_wrapper
-    predict_on_batch_wrapper(args,model,test_generator)
-
-    #drain the queue
     try:
-        while not label_queue.empty():
-            print("draining the label Queue")
-            time.sleep(2)
-    except Exception as e:
-        print(e)
-    try:
-        while not pred_queue.empty():
-            print("draining the prediction Queue")
-            time.sleep(2)
-    except Exception as e:
-        print(e)
-    
-    print("joining label writer") 
-    label_writer.join()
-    print("joining prediction writer") 
-    pred_writer.join()
+        predict_on_batch_wrapper(args,model,test_generator,batch_source)
+    except BaseException:
+        #stop the writers rather than leave them blocked on their queues
+        label_writer.cancel()
+        pred_writer.cancel()
+        raise
+
+    #wait for the writers to finish; raises if either of them failed
+    print("waiting for the label writer")
+    label_writer.finish()
+    print("waiting for the prediction writer")
+    pred_writer.finish()
 
     #sync files to s3 if needed
     if args.predictions_and_labels_hdf5.startswith('s3://'):
@@ -18,8 +18,12 @@ from kerasAC.activations import softMaxAxis1
 from .calibrate import * 
 from .generators.basic_generator import *
 from .generators.tiledb_predict_generator import *
+from .generators.prefetch import *
 from .tiledb_config import *
 from .s3_sync import *
+from .prediction_store import *
+from .prediction_writer import *
+from .track_writer import *
 from .get_model import *
 from .splits import *
 from kerasAC.config import args_object_from_args_dict
@@ -68,7 +72,16 @@ def parse_args():
     tiledbgroup.add_argument("--tdb_bias_pseudocount",type=float,default=0.001)
     tiledbgroup.add_argument("--chrom_sizes",default=None,help="chromsizes file for use with tiledb generator")
     tiledbgroup.add_argument("--tiledb_stride",type=int,default=1)
+    tiledbgroup.add_argument("--bed_regions",default=None,help="BED file of regions to predict on with --tiledb_stride, instead of the whole test chromosomes")
+    tiledbgroup.add_argument("--skip_ambig",action="store_true",default=False,help="skip positions whose input/output windows contain an N in the reference")
+    tiledbgroup.add_argument("--num_shards",type=int,default=1,help="split the planned batches into this many contiguous shards")
+    tiledbgroup.add_argument("--shard_index",type=int,default=0,help="shard of the planned batches to predict on, in [0, num_shards)")
+    tiledbgroup.add_argument("--tile_length",type=int,default=None,help="tile each chromosome with windows of this length instead of walking it with --tiledb_stride; defaults to the output window (2*tdb_output_flank) with --output_tracks_prefix")
+    tiledbgroup.add_argument("--tile_overlap",type=int,default=0,help="number of bases by which consecutive tiles overlap; overlapping predictions are averaged in the output tracks")
     tiledbgroup.add_argument("--upsample_threads",type=int,default=1)
+    tiledbgroup.add_argument("--upsample_cache_dir",default=None,help="directory to cache tiledb upsampled indices in, defaults to ~/.cache/kerasAC/upsampled_indices")
+    tiledbgroup.add_argument("--onehot_dtype",default="float32",help="dtype of one-hot encoded sequence batches, i.e. uint8, float16, float32")
+    tiledbgroup.add_argument("--vals_dtype",default="float32",help="dtype of track value batches, i.e. float16, float32")
     
     input_filtering_params=parser.add_argument_group("input_filtering_params")    
     input_filtering_params.add_argument('--predict_chroms',nargs="*",default=None)
@@ -81,6 +94,9 @@ def parse_args():
     
     output_params=parser.add_argument_group("output_params")
     output_params.add_argument('--predictions_and_labels_hdf5',help='name of hdf5 to save predictions',default=None)
+    output_params.add_argument('--output_tracks_prefix',default=None,help="stream tiled predictions into one genome track per output and task, <prefix>.output<i>.task<j>.bw, instead of writing predictions/labels hdf5 files")
+    output_params.add_argument('--track_format',choices=['bigwig','bedgraph'],default='bigwig')
+    output_params.add_argument('--output_format',choices=['table','columnar'],default='table',help="table: pandas table-format hdf5 appended per batch; columnar: chunked, compressed h5py datasets of values and coordinates, faster to write for wide (i.e. profile) outputs")
     calibration_params=parser.add_argument_group("calibration_params")
     calibration_params.add_argument("--calibrate_classification",action="store_true",default=False)
     calibration_params.add_argument("--calibrate_regression",action="store_true",default=False)        
@@ -111,11 +127,15 @@ def parse_args():
     snp_params.add_argument('--alt_col',type=int,default=None)
 
     parser.add_argument('--batch_size',type=int,help='batch size to use to make model predictions',default=50)
+    parallelization_params=parser.add_argument_group("parallelization")
+    parallelization_params.add_argument("--prefetch_depth",type=int,default=0,help="number of batches built ahead of the model by worker processes, in shared-memory slots; 0 builds each batch in sequence with the model. at most prefetch_depth workers are used")
+    parallelization_params.add_argument("--prefetch_workers",type=int,default=1,help="number of prefetch worker processes")
+    parallelization_params.add_argument("--writer_queue_size",type=int,default=16,help="number of batches that can wait for each output writer before inference blocks")
     return parser.parse_args()
 
-def write_predictions(args):
+def write_predictions(args,pred_queue):
     '''
-    separate predictions file for each output/task combination 
+    separate predictions file for each output/task combination; run in a WriterProcess, returns the writer-side metrics
     '''
     try:
         if args.predictions_and_labels_hdf5.startswith('s3://'):
@@ -125,11 +145,18 @@ def write_predictions(args):
         else: 
             out_predictions_prefix=args.predictions_and_labels_hdf5+".predictions"
         first=True
+        #columnar writers, by output file
+        writers={}
+        num_batches=0
+        write_seconds=0
         while True:
-            pred_df=pred_queue.get()
-            if type(pred_df) == str: 
-                if pred_df=="FINISHED":
-                    return
+            #raw per-output arrays and the CoordBlock of the batch
+            pred_block=pred_queue.get()
+            if type(pred_block) == str: 
+                if pred_block=="FINISHED":
+                    for writer in writers.values():
+                        writer.close()
+                    return {'batches_written':num_batches,'write_seconds':write_seconds}
             if first is True:
                 mode='w'
                 first=False
@@ -137,11 +164,21 @@ def write_predictions(args):
             else:
                 mode='a'
                 append=True
-            for cur_output_index in range(len(pred_df)):
-                #get cur_pred_df for current output
-                cur_pred_df=pred_df[cur_output_index]
+            coord_block,pred_arrays=pred_block
+            start=time.time()
+            for cur_output_index in range(len(pred_arrays)):
+                #get cur_preds for current output
+                cur_preds=pred_arrays[cur_output_index]
                 cur_out_f='.'.join([out_predictions_prefix,str(cur_output_index)])
-                cur_pred_df.to_hdf(cur_out_f,key="data",mode=mode,append=append,format="table",min_itemsize={'CHR':30})
+                if args.output_format=='columnar':
+                    if cur_out_f not in writers:
+                        writers[cur_out_f]=ColumnarPredictionWriter(cur_out_f)
+                    writers[cur_out_f].append_block(cur_preds,coord_block)
+                else:
+                    #the index is built once per batch, in the writer process
+                    coord_block.to_dataframe(cur_preds).to_hdf(cur_out_f,key="data",mode=mode,append=append,format="table",min_itemsize={'CHR':30})
+            num_batches+=1
+            write_seconds+=time.time()-start
                 
     except KeyboardInterrupt:
         #shutdown the pool
@@ -155,9 +192,9 @@ def write_predictions(args):
         kill_child_processes(os.getpid())
         raise e
 
-def write_labels(args):
+def write_labels(args,label_queue):
     '''
-    separate label file for each output/task combination
+    separate label file for each output/task combination; run in a WriterProcess, returns the writer-side metrics
     '''
     try:
         if args.predictions_and_labels_hdf5.startswith('s3://'):
@@ -167,11 +204,18 @@ def write_labels(args):
         else: 
             out_labels_prefix=args.predictions_and_labels_hdf5+".labels" 
         first=True
+        #columnar writers, by output file
+        writers={}
+        num_batches=0
+        write_seconds=0
         while True:
-            label_df=label_queue.get()
-            if type(label_df)==str:
-                if label_df=="FINISHED":
-                    return
+            #raw per-output arrays and the CoordBlock of the batch
+            label_block=label_queue.get()
+            if type(label_block)==str:
+                if label_block=="FINISHED":
+                    for writer in writers.values():
+                        writer.close()
+                    return {'batches_written':num_batches,'write_seconds':write_seconds}
             if first is True:
                 mode='w'
                 first=False
@@ -179,10 +223,20 @@ def write_labels(args):
             else:
                 mode='a'
                 append=True
-            for cur_output_index in range(len(label_df)):
-                cur_label_df=label_df[cur_output_index]
+            coord_block,label_arrays=label_block
+            start=time.time()
+            for cur_output_index in range(len(label_arrays)):
+                cur_labels=label_arrays[cur_output_index]
                 cur_out_f='.'.join([out_labels_prefix,str(cur_output_index)])
-                cur_label_df.to_hdf(cur_out_f,key="data",mode=mode,append=append,format="table",min_itemsize={'CHR':30})
+                if args.output_format=='columnar':
+                    if cur_out_f not in writers:
+                        writers[cur_out_f]=ColumnarPredictionWriter(cur_out_f)
+                    writers[cur_out_f].append_block(cur_labels,coord_block)
+                else:
+                    #the index is built once per batch, in the writer process
+                    coord_block.to_dataframe(cur_labels).to_hdf(cur_out_f,key="data",mode=mode,append=append,format="table",min_itemsize={'CHR':30})
+            num_batches+=1
+            write_seconds+=time.time()-start
                 
     except KeyboardInterrupt:
         #shutdown the pool
@@ -197,6 +251,27 @@ def write_labels(args):
         raise e
     return
 
+def write_tracks(track_args,pred_queue):
+    '''
+    stitch the predictions of the tiles into genome tracks; run in a WriterProcess, returns the writer-side metrics
+    track_args -- (args, list of (chrom, size) in the order of the tiles)
+    '''
+    args,chrom_sizes=track_args
+    stitcher=TrackStitcher(args.output_tracks_prefix,chrom_sizes,args.tile_length,track_format=args.track_format)
+    num_batches=0
+    write_seconds=0
+    while True:
+        pred_block=pred_queue.get()
+        if type(pred_block)==str:
+            if pred_block=="FINISHED":
+                stitcher.close()
+                return {'batches_written':num_batches,'write_seconds':write_seconds}
+        coord_block,pred_arrays=pred_block
+        start=time.time()
+        stitcher.add_batch(coord_block.chrom_names[coord_block.chrom_codes],coord_block.positions[0],pred_arrays)
+        num_batches+=1
+        write_seconds+=time.time()-start
+
 def init_worker():
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
@@ -209,21 +284,32 @@ def kill_child_processes(parent_pid, sig=signal.SIGTERM):
     for process in children:
         process.send_signal(sig)
         
-def get_batch_wrapper(idx):
-    X,y,coords=test_generator[idx]
+def get_batch_wrapper(idx,batch_source=None):
+    '''
+    batch_source -- SharedMemoryPrefetcher to take the batch from; defaults to building it with test_generator
+    '''
+    if batch_source is None:
+        X,y,coords=test_generator[idx]
+    else:
+        X,y,coords=batch_source[idx]
     if type(y) is not list:
         y=[y]
     try:
         y=[i.squeeze(axis=-1) for i in y]
     except:
         pass
+    if batch_source is not None:
+        #prefetched arrays are views of a shared-memory slot that is reused by later batches; the labels outlive it in the writer queue
+        y=[np.array(i) for i in y]
     if type(X) is not list:
         X=[X]
     
-    #represent coords w/ string, MultiIndex not supported in table append mode
-    #set the column names for the MultiIndex
-    coords=pd.MultiIndex.from_tuples(coords,names=['CHR','CENTER'])
-    y=[pd.DataFrame(i,index=coords) for i in y]
+    #coords are (chrom_codes, positions) arrays, passed on as a CoordBlock; the chromosome names are decoded when the index is built
+    chrom_codes,positions=coords
+    if batch_source is not None:
+        chrom_codes=np.array(chrom_codes)
+        positions=np.array(positions)
+    coords=CoordBlock(['CHR','CENTER'],test_generator.chrom_names,chrom_codes,[positions])
     return X,y,coords
 
 
@@ -245,6 +331,9 @@ def get_tiledb_predict_generator(args):
                                           tdb_partition_thresh_for_upsample=args.tdb_partition_thresh_for_upsample,
                                           upsample_ratio=upsample_ratio_predict,
                                           num_threads=args.upsample_threads,
+                                          upsample_cache_dir=args.upsample_cache_dir,
+                                          onehot_dtype=args.onehot_dtype,
+                                          vals_dtype=args.vals_dtype,
                                           tdb_ambig_attribute=args.tdb_ambig_attribute,
                                           tdb_bias_arrays=args.tdb_bias_arrays,
                                           tdb_bias_source_attribute=args.tdb_bias_source_attribute,
@@ -264,6 +353,12 @@ def get_tiledb_predict_generator(args):
                                           tdb_output_aggregation=args.tdb_output_aggregation,
                                           tdb_output_transformation=args.tdb_output_transformation,                                          
                                           tiledb_stride=args.tiledb_stride,
+                                          bed_regions=args.bed_regions,
+                                          skip_ambig=args.skip_ambig,
+                                          num_shards=args.num_shards,
+                                          shard_index=args.shard_index,
+                                          tile_length=args.tile_length,
+                                          tile_overlap=args.tile_overlap,
                                           chrom_sizes=args.chrom_sizes,
                                           chroms=test_chroms,
                                           tasks=args.tasks,
@@ -273,28 +368,48 @@ def get_tiledb_predict_generator(args):
     print("created TiledbPredictGenerator")    
     return test_generator 
 
-def predict_on_batch_wrapper(args,model,test_generator):
+def get_batch_source(args,test_generator):
+    '''
+    with args.prefetch_depth>0, worker processes build the next prefetch_depth batches (tiledb reads, sequence encoding) while the model runs on the current one;
+    the prefetcher has a bounded ring of slots and hands the batches back in index order
+    '''
+    prefetch_depth=getattr(args,'prefetch_depth',0)
+    if (prefetch_depth is None) or (prefetch_depth<1):
+        return None
+    prefetch_workers=getattr(args,'prefetch_workers',None)
+    if prefetch_workers is None:
+        prefetch_workers=1
+    batch_source=SharedMemoryPrefetcher(test_generator,prefetch_depth,prefetch_workers)
+    print("prefetching "+str(prefetch_depth)+" batches with "+str(batch_source.num_workers)+" worker processes")
+    return batch_source
+
+def predict_on_batch_wrapper(args,model,test_generator,batch_source=None):
     num_batches=len(test_generator)
-    for idx in range(num_batches):
-        if idx%100==0:
-            print(str(idx)+'/'+str(num_batches))
-        X,y,coords=get_batch_wrapper(idx)
-        #get the model predictions            
-        preds=model.predict_on_batch(X)
-        if type(preds) is not list:
-            preds=[preds]
-        try:
-            preds=[i.squeeze(axis=-1) for i in preds]
-        except:
-            pass 
-        preds_dfs=[pd.DataFrame(cur_pred,index=coords) for cur_pred in preds]
-        label_queue.put(y)
-        pred_queue.put(preds_dfs)
+    try:
+        for idx in range(num_batches):
+            if idx%100==0:
+                print(str(idx)+'/'+str(num_batches))
+            X,y,coords=get_batch_wrapper(idx,batch_source=batch_source)
+            #get the model predictions            
+            preds=model.predict_on_batch(X)
+            if type(preds) is not list:
+                preds=[preds]
+            try:
+                preds=[i.squeeze(axis=-1) for i in preds]
+            except:
+                pass 
+            #raw arrays and compact coordinates go to the writers; no DataFrames are built in the inference loop
+            if label_writer is not None:
+                label_writer.put((coords,y))
+            pred_writer.put((coords,preds))
+    except BaseException:
+        #stop the batch workers without waiting on in-flight batches
+        if batch_source is not None:
+            batch_source.cancel()
+        raise
+    if batch_source is not None:
+        batch_source.close()
     print("finished with tiledb predictions!")
-    label_queue.put("FINISHED")
-    label_queue.close() 
-    pred_queue.put("FINISHED")
-    pred_queue.close() 
     return
 
 def get_model_layer_functor(model,target_layer_idx):
@@ -310,20 +425,25 @@ def get_layer_outputs(functor,X):
 def predict(args):
     if type(args)==type({}):
         args=args_object_from_args_dict(args) 
-    global pred_queue
-    global label_queue
-    
-    pred_queue=Queue()
-    label_queue=Queue()
-    
-    label_writer=Process(target=write_predictions,args=([args]))
-    pred_writer=Process(target=write_labels,args=([args]))
-    label_writer.start()
-    pred_writer.start() 
-
+    global pred_writer
+    global label_writer
+    if (args.output_tracks_prefix is not None) and (args.tile_length is None):
+        #tile with the output window of the model
+        args.tile_length=2*int(args.tdb_output_flank[0])
 
     #get the generator
     test_generator=get_tiledb_predict_generator(args) 
+
+    #bounded writer queues: inference blocks when writes fall behind, instead of buffering batches without limit
+    if args.output_tracks_prefix is not None:
+        #predictions are stitched into genome tracks; labels are not written
+        pred_writer=WriterProcess(write_tracks,(args,test_generator.get_chrom_sizes()),"tracks",max_queue_size=args.writer_queue_size)
+        label_writer=None
+    else:
+        pred_writer=WriterProcess(write_predictions,args,"predictions",max_queue_size=args.writer_queue_size)
+        label_writer=WriterProcess(write_labels,args,"labels",max_queue_size=args.writer_queue_size)
+    #start any prefetch workers before the model is loaded, so they are forked without tensorflow state
+    batch_source=get_batch_source(args,test_generator)
     
     #get the model
     #if calibration is to be done, get the preactivation model 
@@ -340,29 +460,24 @@ def predict(args):
                         outputs=model.layers[-1].output)
             
     #call the predict_on_batch_wrapper
-    predict_on_batch_wrapper(args,model,test_generator)
-
-    #drain the queue
     try:
-        while not label_queue.empty():
-            print("draining the label Queue")
-            time.sleep(2)
-    except Exception as e:
-        print(e)
-    try:
-        while not pred_queue.empty():
-            print("draining the prediction Queue")
-            time.sleep(2)
-    except Exception as e:
-        print(e)
-    
-    print("joining label writer") 
-    label_writer.join()
-    print("joining prediction writer") 
-    pred_writer.join()
+        predict_on_batch_wrapper(args,model,test_generator,batch_source=batch_source)
+    except BaseException:
+        #stop the writers rather than leave them blocked on their queues
+        if label_writer is not None:
+            label_writer.cancel()
+        pred_writer.cancel()
+        raise
+
+    #wait for the writers to finish; raises if either of them failed
+    if label_writer is not None:
+        print("waiting for the label writer")
+        label_writer.finish()
+    print("waiting for the prediction writer")
+    pred_writer.finish()
 
     #sync files to s3 if needed
-    if args.predictions_and_labels_hdf5.startswith('s3://'):
+    if (args.predictions_and_labels_hdf5 is not None) and args.predictions_and_labels_hdf5.startswith('s3://'):
         #use a local version of the file and upload to s3 when finished
         out_predictions_prefix=args.predictions_and_labels_hdf5+".predictions"
         out_labels_prefix=args.predictions_and_labels_hdf5+".labels"
@@ -0,0 +1,182 @@
+#columnar prediction/label output for the predict tools.
+#each output file is an hdf5 file holding a chunked, compressed (num_rows, num_columns) 'values' dataset and one dataset per
+#coordinate level under 'coords' (chromosomes as integer codes, with the names in an attribute); the datasets are preallocated
+#and grown geometrically as batches are appended, then trimmed to the number of rows written when the file is closed.
+#read_prediction_table reads these files and the pandas table-format files alike, so scoring and calibration accept either.
+#the predict tools send each batch to the writers as raw arrays plus a CoordBlock (chromosome codes and int64 positions),
+#so no index or DataFrame is built in the inference loop; the index is only built when the file is read.
+import json
+import h5py
+import numpy as np
+import pandas as pd
+
+COLUMNAR_FORMAT='kerasAC_columnar'
+
+def is_columnar_predictions(path):
+    try:
+        with h5py.File(path,'r') as f:
+            return f.attrs.get('format')==COLUMNAR_FORMAT
+    except (OSError,IOError):
+        return False
+
+class CoordBlock(object):
+    def __init__(self,index_names,chrom_names,chrom_codes,positions):
+        '''
+        compact coordinates of a batch, sent to the writers in place of a MultiIndex
+        index_names -- names of the index levels, i.e. ['CHR','CENTER'] or ['CHR','START','END']; CHR comes first
+        chrom_names -- array of chromosome names
+        chrom_codes -- (num_rows,) integer codes into chrom_names
+        positions -- list of (num_rows,) int64 arrays, one per remaining index level
+        '''
+        self.index_names=list(index_names)
+        self.chrom_names=np.asarray(chrom_names)
+        self.chrom_codes=np.asarray(chrom_codes)
+        self.positions=[np.asarray(i,dtype=np.int64) for i in positions]
+        self.index=None
+
+    def __len__(self):
+        return self.chrom_codes.shape[0]
+
+    def get_index(self):
+        #built once per batch, on first use
+        if self.index is None:
+            self.index=pd.MultiIndex.from_arrays([self.chrom_names[self.chrom_codes]]+self.positions,names=self.index_names)
+        return self.index
+
+    def to_dataframe(self,values):
+        return pd.DataFrame(get_2d_values(values),index=self.get_index())
+
+def coord_block_from_tuples(coords,index_names=['CHR','START','END']):
+    #i.e. the (chrom,start,end) tuples returned by DataGenerator
+    levels=list(zip(*coords))
+    chrom_names,chrom_codes=np.unique(np.asarray(levels[0]).astype(str),return_inverse=True)
+    return CoordBlock(index_names,chrom_names,chrom_codes,levels[1:])
+
+def coord_block_from_index(index):
+    chrom_names,chrom_codes=np.unique(np.asarray(index.get_level_values(0)).astype(str),return_inverse=True)
+    return CoordBlock([str(i) for i in index.names],chrom_names,chrom_codes,[index.get_level_values(i) for i in range(1,index.nlevels)])
+
+def get_2d_values(values):
+    #single-task outputs squeezed to (num_rows,) are written as one column
+    values=np.asarray(values)
+    if values.ndim==1:
+        values=values[:,None]
+    return values
+
+class ColumnarPredictionWriter(object):
+    def __init__(self,path,initial_rows=100000,chunk_bytes=2**20,compression='lzf'):
+        '''
+        path -- output hdf5 file, overwritten if it exists
+        initial_rows -- rows preallocated for the first batch; capacity doubles whenever it runs out
+        chunk_bytes -- approximate size of a 'values' chunk; chunks span whole rows
+        compression -- h5py compression filter, i.e. 'lzf' or 'gzip'
+        '''
+        self.path=path
+        self.initial_rows=initial_rows
+        self.chunk_bytes=chunk_bytes
+        self.compression=compression
+        self.f=h5py.File(path,'w')
+        self.f.attrs['format']=COLUMNAR_FORMAT
+        self.num_rows=0
+        self.capacity=0
+        self.values=None
+        self.coords=None
+        self.chrom_codes={}
+
+    def create_datasets(self,values,coord_block,columns):
+        row_shape=values.shape[1:]
+        chunk_rows=max(1,min(self.initial_rows,self.chunk_bytes//max(1,int(np.prod(row_shape))*values.dtype.itemsize)))
+        self.capacity=max(self.initial_rows,values.shape[0])
+        self.values=self.f.create_dataset('values',shape=(self.capacity,)+row_shape,maxshape=(None,)+row_shape,dtype=values.dtype,
+                                          chunks=(chunk_rows,)+row_shape,compression=self.compression,shuffle=True)
+        self.index_names=coord_block.index_names
+        self.coords=[]
+        for name in self.index_names:
+            dtype=np.int32 if name=='CHR' else np.int64
+            self.coords.append(self.f.create_dataset('coords/'+name,shape=(self.capacity,),maxshape=(None,),dtype=dtype,
+                                                     chunks=(min(self.capacity,65536),),compression=self.compression))
+        if columns is None:
+            columns=list(range(values.shape[1]))
+        self.f.attrs['index_names']=json.dumps(self.index_names)
+        self.f.attrs['columns']=json.dumps([i if isinstance(i,str) else int(i) for i in columns])
+
+    def encode_chroms(self,chrom_names):
+        #map a batch's chromosome names to the file's integer codes, adding new names as they are seen
+        return np.array([self.chrom_codes.setdefault(str(name),len(self.chrom_codes)) for name in chrom_names],dtype=np.int32)
+
+    def resize(self,num_rows):
+        while self.capacity<num_rows:
+            self.capacity*=2
+        self.values.resize(self.capacity,axis=0)
+        for dataset in self.coords:
+            dataset.resize((self.capacity,))
+
+    def append_block(self,values,coord_block,columns=None):
+        '''
+        append a batch of values (num_rows, ...) with its CoordBlock
+        columns -- column names, written with the first batch; defaults to 0..num_columns-1
+        '''
+        values=get_2d_values(values)
+        if self.values is None:
+            self.create_datasets(values,coord_block,columns)
+        start=self.num_rows
+        end=start+values.shape[0]
+        if end>self.capacity:
+            self.resize(end)
+        self.values[start:end]=values
+        self.coords[0][start:end]=self.encode_chroms(coord_block.chrom_names)[coord_block.chrom_codes]
+        for level_index in range(1,len(self.index_names)):
+            self.coords[level_index][start:end]=coord_block.positions[level_index-1]
+        self.num_rows=end
+
+    def append(self,df):
+        '''
+        append a batch DataFrame with a CHR/START/END or CHR/CENTER MultiIndex
+        '''
+        self.append_block(df.values,coord_block_from_index(df.index),columns=list(df.columns))
+
+    def close(self):
+        if self.values is not None:
+            self.values.resize(self.num_rows,axis=0)
+            for dataset in self.coords:
+                dataset.resize((self.num_rows,))
+            chrom_names=[None]*len(self.chrom_codes)
+            for name,code in self.chrom_codes.items():
+                chrom_names[code]=name
+            self.f.attrs['chroms']=json.dumps(chrom_names)
+        else:
+            print("warning! no rows were written to "+self.path)
+        self.f.close()
+
+def read_prediction_table(path,columns=None):
+    '''
+    read a predictions/labels file written by the predict tools as a DataFrame indexed by its coordinates;
+    accepts both columnar files and pandas table-format files
+    columns -- subset of columns to return, defaults to all
+    '''
+    if not is_columnar_predictions(path):
+        data=pd.read_hdf(path)
+        if columns is not None:
+            data=data[columns]
+        return data
+    with h5py.File(path,'r') as f:
+        if 'values' not in f:
+            #no batches were written, i.e. an empty chromosome split
+            return pd.DataFrame(columns=[] if columns is None else columns)
+        index_names=json.loads(f.attrs['index_names'])
+        all_columns=json.loads(f.attrs['columns'])
+        if columns is None:
+            column_indices=None
+            columns=all_columns
+        else:
+            column_indices=[all_columns.index(i) for i in columns]
+        values=f['values'][:]
+        if column_indices is not None:
+            values=values[:,column_indices]
+        levels=[]
+        for name in index_names:
+            level_values=f['coords/'+name][:]
+            if name=='CHR':
+                level_values=np.array(json.loads(f.attrs['chroms']))[level_values]
+            levels.append(level_values)
+    return pd.DataFrame(values,index=pd.MultiIndex.from_arrays(levels,names=index_names),columns=columns)
@@ -0,0 +1,121 @@
+#bounded writer pipeline for the predict tools.
+#each writer runs in its own process and is fed through a bounded queue, so the inference loop blocks (backpressure) instead of
+#buffering without limit when writes fall behind. The writer's outcome is delivered through a concurrent.futures.Future:
+#its return value (writer-side metrics) on success, or an exception carrying the writer's traceback on failure, which is
+#raised in the main process on the next put or on finish.
+from concurrent.futures import Future
+import multiprocessing as mp
+import queue
+import signal
+import threading
+import time
+import traceback
+
+def run_writer(target,args,item_queue,status_queue):
+    #the main process handles ctrl-c and cancels the writers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        status_queue.put(('done',target(args,item_queue)))
+    except Exception:
+        status_queue.put(('error',traceback.format_exc()))
+
+class WriterProcess(object):
+    def __init__(self,target,args,name,max_queue_size=16,timeout=10):
+        '''
+        target -- writer function called as target(args,item_queue) in the writer process; it reads items until "FINISHED" and returns a dict of metrics
+        name -- name used in errors and metrics reports, i.e. "predictions"
+        max_queue_size -- number of items (batches) that can be queued before put blocks
+        timeout -- seconds between liveness checks of the writer while blocked
+        '''
+        self.name=name
+        self.max_queue_size=max_queue_size
+        self.timeout=timeout
+        self.item_queue=mp.Queue(maxsize=max_queue_size)
+        self.status_queue=mp.Queue()
+        self.process=mp.Process(target=run_writer,args=(target,args,self.item_queue,self.status_queue))
+        self.process.daemon=True
+        self.process.start()
+        self.future=Future()
+        self.watcher=threading.Thread(target=self.watch)
+        self.watcher.daemon=True
+        self.watcher.start()
+        #queue-depth metrics, sampled at each put
+        self.num_puts=0
+        self.depth_sum=0
+        self.max_depth=0
+        self.blocked_seconds=0
+
+    def watch(self):
+        #resolve the future from the writer's status message, or fail it if the process dies without sending one
+        while True:
+            try:
+                status,result=self.status_queue.get(timeout=self.timeout)
+                break
+            except queue.Empty:
+                if not self.process.is_alive():
+                    self.future.set_exception(Exception(self.name+" writer exited with code "+str(self.process.exitcode)+" before finishing"))
+                    return
+        if status=='done':
+            self.future.set_result(result)
+        else:
+            self.future.set_exception(Exception(self.name+" writer failed:\n"+result))
+
+    def check(self):
+        #raise the writer's exception in the main process, if it has failed
+        if self.future.done() and (self.future.exception() is not None):
+            raise self.future.exception()
+
+    def get_depth(self):
+        try:
+            return self.item_queue.qsize()
+        except NotImplementedError:
+            #qsize isn't available on all platforms
+            return 0
+
+    def put(self,item):
+        '''
+        queue an item for the writer, blocking while the queue is full
+        '''
+        self.check()
+        start=time.time()
+        while True:
+            try:
+                self.item_queue.put(item,timeout=self.timeout)
+                break
+            except queue.Full:
+                self.check()
+                if self.future.done():
+                    raise Exception(self.name+" writer finished before all items were queued")
+        self.blocked_seconds+=time.time()-start
+        depth=self.get_depth()
+        self.num_puts+=1
+        self.depth_sum+=depth
+        self.max_depth=max(self.max_depth,depth)
+
+    def get_metrics(self):
+        metrics={'items':self.num_puts,
+                 'max_queue_size':self.max_queue_size,
+                 'max_queue_depth':self.max_depth,
+                 'mean_queue_depth':self.depth_sum/max(1,self.num_puts),
+                 'put_blocked_seconds':self.blocked_seconds}
+        if self.future.done() and (self.future.exception() is None) and (self.future.result() is not None):
+            metrics.update(self.future.result())
+        return metrics
+
+    def finish(self):
+        '''
+        signal the end of the items, wait for the writer to complete and return its metrics; raises if the writer failed
+        '''
+        self.put("FINISHED")
+        self.future.result()
+        self.process.join()
+        metrics=self.get_metrics()
+        print(self.name+" writer metrics: "+", ".join([key+"="+str(round(val,3) if isinstance(val,float) else val) for key,val in metrics.items()]))
+        return metrics
+
+    def cancel(self):
+        #stop the writer without waiting for the queued items
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(timeout=self.timeout)
+        self.item_queue.cancel_join_thread()
@@ -0,0 +1,180 @@
+#reference genome store for the data generators.
+#each chromosome is read from the fasta once, stored as a uint8 array of ascii bytes in a per-chromosome .npy cache file,
+#and memory-mapped, so all worker processes share the same pages and sequence windows become array slices.
+import os
+import numpy as np
+import pysam
+from .util import *
+
+N_BYTE=ord('N')
+
+class ReferenceCache(object):
+    def __init__(self,ref_fasta,chroms=None,cache_dir=None):
+        '''
+        ref_fasta -- indexed fasta file
+        chroms -- chromosomes to cache up front; other chromosomes are cached the first time they are accessed
+        cache_dir -- directory for the per-chromosome cache files, defaults to <ref_fasta>.kerasAC_cache.
+        If the directory can't be written, chromosomes are held in memory instead.
+        '''
+        self.ref_fasta=ref_fasta
+        if cache_dir is None:
+            cache_dir=ref_fasta+'.kerasAC_cache'
+        try:
+            os.makedirs(cache_dir,exist_ok=True)
+        except OSError:
+            print("warning! could not create reference cache directory:"+str(cache_dir)+", holding chromosomes in memory")
+            cache_dir=None
+        self.cache_dir=cache_dir
+        fasta=pysam.FastaFile(self.ref_fasta)
+        self.chrom_sizes=dict(zip(fasta.references,fasta.lengths))
+        fasta.close()
+        self.chrom_arrays={}
+        self.ambig_masks={}
+        if chroms is not None:
+            for chrom in chroms:
+                self.get_chrom(chrom)
+
+    def __getstate__(self):
+        #memory-maps are re-opened lazily after unpickling in a worker process
+        state=self.__dict__.copy()
+        if self.cache_dir is not None:
+            state['chrom_arrays']={}
+            state['ambig_masks']={}
+        return state
+
+    def get_cache_path(self,chrom):
+        return os.path.join(self.cache_dir,chrom+'.npy')
+
+    def get_chrom(self,chrom):
+        '''
+        returns the uint8 array of ascii bytes for a chromosome, or None if the chromosome is not in the fasta
+        '''
+        if chrom in self.chrom_arrays:
+            return self.chrom_arrays[chrom]
+        if chrom not in self.chrom_sizes:
+            self.chrom_arrays[chrom]=None
+            return None
+        if self.cache_dir is None:
+            chrom_array=self.read_chrom(chrom)
+        else:
+            cache_path=self.get_cache_path(chrom)
+            if (not os.path.exists(cache_path)) or (os.path.getmtime(cache_path)<os.path.getmtime(self.ref_fasta)):
+                print("caching reference sequence for "+chrom+" in "+cache_path)
+                #write to a temporary file first so concurrent readers never see a partial cache
+                tmp_path=cache_path+'.tmp.'+str(os.getpid())+'.npy'
+                np.save(tmp_path,self.read_chrom(chrom))
+                os.replace(tmp_path,cache_path)
+            chrom_array=np.load(cache_path,mmap_mode='r')
+        self.chrom_arrays[chrom]=chrom_array
+        return chrom_array
+
+    def read_chrom(self,chrom):
+        fasta=pysam.FastaFile(self.ref_fasta)
+        seq=fasta.fetch(chrom)
+        fasta.close()
+        return np.frombuffer(seq.encode('ascii'),dtype=np.uint8)
+
+    def fetch(self,chrom,start,end):
+        '''
+        drop-in replacement for pysam.FastaFile.fetch, returns the sequence string
+        '''
+        chrom_array=self.get_chrom(chrom)
+        if chrom_array is None:
+            raise KeyError("chrom name:"+str(chrom)+" not found in "+self.ref_fasta)
+        return chrom_array[max(0,start):end].tobytes().decode('ascii')
+
+    def fetch_windows(self,chroms,starts,window_len):
+        '''
+        gather the windows [start, start+window_len) as a (num_windows, window_len) uint8 array of ascii bytes
+        positions past either end of a chromosome, and chromosomes missing from the fasta, are filled with N
+        '''
+        chroms=np.asarray(chroms)
+        starts=np.asarray(starts,dtype=np.int64)
+        windows=np.full((starts.shape[0],window_len),N_BYTE,dtype=np.uint8)
+        offsets=np.arange(window_len)
+        unique_chroms,chrom_inverse=np.unique(chroms,return_inverse=True)
+        for chrom_index in range(unique_chroms.shape[0]):
+            chrom_array=self.get_chrom(str(unique_chroms[chrom_index]))
+            if chrom_array is None:
+                continue
+            rows=np.flatnonzero(chrom_inverse==chrom_index)
+            positions=starts[rows,None]+offsets
+            in_bounds=(positions>=0)&(positions<chrom_array.shape[0])
+            if in_bounds.all():
+                windows[rows]=chrom_array[positions]
+            else:
+                windows[rows]=np.where(in_bounds,chrom_array[np.clip(positions,0,chrom_array.shape[0]-1)],N_BYTE)
+        return windows
+
+    def fetch_regions(self,chroms,starts,ends):
+        '''
+        gather the regions [start, end) as a (num_regions, max_region_len) uint8 array, padding shorter regions with N
+        '''
+        starts=np.asarray(starts,dtype=np.int64)
+        region_lens=np.asarray(ends,dtype=np.int64)-starts
+        if region_lens.shape[0]==0:
+            return np.zeros((0,0),dtype=np.uint8)
+        max_len=int(region_lens.max())
+        windows=self.fetch_windows(chroms,starts,max_len)
+        if region_lens.min()<max_len:
+            windows[np.arange(max_len)[None,:]>=region_lens[:,None]]=N_BYTE
+        return windows
+
+    def compute_ambig_mask(self,chrom,flank,chunk_size=2**24):
+        '''
+        boolean array over the chromosome, True where the window [pos-flank, pos+flank) contains an N or runs past either end
+        '''
+        chrom_array=self.get_chrom(chrom)
+        chrom_size=chrom_array.shape[0]
+        ambig_mask=np.ones(chrom_size,dtype=bool)
+        #process in chunks so the window sums never need a whole-chromosome cumsum 
+        for chunk_start in range(flank,max(flank,chrom_size-flank+1),chunk_size):
+            chunk_end=min(chunk_start+chunk_size,chrom_size-flank+1)
+            is_n=(base_code_lookup[chrom_array[chunk_start-flank:chunk_end+flank-1]]==AMBIG_CODE)
+            n_counts=np.zeros(is_n.shape[0]+1,dtype=np.int64)
+            np.cumsum(is_n,out=n_counts[1:])
+            ambig_mask[chunk_start:chunk_end]=(n_counts[2*flank:]-n_counts[0:-2*flank])>0
+        return ambig_mask
+
+    def get_ambig_mask(self,chrom,flank):
+        '''
+        bit-packed (np.packbits) ambiguity mask of a chromosome for windows of +/- flank, cached next to the chromosome cache file 
+        returns None if the chromosome is not in the fasta 
+        '''
+        key=(chrom,flank)
+        if key in self.ambig_masks:
+            return self.ambig_masks[key]
+        if self.get_chrom(chrom) is None:
+            packed_mask=None
+        elif self.cache_dir is None:
+            packed_mask=np.packbits(self.compute_ambig_mask(chrom,flank))
+        else:
+            cache_path=os.path.join(self.cache_dir,chrom+'.ambig_flank'+str(flank)+'.npy')
+            if (not os.path.exists(cache_path)) or (os.path.getmtime(cache_path)<os.path.getmtime(self.ref_fasta)):
+                print("caching ambiguous windows for "+chrom+" in "+cache_path)
+                tmp_path=cache_path+'.tmp.'+str(os.getpid())+'.npy'
+                np.save(tmp_path,np.packbits(self.compute_ambig_mask(chrom,flank)))
+                os.replace(tmp_path,cache_path)
+            packed_mask=np.load(cache_path,mmap_mode='r')
+        self.ambig_masks[key]=packed_mask
+        return packed_mask
+
+    def is_ambig(self,chroms,positions,flank):
+        '''
+        vectorized lookup of whether the windows [pos-flank, pos+flank) contain an N; positions on chromosomes missing from the fasta are ambiguous 
+        '''
+        chroms=np.asarray(chroms)
+        positions=np.asarray(positions,dtype=np.int64)
+        ambig=np.ones(positions.shape[0],dtype=bool)
+        unique_chroms,chrom_inverse=np.unique(chroms,return_inverse=True)
+        for chrom_index in range(unique_chroms.shape[0]):
+            packed_mask=self.get_ambig_mask(str(unique_chroms[chrom_index]),flank)
+            if packed_mask is None:
+                continue
+            rows=np.flatnonzero(chrom_inverse==chrom_index)
+            cur_positions=positions[rows]
+            in_bounds=(cur_positions>=0)&(cur_positions<self.chrom_sizes[str(unique_chroms[chrom_index])])
+            cur_positions=np.where(in_bounds,cur_positions,0)
+            bits=(packed_mask[cur_positions>>3]>>(7-(cur_positions&7)))&1
+            ambig[rows]=(bits==1)|(~in_bounds)
+        return ambig
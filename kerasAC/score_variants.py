@@ -0,0 +1,185 @@
+#variant effect scoring: each batch holds the ref and alt windows of its variants, built from a single reference fetch
+#(optionally with their reverse complements), which are run through the model together; per-variant scores are appended
+#to a tab-separated output file as each batch finishes. The variant file is read in chunks, so neither the variants nor their
+#scores are held in memory in full.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import argparse
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import pandas as pd
+from .generators.snp_generator import *
+from .get_model import *
+from .util import *
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="score the effect of variants as the difference between model predictions for their alt and ref alleles")
+    input_group=parser.add_argument_group('input')
+    input_group.add_argument("--variant_bed",required=True,help="tab-separated file with a header row, one variant per row")
+    input_group.add_argument("--ref_fasta",required=True)
+    input_group.add_argument("--ref_cache_dir",default=None,help="directory for the memory-mapped reference sequence cache, defaults to <ref_fasta>.kerasAC_cache")
+    input_group.add_argument("--chrom_col",default="CHR")
+    input_group.add_argument("--pos_col",default="POS",help="0-based position of the variant")
+    input_group.add_argument("--ref_col",default="REF")
+    input_group.add_argument("--alt_col",default="ALT")
+    input_group.add_argument("--rsid_col",default=None)
+    input_group.add_argument("--flank",type=int,default=500)
+    input_group.add_argument("--compute_gc",action="store_true",default=False,help="the model takes the GC content of the window as a second input")
+    input_group.add_argument("--expand_dims",action="store_true",default=False)
+
+    model_group=parser.add_argument_group('model')
+    model_group.add_argument('--load_model_hdf5',default=None,help='hdf5 file that stores the model')
+    model_group.add_argument('--weights',default=None,help='weights file for the model')
+    model_group.add_argument('--yaml',default=None,help='yaml file for the model')
+    model_group.add_argument('--json',default=None,help='json file for the model')
+    model_group.add_argument("--architecture_spec",type=str,default="basset_architecture_multitask")
+    model_group.add_argument("--architecture_from_file",type=str,default=None)
+    model_group.add_argument("--num_gpus",type=int,default=1)
+    model_group.add_argument('--w1',nargs="*",type=float,default=None)
+    model_group.add_argument('--w0',nargs="*",type=float,default=None)
+    model_group.add_argument("--w1_w0_file",default=None)
+
+    score_group=parser.add_argument_group('scoring')
+    score_group.add_argument("--revcomp",action="store_true",default=False,help="average the predictions for each window and its reverse complement")
+    score_group.add_argument("--output_space",choices=['log','linear'],default='log',help="log: scalar outputs are in log space and their logfc is alt-ref; linear: logfc is log2((alt+pseudocount)/(ref+pseudocount))")
+    score_group.add_argument("--pseudocount",type=float,default=0.001)
+    score_group.add_argument("--profile_softmax",action="store_true",default=False,help="profile outputs are logits; apply a softmax over positions before taking the profile difference")
+    score_group.add_argument("--batch_size",type=int,default=500,help="number of variants per batch; the model sees 2x (4x with --revcomp) windows")
+    score_group.add_argument("--onehot_dtype",default="float32")
+    score_group.add_argument("--chunk_size",type=int,default=1000000,help="number of variants read from --variant_bed at a time; bounds the memory held for the variant table")
+    score_group.add_argument("--out_tsv",required=True)
+    return parser.parse_args()
+
+def get_paired_model_inputs(ref_X,alt_X,add_revcomp=False):
+    '''
+    stack the ref windows, alt windows and (if add_revcomp) their reverse complements into a single model input along the batch axis
+    '''
+    if type(ref_X) is not list:
+        return get_paired_model_inputs([ref_X],[alt_X],add_revcomp=add_revcomp)[0]
+    model_inputs=[]
+    for input_index in range(len(ref_X)):
+        parts=[ref_X[input_index],alt_X[input_index]]
+        if add_revcomp==True:
+            if input_index==0:
+                #one-hot sequence: reverse the position and base axes; works with or without expand_dims
+                parts=parts+[ref_X[0][...,::-1,::-1],alt_X[0][...,::-1,::-1]]
+            else:
+                parts=parts+parts
+        model_inputs.append(np.concatenate(parts,axis=0))
+    return model_inputs
+
+def split_paired_predictions(preds,num_variants,add_revcomp=False):
+    '''
+    split each model output back into (ref, alt) predictions, averaging over the two strands if add_revcomp
+    outputs are reshaped to (num_variants, num_tasks) or (num_variants, seq_len, num_tasks)
+    '''
+    if type(preds) is not list:
+        preds=[preds]
+    paired_preds=[]
+    for cur_preds in preds:
+        if cur_preds.ndim==1:
+            cur_preds=cur_preds[:,None]
+        ref_preds=cur_preds[0:num_variants]
+        alt_preds=cur_preds[num_variants:2*num_variants]
+        if add_revcomp==True:
+            ref_rc_preds=cur_preds[2*num_variants:3*num_variants]
+            alt_rc_preds=cur_preds[3*num_variants:4*num_variants]
+            if cur_preds.ndim==3:
+                #per-position outputs of the reverse complement run in the opposite direction
+                ref_rc_preds=ref_rc_preds[:,::-1]
+                alt_rc_preds=alt_rc_preds[:,::-1]
+            ref_preds=(ref_preds+ref_rc_preds)/2
+            alt_preds=(alt_preds+alt_rc_preds)/2
+        paired_preds.append((ref_preds,alt_preds))
+    return paired_preds
+
+def softmax_positions(logits):
+    logits=logits-logits.max(axis=1,keepdims=True)
+    probs=np.exp(logits)
+    return probs/probs.sum(axis=1,keepdims=True)
+
+def get_variant_scores(paired_preds,output_space='log',pseudocount=0.001,profile_softmax=False):
+    '''
+    returns an OrderedDict of score column name --> (num_variants,) array
+    scalar outputs: ref and alt predictions and their log fold change; per-position outputs: the L1 distance between the ref and alt profiles
+    '''
+    scores=OrderedDict()
+    for output_index,(ref_preds,alt_preds) in enumerate(paired_preds):
+        if ref_preds.ndim==3:
+            if profile_softmax==True:
+                ref_preds=softmax_positions(ref_preds)
+                alt_preds=softmax_positions(alt_preds)
+            profile_diff=np.abs(alt_preds-ref_preds).sum(axis=1)
+            for task_index in range(profile_diff.shape[1]):
+                scores['_'.join(['output'+str(output_index),'task'+str(task_index),'profile_diff'])]=profile_diff[:,task_index]
+            continue
+        if output_space=='log':
+            logfc=alt_preds-ref_preds
+        else:
+            logfc=np.log2((alt_preds+pseudocount)/(ref_preds+pseudocount))
+        for task_index in range(ref_preds.shape[1]):
+            prefix='_'.join(['output'+str(output_index),'task'+str(task_index)])
+            scores[prefix+'_ref']=ref_preds[:,task_index]
+            scores[prefix+'_alt']=alt_preds[:,task_index]
+            scores[prefix+'_logfc']=logfc[:,task_index]
+    return scores
+
+def score_variant_chunk(args,model,generator,out_f,pool,write_header):
+    num_batches=len(generator)
+    #the next batch is built while the model runs on the current one; only one batch is built ahead
+    next_batch=pool.apply_async(generator.__getitem__,(0,)) if num_batches>0 else None
+    for idx in range(num_batches):
+        rsids,ref_X,alt_X=next_batch.get()
+        if idx+1<num_batches:
+            next_batch=pool.apply_async(generator.__getitem__,(idx+1,))
+        num_variants=len(rsids)
+        preds=model.predict_on_batch(get_paired_model_inputs(ref_X,alt_X,add_revcomp=args.revcomp))
+        paired_preds=split_paired_predictions(preds,num_variants,add_revcomp=args.revcomp)
+        batch=slice(idx*args.batch_size,idx*args.batch_size+num_variants)
+        batch_scores=pd.DataFrame(OrderedDict([('CHR',generator.chroms[batch]),
+                                               ('POS',generator.positions[batch]),
+                                               ('RSID',rsids),
+                                               ('REF',generator.bed[args.ref_col].values[batch]),
+                                               ('ALT',generator.bed[args.alt_col].values[batch])]))
+        for name,values in get_variant_scores(paired_preds,output_space=args.output_space,pseudocount=args.pseudocount,profile_softmax=args.profile_softmax).items():
+            batch_scores[name]=values
+        batch_scores.to_csv(out_f,sep='\t',header=(write_header and idx==0),index=False)
+        if idx%10==0:
+            print(str(idx)+"/"+str(num_batches))
+    return num_batches
+
+def score_variants(args):
+    #the variant file is read chunk_size variants at a time, so memory follows the chunk rather than the number of variants;
+    #the chunks share one reference cache, which adds chromosomes as they are first seen
+    ref=ReferenceCache(args.ref_fasta,cache_dir=args.ref_cache_dir)
+    model=get_model(args)
+    num_variants=0
+    with open(args.out_tsv,'w') as out_f, ThreadPool(processes=1) as pool:
+        for chunk in pd.read_csv(args.variant_bed,header=0,sep='\t',chunksize=args.chunk_size):
+            generator=SNPGenerator(args.variant_bed,
+                                   args.chrom_col,
+                                   args.pos_col,
+                                   args.ref_col,
+                                   args.flank,
+                                   args.ref_fasta,
+                                   rsid_col=args.rsid_col,
+                                   compute_gc=args.compute_gc,
+                                   batch_size=args.batch_size,
+                                   expand_dims=args.expand_dims,
+                                   ref_cache_dir=args.ref_cache_dir,
+                                   onehot_dtype=args.onehot_dtype,
+                                   alt_allele_col=args.alt_col,
+                                   bed=chunk,
+                                   ref=ref)
+            print("scoring variants "+str(num_variants)+"-"+str(num_variants+generator.num_snps)+" in "+str(len(generator))+" batches")
+            score_variant_chunk(args,model,generator,out_f,pool,num_variants==0)
+            num_variants+=generator.num_snps
+    print("wrote scores of "+str(num_variants)+" variants to "+args.out_tsv)
+
+def main():
+    args=parse_args()
+    score_variants(args)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,170 @@
+#streaming genome tracks from tiled predictions.
+#windows arrive sorted by chromosome and start; each track keeps a rolling buffer (one window long) of summed values and
+#window counts, so overlapping windows are averaged. Once a window starts at position s, no later window can cover the
+#positions before s, so they are written out and the buffer is shifted. Memory is bounded by the window length, not the
+#chromosome length.
+import numpy as np
+import pyBigWig
+
+def get_covered_runs(counts):
+    #(start, end) offsets of the runs of positions covered by at least one window
+    covered=np.concatenate(([False],counts>0,[False]))
+    edges=np.flatnonzero(covered[1:]!=covered[:-1])
+    return zip(edges[0::2],edges[1::2])
+
+class BigWigTrackWriter(object):
+    def __init__(self,path,chrom_sizes):
+        '''
+        chrom_sizes -- list of (chrom, size) tuples, in the order the chromosomes will be written
+        '''
+        self.path=path
+        self.bw=pyBigWig.open(path,'w')
+        self.bw.addHeader([(str(chrom),int(size)) for chrom,size in chrom_sizes])
+
+    def write_run(self,chrom,start,values):
+        #fixed-step entries with a span of 1 base
+        if pyBigWig.numpy==1:
+            values=np.asarray(values,dtype=np.float64)
+        else:
+            values=[float(i) for i in values]
+        self.bw.addEntries(chrom,int(start),values=values,span=1,step=1)
+
+    def close(self):
+        self.bw.close()
+
+class BedGraphTrackWriter(object):
+    def __init__(self,path,chrom_sizes=None,precision=5):
+        '''
+        precision -- significant digits of the written values; consecutive bases with equal written values are merged into one interval
+        '''
+        self.path=path
+        self.precision=precision
+        self.f=open(path,'w')
+
+    def write_run(self,chrom,start,values):
+        values=np.array(['%.*g'%(self.precision,i) for i in values])
+        breaks=np.flatnonzero(values[1:]!=values[:-1])+1
+        starts=np.concatenate(([0],breaks))
+        ends=np.concatenate((breaks,[values.shape[0]]))
+        self.f.write(''.join([chrom+'\t'+str(start+s)+'\t'+str(start+e)+'\t'+values[s]+'\n' for s,e in zip(starts,ends)]))
+
+    def close(self):
+        self.f.close()
+
+def get_track_writer(path,chrom_sizes,track_format='bigwig'):
+    if track_format=='bigwig':
+        return BigWigTrackWriter(path,chrom_sizes)
+    elif track_format=='bedgraph':
+        return BedGraphTrackWriter(path,chrom_sizes)
+    else:
+        raise Exception("track_format must be one of bigwig, bedgraph; you provided:"+str(track_format))
+
+class StitchedTrack(object):
+    def __init__(self,track_writer,chrom_sizes,buffer_len):
+        '''
+        track_writer -- BigWigTrackWriter/BedGraphTrackWriter the averaged values are written to
+        chrom_sizes -- dict of chrom --> size; windows are clipped to the chromosome
+        buffer_len -- initial length of the rolling buffer, i.e. the window length; grows if a longer window is added
+        '''
+        self.track_writer=track_writer
+        self.chrom_sizes=chrom_sizes
+        self.sums=np.zeros(buffer_len,dtype=np.float64)
+        self.counts=np.zeros(buffer_len,dtype=np.int32)
+        self.chrom=None
+        self.buffer_start=0
+
+    def flush(self,to_pos):
+        '''
+        write out the averaged values of the positions before to_pos and shift the buffer to start at to_pos
+        '''
+        num_final=min(to_pos-self.buffer_start,self.sums.shape[0])
+        if num_final<=0:
+            return
+        for run_start,run_end in get_covered_runs(self.counts[0:num_final]):
+            self.track_writer.write_run(self.chrom,self.buffer_start+run_start,self.sums[run_start:run_end]/self.counts[run_start:run_end])
+        self.sums[0:self.sums.shape[0]-num_final]=self.sums[num_final:]
+        self.sums[self.sums.shape[0]-num_final:]=0
+        self.counts[0:self.counts.shape[0]-num_final]=self.counts[num_final:]
+        self.counts[self.counts.shape[0]-num_final:]=0
+        self.buffer_start=to_pos
+
+    def add(self,chrom,start,values):
+        '''
+        add the values of a window starting at start; windows must be added in order of chromosome and start
+        '''
+        if chrom!=self.chrom:
+            self.finish_chrom()
+            self.chrom=chrom
+            self.buffer_start=max(0,start)
+        elif start<self.buffer_start:
+            raise Exception("windows must be added in sorted order; got "+chrom+":"+str(start)+" after "+chrom+":"+str(self.buffer_start))
+        #clip the window to the chromosome
+        end=min(start+values.shape[0],self.chrom_sizes[chrom])
+        if start<0:
+            values=values[-start:]
+            start=0
+        values=values[0:max(0,end-start)]
+        if values.shape[0]==0:
+            return
+        self.flush(start)
+        if values.shape[0]>self.sums.shape[0]:
+            self.sums=np.concatenate((self.sums,np.zeros(values.shape[0]-self.sums.shape[0],dtype=self.sums.dtype)))
+            self.counts=np.concatenate((self.counts,np.zeros(values.shape[0]-self.counts.shape[0],dtype=self.counts.dtype)))
+        self.sums[0:values.shape[0]]+=values
+        self.counts[0:values.shape[0]]+=1
+
+    def finish_chrom(self):
+        if self.chrom is not None:
+            self.flush(self.buffer_start+self.sums.shape[0])
+
+    def close(self):
+        self.finish_chrom()
+        self.track_writer.close()
+
+class TrackStitcher(object):
+    def __init__(self,out_prefix,chrom_sizes,window_len,track_format='bigwig'):
+        '''
+        streams the predictions of tiled windows into one track per output and task: <out_prefix>.output<i>.task<j>.<bw|bedGraph>
+        chrom_sizes -- list of (chrom, size) tuples, in the order of the tiles
+        window_len -- span of scalar (i.e. count) outputs, centered on each tile; per-position (profile) outputs span their own length
+        '''
+        self.out_prefix=out_prefix
+        self.chrom_size_list=chrom_sizes
+        self.chrom_sizes=dict([(str(chrom),int(size)) for chrom,size in chrom_sizes])
+        self.window_len=window_len
+        self.track_format=track_format
+        self.tracks={}
+
+    def get_track(self,output_index,task_index,buffer_len):
+        key=(output_index,task_index)
+        if key not in self.tracks:
+            suffix='bw' if self.track_format=='bigwig' else 'bedGraph'
+            path='.'.join([self.out_prefix,'output'+str(output_index),'task'+str(task_index),suffix])
+            self.tracks[key]=StitchedTrack(get_track_writer(path,self.chrom_size_list,self.track_format),self.chrom_sizes,buffer_len)
+        return self.tracks[key]
+
+    def add_batch(self,chroms,centers,outputs):
+        '''
+        chroms, centers -- (num_rows,) arrays of the tile centers
+        outputs -- list with one array per model output: (num_rows,), (num_rows, num_tasks), (num_rows, window) or (num_rows, window, num_tasks)
+        '''
+        for output_index,values in enumerate(outputs):
+            values=np.asarray(values)
+            if values.ndim==1:
+                #scalar, single task
+                values=np.repeat(values[:,None,None],self.window_len,axis=1)
+            elif values.ndim==2 and values.shape[1]!=self.window_len:
+                #scalar, one column per task; a single-task profile squeezed to (num_rows, window) is kept as is
+                values=np.repeat(values[:,None,:],self.window_len,axis=1)
+            if values.ndim==2:
+                values=values[:,:,None]
+            window=values.shape[1]
+            for task_index in range(values.shape[2]):
+                track=self.get_track(output_index,task_index,window)
+                for row in range(values.shape[0]):
+                    track.add(str(chroms[row]),int(centers[row])-window//2,values[row,:,task_index])
+
+    def close(self):
+        for track in self.tracks.values():
+            track.close()
+        print("wrote "+str(len(self.tracks))+" tracks with prefix "+self.out_prefix)
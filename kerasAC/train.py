@@ -9,6 +9,7 @@ import h5py
 from .s3_sync import *
 from .generators.basic_generator import *
 from .generators.tiledb_generator import *
+from .generators.prefetch import *
 from .custom_callbacks import * 
 from .tiledb_config import *
 from .get_model import *
@@ -107,15 +108,21 @@ def parse_args():
     
     batch_params=parser.add_argument_group("batch_params")
     batch_params.add_argument("--batch_size",type=int,default=1000)
-    batch_params.add_argument("--revcomp",action="store_true")
+    batch_params.add_argument("--revcomp",action="store_true",help="add the reverse complement of each example; tiledb per-position tracks (inputs, outputs, bias) are reversed along the position axis on the reverse strand")
+    batch_params.add_argument("--revcomp_strand_pairs",nargs="*",default=None,help="tiledb: plus,minus pairs of strand-specific tasks (positions in the selected tasks, i.e. 0,1) swapped on the reverse strand")
     batch_params.add_argument("--label_transformer",nargs="+",default=None,help="transformation to apply to label values")
     batch_params.add_argument("--squeeze_input_for_gru",action="store_true")
     batch_params.add_argument("--expand_dims",default=False,action="store_true")
-    batch_params.add_argument("--upsample_thresh_list_train",type=float,nargs="*",default=None)
-    batch_params.add_argument("--upsample_ratio_list_train",type=float,nargs="*",default=None)
-    batch_params.add_argument("--upsample_thresh_list_eval",type=float,nargs="*",default=None)
-    batch_params.add_argument("--upsample_ratio_list_eval",type=float,nargs="*",default=None)
+    batch_params.add_argument("--upsample_thresh_list_train",type=float,nargs="*",default=None,help="sorted thresholds bounding the upsampling bands [t_i, t_i+1); the last band is unbounded. tiledb defaults to [tdb_partition_thresh_for_upsample]")
+    batch_params.add_argument("--upsample_ratio_list_train",type=float,nargs="*",default=None,help="fraction of each batch drawn from each band. len(thresh_list)-1 ratios: the last band takes the rest of the batch (hdf5/bed and tiledb). tiledb also accepts len(thresh_list) ratios, with random genome positions filling the rest of the batch")
+    batch_params.add_argument("--upsample_thresh_list_eval",type=float,nargs="*",default=None,help="as --upsample_thresh_list_train, for the validation generator")
+    batch_params.add_argument("--upsample_ratio_list_eval",type=float,nargs="*",default=None,help="as --upsample_ratio_list_train, for the validation generator")
     batch_params.add_argument("--upsample_threads",type=int,default=1)
+    batch_params.add_argument("--upsample_cache_dir",default=None,help="directory to cache tiledb upsampled indices in, defaults to ~/.cache/kerasAC/upsampled_indices")
+    batch_params.add_argument("--onehot_dtype",default="float32",help="dtype of one-hot encoded sequence batches, i.e. uint8, float16, float32")
+    batch_params.add_argument("--vals_dtype",default="float32",help="dtype of track value batches, i.e. float16, float32")
+    batch_params.add_argument("--positional_gathers",action="store_true",help="hdf5/bed inputs: align all tables to the index rows at startup and gather batches by row id; fails at startup on duplicate or missing coordinates. always on for label stores")
+    batch_params.add_argument("--reject_ambig_nonupsampled",action="store_true",help="redraw non-upsampled tiledb positions whose windows contain an N in the reference")
     
     epoch_params=parser.add_argument_group("epoch_params")
     epoch_params.add_argument("--epochs",type=int,default=40)
@@ -132,6 +139,8 @@ def parse_args():
     parallelization_params=parser.add_argument_group("parallelization")
     parallelization_params.add_argument("--threads",type=int,default=1)
     parallelization_params.add_argument("--max_queue_size",type=int,default=100)
+    parallelization_params.add_argument("--prefetch_depth",type=int,default=0,help="number of batches built ahead of the training loop, in shared-memory slots; 0 uses the keras multiprocessing queue instead")
+    parallelization_params.add_argument("--prefetch_workers",type=int,default=None,help="number of prefetch worker processes, defaults to --threads; capped at --prefetch_depth")
     parallelization_params.add_argument("--num_gpus",type=int,default=1)
 
     vis_params=parser.add_argument_group("visualization")            
@@ -176,17 +185,33 @@ def fit_and_evaluate(model,train_gen,valid_gen,args):
                 os.makedirs(cur_logdir)
         tensorboard_visualizer=TensorBoard(log_dir=cur_logdir, histogram_freq=0, batch_size=500, write_graph=True, write_grads=False, write_images=False, embeddings_freq=0, embeddings_layer_names=None, embeddings_metadata=None)
         cur_callbacks.append(tensorboard_visualizer)
-    model.fit_generator(train_gen,
-                        validation_data=valid_gen,
-                        steps_per_epoch=args.num_train/args.batch_size,
-                        validation_steps=args.num_valid/args.batch_size,
-                        epochs=args.epochs,
-                        verbose=1,
-                        use_multiprocessing=args.use_multiprocessing,
-                        workers=args.threads,
-                        max_queue_size=args.max_queue_size,
-                        callbacks=cur_callbacks,
-                        shuffle=False)
+    use_multiprocessing=args.use_multiprocessing
+    workers=args.threads
+    if args.prefetch_depth>0:
+        #worker processes write batches to shared memory, keras reads them in the main process 
+        prefetch_workers=args.prefetch_workers
+        if prefetch_workers is None:
+            prefetch_workers=args.threads
+        train_gen=SharedMemoryPrefetcher(train_gen,args.prefetch_depth,prefetch_workers,seed=args.seed)
+        valid_gen=SharedMemoryPrefetcher(valid_gen,args.prefetch_depth,prefetch_workers,seed=args.seed)
+        use_multiprocessing=False
+        workers=0
+    try:
+        model.fit_generator(train_gen,
+                            validation_data=valid_gen,
+                            steps_per_epoch=args.num_train/args.batch_size,
+                            validation_steps=args.num_valid/args.batch_size,
+                            epochs=args.epochs,
+                            verbose=1,
+                            use_multiprocessing=use_multiprocessing,
+                            workers=workers,
+                            max_queue_size=args.max_queue_size,
+                            callbacks=cur_callbacks,
+                            shuffle=False)
+    finally:
+        if args.prefetch_depth>0:
+            train_gen.close()
+            valid_gen.close()
     print('fit_generator complete') 
     model.save_weights(model_output_path_weights_name)
     print('weights saved') 
@@ -216,11 +241,14 @@ def initializer_generators_hdf5(args):
                                   ref_fasta=args.ref_fasta,
                                   batch_size=args.batch_size,
                                   add_revcomp=args.revcomp,
+                                  onehot_dtype=args.onehot_dtype,
+                                  vals_dtype=args.vals_dtype,
                                   chroms_to_use=train_chroms,
                                   get_w1_w0=args.weighted,
                                   expand_dims=args.expand_dims,
                                   upsample_thresh_list=args.upsample_thresh_list_train,
                                   upsample_ratio_list=args.upsample_ratio_list_train,
+                                  positional_gathers=args.positional_gathers,
                                   tasks=args.tasks)
 
     
@@ -234,15 +262,23 @@ def initializer_generators_hdf5(args):
                                   num_outputs=args.num_outputs,
                                   ref_fasta=args.ref_fasta,
                                   batch_size=args.batch_size,
-                                  add_revcomp=args.revcomp,                        
+                                  add_revcomp=args.revcomp,
+                                  onehot_dtype=args.onehot_dtype,
+                                  vals_dtype=args.vals_dtype,
                                   upsample_thresh_list=args.upsample_thresh_list_eval,
                                   upsample_ratio_list=args.upsample_ratio_list_eval,
                                   chroms_to_use=valid_chroms,
                                   expand_dims=args.expand_dims,
+                                  positional_gathers=args.positional_gathers,
                                   tasks=args.tasks)
     print("generated validation data generator!")
     return train_generator, valid_generator 
 
+def get_revcomp_strand_pairs(args):
+    if args.revcomp_strand_pairs is None:
+        return None
+    return [tuple([int(j) for j in i.split(',')]) for i in args.revcomp_strand_pairs]
+
 def initialize_generators_tiledb(args):
     #open array for reading
     #print("consolidating:")
@@ -250,16 +286,8 @@ def initialize_generators_tiledb(args):
     #tiledb.consolidate(args.tdb_array)
     #print("done")
 
-    if args.upsample_ratio_list_train is not None:
-        upsample_ratio_train=args.upsample_ratio_list_train[0]
-        print("warning! only a single ratio for upsampling supported for tiledb as of now")
-    else:
-        upsample_ratio_train=None
-    if args.upsample_ratio_list_eval is not None:
-        upsample_ratio_eval=args.upsample_ratio_list_eval[0]
-        print("warning! only a single ratio for upsampling supported for tiledb as of now")
-    else:
-        upsample_ratio_eval=None
+    #tiledb upsampling tiers: one ratio per threshold in the upsample_thresh_list (which defaults to [tdb_partition_thresh_for_upsample]) with random positions
+    #filling the rest of the batch, or one ratio fewer with the last tier filling the rest, as in DataGenerator
     import tiledb
     tdb_config=get_default_config() 
     tdb_ctx=tiledb.Ctx(config=tdb_config)
@@ -294,13 +322,21 @@ def initialize_generators_tiledb(args):
                                     bias_pseudocount=args.tdb_bias_pseudocount,
                                     tasks=args.tasks,
                                     task_indices=args.task_indices,
-                                    upsample_ratio=upsample_ratio_train,
+                                    upsample_ratio=None,
+                                    upsample_thresh_list=args.upsample_thresh_list_train,
+                                    upsample_ratio_list=args.upsample_ratio_list_train,
                                     num_inputs=args.num_inputs,
                                     num_outputs=args.num_outputs,
                                     expand_dims=args.expand_dims,
                                     add_revcomp=args.revcomp,
+                                    revcomp_strand_pairs=get_revcomp_strand_pairs(args),
                                     tdb_config=tdb_config,
                                     tdb_ctx=tdb_ctx,
+                                    upsample_cache_dir=args.upsample_cache_dir,
+                                    onehot_dtype=args.onehot_dtype,
+                                    vals_dtype=args.vals_dtype,
+                                    sample_seed=args.seed,
+                                    reject_ambig_nonupsampled=args.reject_ambig_nonupsampled,
                                     num_threads=args.upsample_threads)
     
     print("generated training data generator!")
@@ -334,13 +370,21 @@ def initialize_generators_tiledb(args):
                                     tdb_bias_transformation=args.tdb_bias_transformation,                                    
                                     tasks=args.tasks,
                                     task_indices=args.task_indices,
-                                    upsample_ratio=upsample_ratio_eval,
+                                    upsample_ratio=None,
+                                    upsample_thresh_list=args.upsample_thresh_list_eval,
+                                    upsample_ratio_list=args.upsample_ratio_list_eval,
                                     num_inputs=args.num_inputs,
                                     num_outputs=args.num_outputs,
                                     expand_dims=args.expand_dims,
                                     add_revcomp=args.revcomp,
+                                    revcomp_strand_pairs=get_revcomp_strand_pairs(args),
                                     tdb_config=tdb_config,
                                     tdb_ctx=tdb_ctx,
+                                    upsample_cache_dir=args.upsample_cache_dir,
+                                    onehot_dtype=args.onehot_dtype,
+                                    vals_dtype=args.vals_dtype,
+                                    sample_seed=args.seed,
+                                    reject_ambig_nonupsampled=args.reject_ambig_nonupsampled,
                                     num_threads=args.upsample_threads)
     
     print("generated validation data generator")
@@ -5,49 +5,191 @@ import argparse
 import numpy as np 
 import tiledb
 
-ltrdict = {'a':[1,0,0,0],
-           'c':[0,1,0,0],
-           'g':[0,0,1,0],
-           't':[0,0,0,1],
-           'n':[0,0,0,0],
-           'A':[1,0,0,0],
-           'C':[0,1,0,0],
-           'G':[0,0,1,0],
-           'T':[0,0,0,1],
-           'N':[0,0,0,0]}
-
-def one_hot_encode(seqs):
-    return np.array([[ltrdict.get(x,[0,0,0,0]) for x in seq] for seq in seqs])
-
-def dinuc_shuffle(seq):
-    #get list of dinucleotides
-    nucs=[]
-    for i in range(0,len(seq),2):
-        nucs.append(seq[i:i+2])
-    #generate a random permutation
-    random.shuffle(nucs)
-    return ''.join(nucs) 
+#lookup tables for vectorized one-hot encoding
+#ascii byte --> base code: 0,1,2,3 for A,C,G,T; 4 for N and any IUPAC ambiguity code 
+NUM_BASES=4
+AMBIG_CODE=4
+base_code_lookup=np.full(256,AMBIG_CODE,dtype=np.uint8)
+softmasked_code_lookup=np.full(256,AMBIG_CODE,dtype=np.uint8)
+for base_index,base in enumerate('ACGT'):
+    base_code_lookup[ord(base)]=base_index
+    base_code_lookup[ord(base.lower())]=base_index
+    softmasked_code_lookup[ord(base)]=base_index
+#complement of each base code, N is its own complement
+complement_code_lookup=np.array([3,2,1,0,AMBIG_CODE],dtype=np.uint8)
 
+def seqs_to_bytes(seqs):
+    '''
+    convert a list of sequence strings to a (num_seqs, seq_len) uint8 array of ascii bytes.
+    sequences shorter than the longest one are padded with N.
+    uint8 arrays (i.e. slices of a reference cache) are returned as is. 
+    '''
+    if isinstance(seqs,np.ndarray) and seqs.dtype==np.uint8:
+        if seqs.ndim==1:
+            return seqs[None,:]
+        return seqs
+    if isinstance(seqs,str):
+        seqs=[seqs]
+    num_seqs=len(seqs)
+    if num_seqs==0:
+        return np.zeros((0,0),dtype=np.uint8)
+    seq_lens=[len(seq) for seq in seqs]
+    max_len=max(seq_lens)
+    if min(seq_lens)==max_len:
+        return np.frombuffer(''.join(seqs).encode('ascii'),dtype=np.uint8).reshape((num_seqs,max_len))
+    seq_bytes=np.full((num_seqs,max_len),ord('N'),dtype=np.uint8)
+    for i in range(num_seqs):
+        seq_bytes[i,0:seq_lens[i]]=np.frombuffer(seqs[i].encode('ascii'),dtype=np.uint8)
+    return seq_bytes
 
-def revcomp(seq):
-    seq=seq[::-1].upper()
-    comp_dict=dict()
-    comp_dict['A']='T'
-    comp_dict['T']='A'
-    comp_dict['C']='G'
-    comp_dict['G']='C'
-    rc=[]
-    for base in seq:
-        if base in comp_dict:
-            rc.append(comp_dict[base])
-        else:
-            rc.append(base)
-    return ''.join(rc)
+def encode_bases(seqs,mask_softmasked=False,add_revcomp=False):
+    '''
+    map sequences to a (num_seqs, seq_len) uint8 array of base codes through a lookup table 
+    mask_softmasked -- lowercase (soft-masked) bases are encoded as N
+    add_revcomp -- the reverse complement of each sequence is appended after the forward sequences
+    '''
+    seq_bytes=seqs_to_bytes(seqs)
+    if mask_softmasked is True:
+        codes=softmasked_code_lookup[seq_bytes]
+    else:
+        codes=base_code_lookup[seq_bytes]
+    if add_revcomp is True:
+        codes=np.concatenate((codes,complement_code_lookup[codes[:,::-1]]),axis=0)
+    return codes
 
+def one_hot_encode(seqs,dtype=np.float32,mask_softmasked=False,add_revcomp=False):
+    '''
+    one-hot encode sequence strings (or uint8 ascii arrays) to a (num_seqs, seq_len, 4) array of the specified dtype 
+    N and IUPAC ambiguity codes are encoded as all zeros 
+    add_revcomp -- the reverse complement of each sequence is appended after the forward sequences, giving (2*num_seqs, seq_len, 4)
+    '''
+    codes=encode_bases(seqs,mask_softmasked=mask_softmasked)
+    num_seqs=codes.shape[0]
+    num_copies=2 if add_revcomp is True else 1
+    onehot=np.empty((num_copies*num_seqs,codes.shape[1],NUM_BASES),dtype=dtype)
+    #row 4 of the (5,4) identity is all zeros, which handles the N's
+    np.take(np.eye(AMBIG_CODE+1,NUM_BASES,dtype=dtype),codes,axis=0,out=onehot[0:num_seqs])
+    if add_revcomp is True:
+        onehot[num_seqs:]=revcomp_onehot(onehot[0:num_seqs])
+    return onehot
+
+def revcomp_onehot(onehot):
+    '''
+    reverse complement a batch of one-hot encoded sequences (num_seqs, seq_len, 4), returned as a view. 
+    with channels in A,C,G,T order, reversing the channel axis complements each base 
+    '''
+    return onehot[:,::-1,::-1]
+
+def add_revcomp_vals(vals,flip_axes=(1,),dtype=None,task_order=None):
+    '''
+    returns a (2*num_entries, ...) array holding vals followed by their reverse complement strand counterparts, written into one preallocated buffer
+    flip_axes -- axes reversed for the reverse complement strand: (1,) for per-position tracks (num_entries, seq_len, num_tasks),
+    (1,2) for one-hot encoded sequence, () for values aggregated over the window 
+    dtype -- dtype of the returned array, defaults to vals.dtype 
+    task_order -- order of the last (task) axis on the reverse complement strand, i.e. [1,0] swaps a plus/minus strand pair of tasks 
+    '''
+    if dtype is None:
+        dtype=vals.dtype
+    num_entries=vals.shape[0]
+    out=np.empty((2*num_entries,)+vals.shape[1:],dtype=dtype)
+    out[0:num_entries]=vals
+    flipped=[slice(None)]*vals.ndim
+    for axis in flip_axes:
+        flipped[axis]=slice(None,None,-1)
+    out[num_entries:]=vals[tuple(flipped)]
+    if task_order is not None:
+        out[num_entries:]=out[num_entries:][...,task_order]
+    return out
 
+def dinuc_shuffle(onehot,num_shufs=1,rng=None):
+    '''
+    dinucleotide-preserving shuffle of one-hot encoded sequences (Altschul-Erickson Euler path shuffle), batched over sequences and shuffles.
+    each shuffle keeps the first base and the exact dinucleotide counts of its sequence; all-zero (N) positions are shuffled as a fifth base. 
+    onehot -- (num_seqs, seq_len, 4) or (seq_len, 4) array 
+    num_shufs -- number of shuffles per sequence 
+    rng -- np.random.RandomState/Generator or integer seed; if None, numpy's global random state is used 
+    returns a (num_seqs, num_shufs, seq_len, 4) array, or (num_shufs, seq_len, 4) for a single (seq_len, 4) sequence 
+    '''
+    if isinstance(rng,(int,np.integer)):
+        rng=np.random.RandomState(rng)
+    random_func=np.random.random if rng is None else rng.random
+    single_seq=(onehot.ndim==2)
+    if single_seq:
+        onehot=onehot[None]
+    num_seqs,seq_len=onehot.shape[0:2]
+    #base codes, with N as code 4 
+    codes=np.where(onehot.any(axis=2),onehot.argmax(axis=2),AMBIG_CODE)
+    num_copies=num_seqs*num_shufs
+    copy_codes=np.repeat(codes,num_shufs,axis=0)
+    if seq_len<3:
+        shuffled=copy_codes
+    else:
+        #each edge i (base i --> base i+1) is grouped by its source base; edges within a group are visited in random order,
+        #except that the last edge out of each base stays last, which guarantees that the walk is an Eulerian path
+        sources=copy_codes[:,0:-1]
+        sort_keys=random_func((num_copies,seq_len-1))
+        for base_code in range(AMBIG_CODE+1):
+            is_source=(sources==base_code)
+            has_edges=np.flatnonzero(is_source.any(axis=1))
+            last_edges=seq_len-2-is_source[:,::-1].argmax(axis=1)
+            sort_keys[has_edges,last_edges[has_edges]]=2
+        edge_order=np.argsort(sources*3+sort_keys,axis=1)
+        #start of each base's group of edges within edge_order 
+        group_starts=np.zeros((num_copies,AMBIG_CODE+2),dtype=np.int64)
+        group_starts[:,1:]=np.cumsum(np.stack([(sources==i).sum(axis=1) for i in range(AMBIG_CODE+1)],axis=1),axis=1)
+        #walk all copies in parallel 
+        rows=np.arange(num_copies)
+        visit_counts=np.zeros((num_copies,AMBIG_CODE+1),dtype=np.int64)
+        shuffled=np.empty_like(copy_codes)
+        shuffled[:,0]=copy_codes[:,0]
+        cur_positions=np.zeros(num_copies,dtype=np.int64)
+        for i in range(1,seq_len):
+            cur_codes=copy_codes[rows,cur_positions]
+            cur_positions=edge_order[rows,group_starts[rows,cur_codes]+visit_counts[rows,cur_codes]]+1
+            visit_counts[rows,cur_codes]+=1
+            shuffled[:,i]=copy_codes[rows,cur_positions]
+    shuffled_onehot=np.eye(AMBIG_CODE+1,NUM_BASES,dtype=onehot.dtype)[shuffled].reshape((num_seqs,num_shufs,seq_len,NUM_BASES))
+    if single_seq:
+        return shuffled_onehot[0]
+    return shuffled_onehot
 
+def mix_uint64(x,key):
+    #splitmix64 finalizer; uint64 arithmetic wraps, which is the intent 
+    with np.errstate(over='ignore'):
+        z=(x+key)*np.uint64(0x9E3779B97F4A7C15)
+        z=(z^(z>>np.uint64(30)))*np.uint64(0xBF58476D1CE4E5B9)
+        z=(z^(z>>np.uint64(27)))*np.uint64(0x94D049BB133111EB)
+        return z^(z>>np.uint64(31))
 
+def lazy_permutation(positions,n,seed,num_rounds=4):
+    '''
+    images of positions under a seeded pseudo-random permutation of range(n), without materializing the permutation.
+    a keyed Feistel network permutes the smallest domain of 4**k >= n values, and positions that land past n are cycle-walked back into range. 
+    positions -- array of ints in [0, n) 
+    seed -- int or tuple of ints, i.e. (seed, epoch); the same seed gives the same permutation in every process 
+    '''
+    positions=np.asarray(positions,dtype=np.uint64)
+    half_bits=max(1,(int(n-1).bit_length()+1)//2)
+    shift=np.uint64(half_bits)
+    half_mask=np.uint64((1<<half_bits)-1)
+    seed=[int(i) for i in seed] if isinstance(seed,(tuple,list)) else [int(seed)]
+    round_keys=np.random.SeedSequence(seed).generate_state(num_rounds,dtype=np.uint64)
+    def permute(x):
+        left=x>>shift
+        right=x&half_mask
+        for round_key in round_keys:
+            left,right=right,left^(mix_uint64(right,round_key)&half_mask)
+        return (left<<shift)|right
+    permuted=permute(positions)
+    out_of_range=np.flatnonzero(permuted>=n)
+    while out_of_range.shape[0]>0:
+        permuted[out_of_range]=permute(permuted[out_of_range])
+        out_of_range=out_of_range[permuted[out_of_range]>=n]
+    return permuted.astype(np.int64)
 
+revcomp_table=str.maketrans('ACGT','TGCA')
+def revcomp(seq):
+    return seq[::-1].upper().translate(revcomp_table)
 
 class DefaultOrderedDictWrapper(object):
     def __init__(self, factory):
@@ -97,11 +239,54 @@ def coords_to_tdb_indices(coords,tdb_instance):
     raise Exception("chrom name:"+str(coords[0])+" not found in tdb array")
 
 
-def tdb_indices_to_coords(indices,tdb_instance):
+def coalesce_windows(window_starts,window_len):
+    '''
+    merge the windows [start, start+window_len) into sorted, non-overlapping ranges so they can be read with a single multi-range query
+    returns (range_starts, range_ends, window_offsets); range ends are exclusive, and window_offsets gives the position 
+    of each window's first base in the concatenation of all ranges 
+    '''
+    window_starts=np.asarray(window_starts,dtype=np.int64)
+    order=np.argsort(window_starts,kind='stable')
+    sorted_starts=window_starts[order]
+    sorted_ends=sorted_starts+window_len
+    #windows have a fixed length, so a new range begins wherever a window starts past the end of the previous window 
+    is_range_start=np.ones(sorted_starts.shape[0],dtype=bool)
+    is_range_start[1:]=sorted_starts[1:]>sorted_ends[:-1]
+    range_ids=np.cumsum(is_range_start)-1
+    range_starts=sorted_starts[is_range_start]
+    last_in_range=np.append(np.flatnonzero(is_range_start)[1:]-1,sorted_starts.shape[0]-1)
+    range_ends=sorted_ends[last_in_range]
+    range_offsets=np.concatenate(([0],np.cumsum(range_ends-range_starts)[:-1]))
+    window_offsets=np.empty_like(window_starts)
+    window_offsets[order]=range_offsets[range_ids]+sorted_starts-range_starts[range_ids]
+    return range_starts,range_ends,window_offsets
+
+def get_tdb_chrom_offsets(tdb_instance):
+    '''
+    returns arrays of chromosome names, tdb index offsets, and sizes from the tdb array metadata, sorted by offset 
+    '''
+    num_chroms=tdb_instance.meta['num_chroms']
+    chrom_names=np.array([tdb_instance.meta['chrom_'+str(i)] for i in range(num_chroms)])
+    chrom_offsets=np.array([tdb_instance.meta['offset_'+str(i)] for i in range(num_chroms)],dtype=np.int64)
+    chrom_sizes=np.array([tdb_instance.meta['size_'+str(i)] for i in range(num_chroms)],dtype=np.int64)
+    order=np.argsort(chrom_offsets,kind='stable')
+    return chrom_names[order],chrom_offsets[order],chrom_sizes[order]
+
+def tdb_indices_to_coords(indices,tdb_instance=None,chrom_starts=None,chrom_ends=None):
     '''
-    indices is a list of tdb indices     
+    indices is an array of tdb indices
+    the chromosome of each index is found with np.searchsorted over the sorted chromosome start offsets; these are read from 
+    tdb_instance metadata, or passed in directly as chrom_starts/chrom_ends (end exclusive) arrays 
+    returns (chrom_codes, positions) arrays; chrom_codes index into the chromosome ranges (i.e. the names from get_tdb_chrom_offsets)
     '''
-    pass
+    if tdb_instance is not None:
+        chrom_names,chrom_starts,chrom_sizes=get_tdb_chrom_offsets(tdb_instance)
+        chrom_ends=chrom_starts+chrom_sizes
+    indices=np.asarray(indices,dtype=np.int64)
+    chrom_codes=np.searchsorted(chrom_starts,indices,side='right')-1
+    if (chrom_codes<0).any() or (indices>=chrom_ends[np.maximum(chrom_codes,0)]).any():
+        raise Exception("tdb indices fall outside of the chromosome index ranges")
+    return chrom_codes,indices-chrom_starts[chrom_codes]
 
 
 def transform_data_type(inputs,num_inputs):
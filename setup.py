@@ -19,7 +19,9 @@ config = {
                                          'kerasAC_interpret=kerasAC.interpret:main',
                                          'kerasAC_plot_interpretation=kerasAC.plot_interpretation:main',
                                          'kerasAC_cross_validate=kerasAC.cross_validate:main',
-                                         'kerasAC_loss_weights_bpnet=kerasAC.helpers.get_loss_weights_for_bpnet:main']},
+                                         'kerasAC_loss_weights_bpnet=kerasAC.helpers.get_loss_weights_for_bpnet:main',
+                                         'kerasAC_label_store=kerasAC.label_store:main',
+                                         'kerasAC_score_variants=kerasAC.score_variants:main']},
     'name': 'kerasAC'
 }
 